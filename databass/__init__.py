@@ -4,6 +4,7 @@ from optimizer import *
 from ops import Print, Yield
 from udfs import *
 from parse_sql import parse 
+from prepared import prepare, PreparedStatement
 from tuples import *
 from tables import *
 from schema import Schema
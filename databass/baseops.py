@@ -14,6 +14,7 @@ from itertools import chain
 from collections import defaultdict
 from compiler import *
 from schema import *
+from tuples import *
 
 class Op(object):
   """
@@ -167,23 +168,58 @@ class Op(object):
     """
     raise Exception("Op.schema() not implemented for %s" % self)
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    """
+    Vectorized execution mode: iterate over the operator's output as 
+    ColumnBatch objects that contain at most @batch_size rows.
+
+    By default, this runs the operator in tuple mode and packs its
+    output rows into batches.  Operators override this to directly
+    process their child operators' batches.
+    """
+    rows = []
+    for row in self:
+      rows.append(list(row.row))
+      if len(rows) >= batch_size:
+        yield ColumnBatch.from_rows(self.schema, rows)
+        rows = []
+    if rows:
+      yield ColumnBatch.from_rows(self.schema, rows)
+
   def compile_exprs(self, ctx, exprs):
     """
     Helper function for compilation.  Compiles a list
     of Expr objects, and returns the temporary variables
-    where the result of each Expr is stored.
+    where the result of each Expr is stored.  Subexpressions
+    that occur more than once are only computed once.
 
     @ctx    Context
     @exprs  list of Expr objects
     """
+    from exprs import compile_exprs
     v_in, _ = ctx.pop_io_vars()
-    vlist = []
-    for e in exprs:
-      v_e = ctx.new_var("tmp")
-      ctx.add_io_vars(v_in, v_e)
-      e.compile(ctx)
-      vlist.append(v_e)
-    return vlist
+    return compile_exprs(ctx, v_in, exprs)
+
+  def exprs_func(self, exprs):
+    """
+    Helper function for the interpreted operators.  
+
+    @exprs  list of Expr objects
+    @return cached function that takes a row and returns the list of the 
+            values of @exprs.  See exprs.compile_exprs_func()
+    """
+    f = self.__dict__.get("_func")
+    if f is None:
+      from exprs import compile_exprs_func
+      f = self._func = compile_exprs_func(exprs)
+    return f
+
+  def clear_func(self):
+    """
+    Clear the function cached by exprs_func() or ExprBase.as_func(), e.g., 
+    because the indexes of the Attrs that it references have changed
+    """
+    self.__dict__.pop("_func", None)
 
   def to_str(self, ctx):
     """
@@ -207,6 +243,7 @@ class Op(object):
           "alias",
           "aliases",
           "join_attrs",
+          "band",
           "ascdesc", 
           "cond", 
           "limit"]
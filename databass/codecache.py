@@ -0,0 +1,185 @@
+"""
+Cache of compiled query functions, so that repeated queries skip code
+generation and Python compilation.  Compiled code objects can also be
+persisted to a directory, so that a new process can load them.
+"""
+import os
+import imp
+import marshal
+import hashlib
+import tempfile
+from collections import OrderedDict
+from baseops import Op
+from exprs import ExprBase, Literal
+from ops import Scan
+from compiler import Context
+from db import Database
+
+FUNCNAME = "compiled_q"
+
+
+def plan_fingerprint(plan):
+  """
+  @plan initialized physical plan
+  @return hex digest that identifies the code generated for @plan.
+          It covers the plan's operators and expressions, the exact values
+          of its literals, the operators' schemas, and the attributes that
+          each Scan reads from its table.
+  """
+  db = Database.db()
+  h = hashlib.sha1(plan.pretty_print())
+  for op in plan.collect(Op):
+    if op.is_type(Literal):
+      # the plan's string rounds floats, but literals are compiled with 
+      # repr().  Params' keys do not depend on their bound values
+      h.update(repr(op.cse_key()))
+    if op.is_type(ExprBase):
+      continue
+    if op.schema is not None:
+      h.update(op.schema.compile_constructor())
+    if op.is_type(Scan):
+      h.update(db.schema(op.tablename).compile_constructor())
+      h.update(repr(op.idxs))
+  return h.hexdigest()
+
+
+def query_namespace():
+  """
+  Compiled code expects the names that `from databass import *` defines
+  """
+  import databass
+  return dict((k, v) for k, v in vars(databass).iteritems()
+              if not k.startswith("_"))
+
+
+class CompiledQuery(object):
+  """
+  A query plan's generated source, its code object, and the function that
+  the code defines.  Calling the object runs the query, where @params are 
+  the values of the plan's Param placeholders by index.
+  """
+  def __init__(self, key, source, code):
+    self.key = key
+    self.source = source
+    self.code = code
+    ns = query_namespace()
+    exec(code, ns)
+    self.func = ns[FUNCNAME]
+
+  def __call__(self, params=()):
+    return self.func(params)
+
+
+class CodeCache(object):
+  """
+  LRU cache of CompiledQuery objects keyed by plan_fingerprint().
+
+  If @cachedir is set, newly compiled queries are also written to it as
+  marshaled code objects, and queries missing from memory are first looked
+  up there.  Marshaled code is specific to the Python version, so files
+  written by another version are ignored.
+  """
+  EXT = ".marshal"
+
+  def __init__(self, capacity=64, cachedir=None, disk_capacity=None):
+    """
+    @capacity      maximum number of compiled queries kept in memory
+    @cachedir      optional directory to persist compiled queries to
+    @disk_capacity maximum number of files kept in @cachedir.
+                   Defaults to 4 * @capacity.
+    """
+    self.capacity = capacity
+    self.cachedir = cachedir
+    self.disk_capacity = disk_capacity or 4 * capacity
+    self.queries = OrderedDict()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    if cachedir and not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+
+  def __call__(self, plan):
+    """
+    @plan initialized physical plan
+    @return CompiledQuery for @plan
+    """
+    key = plan_fingerprint(plan)
+    query = self.queries.pop(key, None)
+    if query is not None:
+      self.hits += 1
+    else:
+      query = self.load(key)
+      if query is not None:
+        self.disk_hits += 1
+      else:
+        self.misses += 1
+        query = self.compile(key, plan)
+        self.store(query)
+      while len(self.queries) >= self.capacity:
+        self.queries.popitem(last=False)
+    self.queries[key] = query
+    return query
+
+  def compile(self, key, plan):
+    ctx = Context()
+    plan.produce(ctx)
+    source = ctx.compiler.compile_to_func(FUNCNAME, ["params=()"])
+    code = compile(source, "<query %s>" % key[:10], "exec")
+    return CompiledQuery(key, source, code)
+
+  def path(self, key):
+    return os.path.join(self.cachedir, key + self.EXT)
+
+  def load(self, key):
+    """
+    @return the CompiledQuery persisted for @key, or None
+    """
+    if not self.cachedir:
+      return None
+    path = self.path(key)
+    try:
+      with open(path, "rb") as f:
+        magic, source, code = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return None
+    if magic != imp.get_magic():
+      return None
+    # mark the file as recently used
+    os.utime(path, None)
+    return CompiledQuery(key, source, code)
+
+  def store(self, query):
+    """
+    Persist @query to the cache directory, and evict the least recently
+    used files beyond the disk capacity
+    """
+    if not self.cachedir:
+      return
+    data = marshal.dumps((imp.get_magic(), query.source, query.code))
+    # write to a temporary file first, so that other processes never
+    # load a partially written file
+    fd, tmppath = tempfile.mkstemp(dir=self.cachedir)
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    os.rename(tmppath, self.path(query.key))
+
+    paths = [os.path.join(self.cachedir, fname)
+             for fname in os.listdir(self.cachedir) if fname.endswith(self.EXT)]
+    if len(paths) > self.disk_capacity:
+      paths.sort(key=os.path.getmtime)
+      for path in paths[:len(paths) - self.disk_capacity]:
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+
+  def __len__(self):
+    return len(self.queries)
+
+  def clear(self):
+    self.queries.clear()
+    self.hits = self.disk_hits = self.misses = 0
+
+  def __str__(self):
+    return "CodeCache(%d/%d queries, %d hits, %d disk hits, %d misses)" % (
+        len(self.queries), self.capacity, self.hits, self.disk_hits, self.misses)
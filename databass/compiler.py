@@ -1,3 +1,4 @@
+import re
 from contextlib import contextmanager
 from collections import *
 from udfs import *
@@ -8,6 +9,58 @@ class Indent(object):
 class Unindent(object):
   pass
 
+class RowVars(object):
+  """
+  A compiled row whose attribute values are held in local variables, one per
+  attribute in the operator's schema, rather than in a ListTuple.  Operators
+  pass RowVars to their parents through ctx['row'], so that pipelined
+  operators read and compute attribute values without constructing or
+  copying tuples.  Rows are only built at pipeline breakers and when the
+  results are emitted.
+
+  A "variable" may also be a constant such as None.
+  """
+  def __init__(self, vars):
+    self.vars = list(vars)
+
+  def __getitem__(self, idx):
+    return self.vars[idx]
+
+  def __len__(self):
+    return len(self.vars)
+
+  def __iter__(self):
+    return iter(self.vars)
+
+  def __add__(self, o):
+    return RowVars(self.vars + o.vars)
+
+  def values(self):
+    """
+    @return code for a list of the row's values
+    """
+    return "[%s]" % ", ".join(self.vars)
+
+  def tuple(self):
+    """
+    @return code for a tuple of the row's values
+    """
+    if len(self.vars) == 1:
+      return "(%s,)" % self.vars[0]
+    return "(%s)" % ", ".join(self.vars)
+
+  def target(self):
+    """
+    @return assignment target that unpacks a sequence into the row's variables
+    """
+    if not self.vars:
+      return "_"
+    return self.tuple()
+
+  def __str__(self):
+    return self.tuple()
+
+
 class Compiler(object):
   """
   Defines helper functions to construct code blocks
@@ -32,13 +85,15 @@ class Compiler(object):
     """
     return self.compile()
 
-  def compile_to_func(self, fname="f"):
+  def compile_to_func(self, fname="f", args=()):
     """
     Wrap the compiled query code with a function definition.
+
+    @args list of the function's arguments, e.g., ["params=()"]
     """
     lines = list(self.lines)
     comp = Compiler()
-    with comp.indent("def %s():" % fname):
+    with comp.indent("def %s(%s):" % (fname, ", ".join(args))):
       comp.add_lines(self.lines)
     return comp.compile()
 
@@ -130,6 +185,39 @@ class Context(object):
     """
     return self.compiler.new_var(*args, **kwargs)
 
+  def new_row_vars(self, schema, prefix="v"):
+    """
+    Allocate a local variable for each attribute in @schema
+
+    @schema Schema of the rows the variables will hold
+    @prefix prefix of the variable names
+    @return RowVars
+    """
+    return RowVars([
+      self.new_var("%s_%s" % (prefix, re.sub(r"\W", "_", a.aname)))
+      for a in schema.attrs])
+
+  def row_vars(self, v_row, schema, prefix="v"):
+    """
+    @v_row RowVars, or name of a variable containing a ListTuple
+    @return RowVars for @v_row.  A ListTuple is unpacked into new local
+            variables.
+    """
+    if isinstance(v_row, RowVars):
+      return v_row
+    v_vars = self.new_row_vars(schema, prefix)
+    self.add_line("%s = %s.row" % (v_vars.target(), v_row))
+    return v_vars
+
+  def row_values(self, v_row):
+    """
+    @v_row RowVars, or name of a variable containing a ListTuple
+    @return code for a new list of @v_row's values
+    """
+    if isinstance(v_row, RowVars):
+      return v_row.values()
+    return "list(%s.row)" % v_row
+
   def add_io_vars(self, in_var, out_var):
     """
     Add an io variable request for expression compilation.
@@ -36,6 +36,8 @@ class Database(object):
     self.registry = {}
     self.function_registry = {}
     self.table_function_registry = {}
+    # incremented whenever the catalog changes, e.g., to invalidate plans
+    self.version = 0
     self.setup()
 
   @staticmethod
@@ -66,12 +68,13 @@ class Database(object):
 
   def register_table(self, tablename, schema, table):
     self.registry[tablename] = table
+    self.version += 1
+    # compute the table's statistics once, up front
+    table.stats
 
   def register_dataframe(self, tablename, df):
     schema = infer_schema_from_df(df)
-    rows = df.T.to_dict().values()
-    rows = [[row[attr.aname] for attr in schema] for row in rows]
-    table = InMemoryTable(schema, rows)
+    table = ColumnarTable.from_dataframe(schema, df)
     self.register_table(tablename, schema, table)
 
   @property
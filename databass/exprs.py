@@ -9,8 +9,13 @@
      T.a + 2 / T.b
 
 """
+import numpy as np
+from itertools import chain
+from collections import defaultdict, OrderedDict
 from baseops import *
 from util import guess_type
+from compiler import RowVars, Compiler, Context
+from udfs import UDFRegistry
 
 
 def unary(op, v):
@@ -45,11 +50,208 @@ def binary(op, l, r):
   if op == ">=": return l >= r
   raise Exception("binary op not implemented")
 
+def unary_batch(op, v):
+  """
+  vectorized version of unary() where v may be a NumPy array
+  """
+  if not isinstance(v, np.ndarray):
+    return unary(op, v)
+  if op.lower() == "not":
+    return np.logical_not(truthy(v))
+  return unary(op, v)
+
+def binary_batch(op, l, r):
+  """
+  vectorized version of binary() where l and r may be NumPy arrays
+  """
+  if not (isinstance(l, np.ndarray) or isinstance(r, np.ndarray)):
+    return binary(op, l, r)
+  if op in ("and", "or"):
+    lmask, rmask = truthy(l), truthy(r)
+    if lmask is l and rmask is r:
+      f = np.logical_and if op == "and" else np.logical_or
+      return f(l, r)
+    if op == "and": 
+      return np.where(lmask, r, l)
+    return np.where(lmask, l, r)
+  return binary(op, l, r)
+
+class ParamValues(object):
+  """
+  The values currently bound to a set of Param expressions, indexed by
+  Param.idx.  Used by functions generated by compile_expr()
+  """
+  def __init__(self, params):
+    self.params = dict((param.idx, param) for param in params)
+
+  def __getitem__(self, idx):
+    return self.params[idx].v
+
+def factor_common_subexprs(exprs, new_var):
+  """
+  Find the subexpressions that occur more than once in @exprs, so that they
+  can be computed once per row.
+
+  @exprs   list of expressions evaluated over the same row
+  @new_var function that allocates a variable name
+  @return (common, exprs), where common is a list of (variable, expression)
+          for each repeated subexpression, in the order they should be 
+          computed, and exprs is @exprs with the repeated subexpressions 
+          replaced by Var references
+  """
+  counts = defaultdict(int)
+  firsts = OrderedDict()
+  def visit(e):
+    for child in e.subexprs():
+      visit(child)
+    key = e.cse_key()
+    if key is None or e.is_type([Attr, Literal, AggFunc, Var]):
+      return
+    counts[key] += 1
+    firsts.setdefault(key, e)
+  for e in exprs:
+    visit(e)
+
+  vars = {}
+  def f(e):
+    key = e.cse_key()
+    if key in vars:
+      return Var(vars[key])
+    return None
+
+  # firsts is in post-order, so a subexpression's own repeated
+  # subexpressions are computed before it
+  common = []
+  for key, e in firsts.iteritems():
+    if counts[key] > 1:
+      v = new_var("cse")
+      common.append((v, e.replace_subexprs(f)))
+      vars[key] = v
+  return common, [e.replace_subexprs(f) for e in exprs]
+
+def compile_exprs(ctx, v_in, exprs):
+  """
+  Compiles a list of expressions over the row @v_in, where subexpressions 
+  that occur more than once are computed once.
+
+  @return variables where the result of each expression is stored
+  """
+  common, exprs = factor_common_subexprs(exprs, ctx.new_var)
+  for v, e in common:
+    ctx.add_io_vars(v_in, v)
+    e.compile(ctx)
+
+  vlist = []
+  for e in exprs:
+    if e.is_type(Var):
+      vlist.append(e.name)
+      continue
+    v_e = ctx.new_var("tmp")
+    ctx.add_io_vars(v_in, v_e)
+    e.compile(ctx)
+    vlist.append(v_e)
+  return vlist
+
+def compile_exprs_func(exprs, as_list=True):
+  """
+  Generate a single Python function that evaluates @exprs over a ListTuple,
+  from the same code that expressions compile to in compiled queries.
+
+  @as_list if False, @exprs must have one expression, whose value the
+           function returns
+  @return function that takes a row and returns the list of the values of 
+          @exprs
+  """
+  if any(e.collect(Star) for e in exprs):
+    if not as_list:
+      return exprs[0].__call__
+    return lambda row: [e(row) for e in exprs]
+
+  ctx = Context()
+  vlist = compile_exprs(ctx, "vals", exprs)
+  comp = Compiler()
+  with comp.indent("def exprs_f(row):"):
+    if any(e.collect([Attr, AggFunc]) for e in exprs):
+      comp.add_line("vals = row.row")
+    comp.add_lines(ctx.compiler.lines)
+    if as_list:
+      comp.add_line("return [%s]" % ", ".join(vlist))
+    else:
+      comp.add_line("return %s" % vlist[0])
+
+  params = list(chain(*[e.collect(Param) for e in exprs]))
+  ns = dict(UDFRegistry=UDFRegistry, params=ParamValues(params))
+  name = "<exprs %s>" % ", ".join(map(str, exprs))
+  exec(compile(comp.compile(), name, "exec"), ns)
+  return ns["exprs_f"]
+
+def compile_expr(expr):
+  """
+  @return function that takes a ListTuple and returns @expr's value. 
+          See compile_exprs_func()
+  """
+  return compile_exprs_func([expr], as_list=False)
+
 class ExprBase(Op):
 
   def get_type(self):
     raise Exception("ExprBase.get_type() not implemented")
 
+  def as_func(self):
+    """
+    The interpreted operators evaluate expressions with this instead of
+    __call__, which recurses into every node of the tree and dispatches
+    on the operator for every row.  See compile_expr().
+
+    @return cached function that takes a row and returns the expression's value
+    """
+    f = self.__dict__.get("_func")
+    if f is None:
+      f = self._func = compile_expr(self)
+    return f
+
+  def subexprs(self):
+    """
+    @return the expressions that are evaluated to compute this expression
+    """
+    return [c for c in self.referenced_op_children() if isinstance(c, ExprBase)]
+
+  def cse_key(self):
+    """
+    @return hashable key that is equal for expressions that compute the same
+            value over the same row, or None if the expression should not be
+            shared (e.g., it calls a UDF, which may not be deterministic)
+    """
+    return None
+
+  def replace_subexprs(self, f):
+    """
+    @f function that takes a subexpression and returns the expression to 
+       replace it with, or None to keep it
+    @return copy of the expression with the subexpressions replaced, or the
+            expression itself if nothing was replaced
+    """
+    e = f(self)
+    if e is not None:
+      return e
+    changes = {}
+    for key, val in self.__dict__.iteritems():
+      if isinstance(val, ExprBase):
+        new = val.replace_subexprs(f)
+        if new is not val:
+          changes[key] = new
+      elif isinstance(val, list):
+        new = [v.replace_subexprs(f) if isinstance(v, ExprBase) else v for v in val]
+        if any(v1 is not v2 for v1, v2 in zip(new, val)):
+          changes[key] = new
+    if not changes:
+      return self
+    e = self.__class__.__new__(self.__class__)
+    e.__dict__.update(self.__dict__)
+    e.__dict__.update(changes)
+    e.clear_func()
+    return e
+
   def compile(self, ctx):
     """
     @ctx contains the input and output variable that expression
@@ -60,6 +262,48 @@ class ExprBase(Op):
     """
     raise Exception("ExprBase.compile() not implemented")
 
+  def eval_batch(self, batch):
+    """
+    Vectorized evaluation over every row in a ColumnBatch.
+
+    @return NumPy array with one value per row, or a scalar if the
+            expression has the same value for every row
+    """
+    raise Exception("ExprBase.eval_batch() not implemented")
+
+  def copy(self):
+    """
+    Deep copy of the expression.  The copy's Attr references are new 
+    objects, so they can be disambiguated independently of the original's.
+    """
+    e = self.__class__.__new__(self.__class__)
+    for key, val in self.__dict__.iteritems():
+      if key == "_func":
+        continue
+      if isinstance(val, ExprBase):
+        val = val.copy()
+      elif isinstance(val, list):
+        val = [v.copy() if isinstance(v, ExprBase) else v for v in val]
+      e.__dict__[key] = val
+    return e
+
+  def substitute(self, f):
+    """
+    @f function that takes an Attr reference and returns the expression to
+       replace it with
+    @return copy of the expression where every Attr reference is replaced
+    """
+    e = self.__class__.__new__(self.__class__)
+    for key, val in self.__dict__.iteritems():
+      if key == "_func":
+        continue
+      if isinstance(val, ExprBase):
+        val = val.substitute(f)
+      elif isinstance(val, list):
+        val = [v.substitute(f) if isinstance(v, ExprBase) else v for v in val]
+      e.__dict__[key] = val
+    return e
+
   def __str__(self):
     raise Exception("ExprBase.__str__() not implemented")
 
@@ -140,6 +384,13 @@ class Expr(ExprBase):
       line = "%s = %s(%s)" % (v_out, self.op, v_l)
     ctx.add_line(line)
 
+  def cse_key(self):
+    keys = [c.cse_key() for c in (self.l, self.r) if c is not None]
+    if None in keys:
+      return None
+    op = "==" if self.op == "=" else self.op.lower()
+    return ("Expr", op) + tuple(keys)
+
   def __call__(self, row):
     l = self.l(row)
     if self.r is None:
@@ -147,6 +398,13 @@ class Expr(ExprBase):
     r = self.r(row)
     return binary(self.op, l, r)
 
+  def eval_batch(self, batch):
+    l = self.l.eval_batch(batch)
+    if self.r is None:
+      return unary_batch(self.op, l)
+    r = self.r.eval_batch(batch)
+    return binary_batch(self.op, l, r)
+
 class Paren(ExprBase):
   def __init__(self, c):
     self.c = c
@@ -160,9 +418,15 @@ class Paren(ExprBase):
   def compile(self, ctx):
     self.c.compile(ctx)
 
+  def cse_key(self):
+    return self.c.cse_key()
+
   def __call__(self, tup):
     return self.c(tup)
 
+  def eval_batch(self, batch):
+    return self.c.eval_batch(batch)
+
 
 class Between(ExprBase):
   def __init__(self, expr, lower, upper):
@@ -193,25 +457,44 @@ class Between(ExprBase):
     self.lower.compile(ctx)
     ctx.add_io_vars(v_in, v_u)
     self.upper.compile(ctx)
-    line = "%s = (%s) > (%s) && (%s) <= (%s)" % (
+    line = "%s = (%s) >= (%s) and (%s) <= (%s)" % (
         v_out, v_e, v_l, v_e, v_u)
     ctx.add_line(line)
 
-  def __call__(self, tup, tup2=None):
-    e = self.expr(tup, tup2)
-    l = self.lower(tup, tup2)
-    u = self.upper(tup, tup2)
+  def cse_key(self):
+    keys = [self.expr.cse_key(), self.lower.cse_key(), self.upper.cse_key()]
+    if None in keys:
+      return None
+    return ("Between",) + tuple(keys)
+
+  def __call__(self, tup):
+    e = self.expr(tup)
+    l = self.lower(tup)
+    u = self.upper(tup)
     return e >= l and e <= u
 
+  def eval_batch(self, batch):
+    e = self.expr.eval_batch(batch)
+    l = self.lower.eval_batch(batch)
+    u = self.upper.eval_batch(batch)
+    return binary_batch("and", e >= l, e <= u)
+
 class AggFunc(ExprBase):
   """
-  Expression Wrapper around an AggUDF instance
+  Expression Wrapper around an AggUDF instance.
+
+  The aggregate is computed by the GroupBy operator below it, which adds
+  an attribute (self.agg_attr) for each aggregate to its output schema.
+  See GroupBy.init_schema()
   """
+  id = 0
+
   def __init__(self, f, args):
     self.name = f.name
     self.args = args
     self.f = f
-    self.group_attr = Attr("__group__")
+    self.agg_attr = Attr("__agg%d__" % AggFunc.id, "num")
+    AggFunc.id += 1
 
     # set the Attr references in the arguments to be array typed.
     for arg in self.args:
@@ -222,48 +505,31 @@ class AggFunc(ExprBase):
     return "num"
 
   def __call__(self, row):
-    idx = self.group_attr.idx
-    args = []
-    for grow in row[idx]:
-      args.append([arg(grow) for arg in self.args])
-
-    # make the arguments columnar:
-    #   [ (a,a,a,a), (b,b,b,b) ]
-    args = zip(*args)
-    return self.f(*args)
+    return row[self.agg_attr.idx]
+
+  def subexprs(self):
+    # the arguments are evaluated by the GroupBy, not over this row
+    return []
+
+  def cse_key(self):
+    return ("AggFunc", self.agg_attr.aname)
+
+  def replace_subexprs(self, f):
+    return f(self) or self
+
+  def eval_batch(self, batch):
+    return batch.cols[self.agg_attr.idx]
 
   def compile(self, ctx):
     """
-    Compiles and writes Python code that reads one input row, which should contains a 
-    __group__ attribute, computes the arguments for the aggregation function, and calls it.
+    Compiles and writes Python code that reads the aggregate's value, computed by
+    the child GroupBy, from the input row.
 
     @ctx Context object that contains appropriately set (v_in, v_out) variable names.
          v_in points to a single input row
          See Context.pop_io_vars() for details
     """
-    v_in, v_out = ctx.pop_io_vars()
-    v_g = ctx.new_var("tmp")
-    v_irow = ctx.new_var("irow")
-    v_args = ctx.new_var("args")
-
-    # put row.__group__ into v_g
-    ctx.add_io_vars(v_in, v_g)
-    self.group_attr.compile(ctx)
-    ctx.add_line("%s = [[] for i in range(%d)]" % (
-      v_args, len(self.args)))
-
-    # Iterate through the rows in the group to evaluate each argument
-    line = "for %s in %s: " % (v_irow, v_g)
-    with ctx.compiler.indent(line):
-      for idx, arg in enumerate(self.args):
-        v_arg = ctx.new_var("tmp")
-        ctx.add_io_vars(v_irow, v_arg)
-        arg.compile(ctx)
-        ctx.add_line("%s[%d].append(%s)" % (v_args, idx, v_arg))
-
-    # now, call the UDF with the prepared argument lists
-    line = "%s = UDFRegistry.registry()['%s'](*%s)" % (v_out, self.name, v_args)
-    ctx.add_line(line)
+    self.agg_attr.compile(ctx)
 
   def __str__(self):
     args = ",".join(map(str, self.args))
@@ -279,9 +545,15 @@ class ScalarFunc(ExprBase):
   def get_type(self):
     return "str"
 
-  def __call__(self, ctx):
+  def __call__(self, row):
     args = [arg(row) for arg in self.args]
-    return f(*args)
+    return self.f(*args)
+
+  def eval_batch(self, batch):
+    args = [as_column(arg.eval_batch(batch), batch.n).tolist() for arg in self.args]
+    if not args:
+      return self.f()
+    return to_column([self.f(*vals) for vals in zip(*args)])
 
   def compile(self, ctx):
     """
@@ -300,7 +572,6 @@ class ScalarFunc(ExprBase):
       ctx.add_io_vars(v_in, v_arg)
       arg.compile(ctx)
       vlist.append(v_arg)
-    vlist = ", ".join(vlist)
 
     line = "%s = UDFRegistry.registry()['%s'](%s)" % (v_out, self.name, ", ".join(vlist))
     ctx.add_line(line)
@@ -317,6 +588,12 @@ class Literal(ExprBase):
   def __call__(self, row):
     return self.v
 
+  def eval_batch(self, batch):
+    return self.v
+
+  def cse_key(self):
+    return ("Literal", type(self.v).__name__, repr(self.v))
+
   def get_type(self):
     return guess_type(self.v)
 
@@ -327,13 +604,48 @@ class Literal(ExprBase):
 
   def compile(self, ctx):
     v_in, v_out = ctx.pop_io_vars()
-    line = "%s = %s" % (v_out, self)
-    ctx.add_line(line)
+    # repr() is a python literal of the value: str() of a float may round
+    # it, and __str__ of a string does not escape its quotes
+    ctx.add_line("%s = %r" % (v_out, self.v))
 
 class Bool(Literal):
   def __init__(self, v):
     super(Bool, self).__init__(v)
 
+class Param(Literal):
+  """
+  Placeholder for a value that is bound when a prepared statement is 
+  executed (see prepared.py).  The interpreted and vectorized operators
+  read the bound value from the slot self.v, whereas compiled code reads 
+  it from the compiled function's params argument, so that the code can be 
+  reused for different values.
+  """
+  def __init__(self, idx, name=None):
+    """
+    @idx  index of the parameter's value in the statement's parameter list
+    @name parameter name for :name placeholders, or None for ?
+    """
+    super(Param, self).__init__(None)
+    self.idx = idx
+    self.name = name
+
+  def get_type(self):
+    if self.v is None:
+      return "?"
+    return guess_type(self.v)
+
+  def __str__(self):
+    if self.name:
+      return ":%s" % self.name
+    return "?"
+
+  def cse_key(self):
+    return ("Param", self.idx)
+
+  def compile(self, ctx):
+    v_in, v_out = ctx.pop_io_vars()
+    ctx.add_line("%s = params[%d]" % (v_out, self.idx))
+
 class Attr(ExprBase):
   """
   This class incorporates all uses and representatinos of attribute references in DataBass.
@@ -375,15 +687,13 @@ class Attr(ExprBase):
     self.group_schema = group_schema
 
     # If the child operator is GroupBy, and Attr is used as an expression,
-    # then Attr may refer to an attribute within a group.  In that case we
-    # need to index into the input row # to retrieve __group__, and then 
-    # index into the group's rows:
-    #
-    #       # input_row.__group__.attr
-    #       input_row[gidx][idx]
+    # then Attr may refer to an attribute within a group (an argument of 
+    # an aggregation function).  GroupBy evaluates such arguments over 
+    # its input rows (see GroupBy.collect_aggs()), so
     #
     # * gidx is the index in child operator's schema that contains the __group__ attr.
-    # * idx stores the index within the __group__ attr's schema
+    # * idx stores the index within the __group__ attr's schema, which is 
+    #   the GroupBy's input schema
     #
     # It should be initialized in optimizer.disambiguate_attrs()
     self.gidx = None
@@ -415,8 +725,12 @@ class Attr(ExprBase):
     for key, val in self.__dict__.iteritems():
       attr.__dict__[key] = val
     attr.id = id
+    attr.clear_func()
     return attr
 
+  def substitute(self, f):
+    return f(self)
+
   def matches(self, attr):
     """
     If self can satisfy the @attr argument, where @attr can be less specific 
@@ -436,6 +750,12 @@ class Attr(ExprBase):
   def __call__(self, row):
     return row[self.idx]
 
+  def eval_batch(self, batch):
+    return batch.cols[self.idx]
+
+  def cse_key(self):
+    return ("Attr", self.tablename, self.aname, self.idx)
+
   def __hash__(self):
     return hash(self.id)
 
@@ -445,11 +765,15 @@ class Attr(ExprBase):
     the python code to set the output variable to the input row's attribute val.
 
     @ctx Context object, where the top io variable pair (v_in, v_out) represents 
-         the variable containing the input row, and output variable that stores
-         the attribute value.
+         the variable containing the input row (or the input row's RowVars), 
+         and output variable that stores the attribute value.
     """
     v_in, v_out = ctx.pop_io_vars()
-    line = "%s = %s[%s]" % (v_out, v_in, self.idx)
+    if isinstance(v_in, RowVars):
+      # the attribute value is already in a local variable
+      line = "%s = %s" % (v_out, v_in[self.idx])
+    else:
+      line = "%s = %s[%s]" % (v_out, v_in, self.idx)
     ctx.add_line(line)
 
   def compile_constructor(self):
@@ -493,4 +817,20 @@ class Star(ExprBase):
     raise Exception("I don't support turning SELECT * into python code")
 
 
+class Var(ExprBase):
+  """
+  Reference to a compiled variable that holds the value of a common
+  subexpression.  See factor_common_subexprs()
+  """
+  def __init__(self, name):
+    self.name = name
+
+  def cse_key(self):
+    return ("Var", self.name)
+
+  def compile(self, ctx):
+    v_in, v_out = ctx.pop_io_vars()
+    ctx.add_line("%s = %s" % (v_out, self.name))
 
+  def __str__(self):
+    return self.name
@@ -1,13 +1,18 @@
 """
 Implementation of logical and physical relational operators
 """
+import numpy as np
 from baseops import *
 from exprs import *
 from db import Database
+from tables import ColumnarTable
 from schema import *
 from tuples import *
-from util import cache, OBTuple
+from util import cache, sort_order, top_rows, group_key
 from itertools import chain
+from operator import itemgetter
+from compiler import RowVars
+from spill import ExternalSort, HybridHashTable
 
 
 ########################################################
@@ -33,6 +38,10 @@ class SubQuerySource(Source):
     for row in self.c:
       yield row
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    for batch in self.c.iter_batches(batch_size):
+      yield ColumnBatch(self.schema, batch.cols, batch.n)
+
   def init_schema(self):
     """
     A source operator's schema should be initialized with the same 
@@ -52,10 +61,18 @@ class Scan(Source):
   """
   A scan operator over a table in the Database singleton.
   """
-  def __init__(self, tablename, alias=None):
+  def __init__(self, tablename, alias=None, attrs=None):
+    """
+    @tablename name of the table in the database
+    @alias     name that the query uses to refer to the table
+    @attrs     optional list of the names of the attributes to read.
+               By default, the scan outputs all of the table's attributes.
+    """
     super(Scan, self).__init__()
     self.tablename = tablename
     self.alias = alias or tablename
+    self.attrs = attrs
+    self.idxs = None  # indexes of self.attrs in the table's schema
 
   def init_schema(self):
     """
@@ -63,7 +80,13 @@ class Scan(Source):
     tablename as the operator's alias
     """
     db = Database.db()
-    self.schema = db.schema(self.tablename).copy()
+    schema = db.schema(self.tablename)
+    if self.attrs is None:
+      self.idxs = None
+      self.schema = schema.copy()
+    else:
+      self.idxs = [schema.idx(Attr(aname)) for aname in self.attrs]
+      self.schema = Schema([schema.attrs[idx].copy() for idx in self.idxs])
     self.schema.set_tablename(self.alias)
     return self.schema
 
@@ -71,21 +94,47 @@ class Scan(Source):
     # initialize a single intermediate tuple
     irow = ListTuple(self.schema, [])
 
-    for row in Database.db()[self.tablename]:
-      irow.row = row.row
+    for row in self.iter_table_rows(Database.db()[self.tablename]):
+      irow.row = row
       yield irow
 
-  def produce(self, ctx):
-    v_row = ctx.new_var("scan_row")
+  def iter_table_rows(self, table):
+    if self.idxs is None:
+      return table.iter_rows()
+    return table.iter_rows(self.idxs)
 
-    cond = "for %s in Database.db()['%s']:" % (v_row, self.tablename)
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    table = Database.db()[self.tablename]
+    if not isinstance(table, ColumnarTable):
+      for batch in super(Scan, self).iter_batches(batch_size):
+        yield batch
+      return
+
+    columns = table.columns
+    if self.idxs is not None:
+      columns = [columns[idx] for idx in self.idxs]
+    # slices of the table's arrays are views, so this doesn't copy data
+    for start in xrange(0, len(table), batch_size):
+      cols = [col[start:start+batch_size] for col in columns]
+      yield ColumnBatch(self.schema, cols, len(cols[0]) if cols else 0)
+
+  def produce(self, ctx):
+    # unpack each row's values directly into a local variable per attribute
+    v_vars = ctx.new_row_vars(self.schema, self.alias)
+    v_table = ctx.new_var("scan_table")
+    ctx.add_line("%s = Database.db()['%s']" % (v_table, self.tablename))
+    cond = "for %s in %s.iter_rows(%s):" % (
+        v_vars.target(), v_table, "" if self.idxs is None else self.idxs)
     with ctx.compiler.indent(cond):
-      # give variable name for the scan row to parent operator
-      ctx["row"] = v_row
+      # give the attribute variables for the scan row to parent operator
+      ctx["row"] = v_vars
       self.consume_parent(ctx)
 
   def __str__(self):
-    return "Scan(%s AS %s)" % (self.tablename, self.alias)
+    if self.attrs is None:
+      return "Scan(%s AS %s)" % (self.tablename, self.alias)
+    return "Scan(%s(%s) AS %s)" % (
+        self.tablename, ", ".join(self.attrs), self.alias)
 
 class TableFunctionSource(UnaryOp):
   """
@@ -103,6 +152,40 @@ class TableFunctionSource(UnaryOp):
   def __str__(self):
     return "TableFunctionSource(%s)" % self.alias
 
+class Empty(UnaryOp):
+  """
+  An operator that outputs no rows.  The optimizer replaces subplans that 
+  can never produce results, such as a Filter whose condition is always
+  false, with it.
+  """
+  def __init__(self, schema):
+    """
+    @schema schema of the subplan that the operator replaces
+    """
+    super(Empty, self).__init__()
+    self.rel_schema = schema.copy()
+
+  def init_schema(self):
+    self.schema = self.rel_schema.copy()
+    return self.schema
+
+  def __iter__(self):
+    return iter(())
+
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    return iter(())
+
+  def produce(self, ctx):
+    # a loop that never runs, so that the parent operators still 
+    # generate their code
+    v_vars = ctx.new_row_vars(self.schema, "empty")
+    with ctx.compiler.indent("for %s in ():" % v_vars.target()):
+      ctx["row"] = v_vars
+      self.consume_parent(ctx)
+
+  def __str__(self):
+    return "EMPTY"
+
 
 ########################################################
 #
@@ -122,7 +205,59 @@ class From(NaryOp):
         c.to_str(ctx)
 
 class Join(BinaryOp):
-  pass
+  def init_join_attrs(self, join_attrs):
+    """
+    @join_attrs [left attribute, right attribute], or a list of 
+                (left attribute, right attribute) pairs for joins on 
+                several attributes
+    @return     flat list of the left attributes followed by the right 
+                attributes
+    """
+    if join_attrs and isinstance(join_attrs[0], (list, tuple)):
+      lattrs, rattrs = zip(*join_attrs)
+      return list(lattrs) + list(rattrs)
+    return list(join_attrs)
+
+  @property
+  def left_attrs(self):
+    return self.join_attrs[:len(self.join_attrs) / 2]
+
+  @property
+  def right_attrs(self):
+    return self.join_attrs[len(self.join_attrs) / 2:]
+
+  @property
+  def join_keys(self):
+    """
+    list of (left attribute, right attribute) pairs that must be equal
+    """
+    return zip(self.left_attrs, self.right_attrs)
+
+  def consume_joined(self, ctx, v_irow):
+    """
+    Emits code that evaluates the join's residual condition, if any, over
+    the joined row @v_irow and passes the row to the parent operator.
+    """
+    if getattr(self, "cond", None) is None:
+      ctx['row'] = v_irow
+      self.consume_parent(ctx)
+      return
+
+    v_e = ctx.new_var("join_cond")
+    ctx.add_io_vars(v_irow, v_e)
+    self.cond.compile(ctx)
+    with ctx.compiler.indent("if %s:" % v_e):
+      ctx['row'] = v_irow
+      self.consume_parent(ctx)
+
+  def filter_batch(self, batch):
+    """
+    Vectorized version of the residual condition
+    """
+    if getattr(self, "cond", None) is None:
+      return batch
+    mask = truthy(as_column(self.cond.eval_batch(batch), batch.n))
+    return batch.take(mask)
 
 class ThetaJoin(Join):
   """
@@ -141,13 +276,14 @@ class ThetaJoin(Join):
 
     # Variables allocated during compilation that are shared
     # between the produce and consume phases.
-    self.v_irow = None  # intermediate row emitted to parent op
-    self.v_lrow = None  # variable to contain left row
-    self.v_rrow = None  # variable to contain right row
+    self.v_irow = None  # RowVars of the intermediate row emitted to parent op
+    self.v_lrow = None  # RowVars of the left row
+    self.v_rrow = None  # RowVars of the right row
 
   def __iter__(self):
     # initialize a single intermediate tuple
     irow = ListTuple(self.schema, [])
+    cond = self.cond.as_func()
 
     for lrow in self.l:
       for rrow in self.r:
@@ -155,24 +291,17 @@ class ThetaJoin(Join):
         irow.row[:len(lrow.row)] = lrow.row
         irow.row[len(lrow.row):] = rrow.row
 
-        if self.cond(irow):
+        if cond(irow):
           yield irow
 
   def produce(self, ctx):
     """
     Produce's job is to 
     1. request the var name for the left input row
-    2. allocate a variable and Tuple for the intermediate row
-    3. call produce on left child
+    2. call produce on left child
     """
     # ask child operator to set "row" to variable name that will hold left row
     ctx.request_vars(dict(row=None))
-
-    # intermediate row
-    self.v_irow = ctx.new_var("theta_row")
-    line = "%s = ListTuple(%s)" % (self.v_irow, 
-        self.schema.compile_constructor())
-    ctx.add_line(line)
     self.l.produce(ctx)
 
   def consume(self, ctx):
@@ -197,7 +326,7 @@ class ThetaJoin(Join):
     Retreive the variable allocated by the left subplan and
     setup context for right subplan
     """
-    self.v_lrow = ctx['row']
+    self.v_lrow = ctx.row_vars(ctx['row'], self.l.schema)
     ctx.pop_vars()
 
     ctx.request_vars(dict(row=None))
@@ -206,21 +335,17 @@ class ThetaJoin(Join):
   def consume_right(self, ctx):
     """
     This writes the inner loop logic for the nested loops join.
-    To do so, retreive variable allocated by right subplan, and write the 
-    compiled python code to create the intermediate row, call the 
-    join condition expression, and pass control to parent's consume.
+    To do so, retreive variable allocated by right subplan, call the 
+    join condition expression over the left and right rows' variables, 
+    and pass control to parent's consume.
 
-    Make sure to pass the variable name of output row for the parent operator.
+    Make sure to pass the variables of the output row for the parent operator.
     """
     v_e = ctx.new_var("theta_cond")
-    self.v_rrow = ctx['row']
+    self.v_rrow = ctx.row_vars(ctx['row'], self.r.schema)
     ctx.pop_vars()
-    nlattrs = len(self.l.schema.attrs)
-    lines = [
-      "%s.row[:%d] = %s.row" % (self.v_irow, nlattrs, self.v_lrow),
-      "%s.row[%d:] = %s.row" % (self.v_irow, nlattrs, self.v_rrow)
-    ]
-    ctx.add_lines(lines)
+    # the intermediate row is just the left and right rows' variables
+    self.v_irow = self.v_lrow + self.v_rrow
 
     ctx.add_line("# ThetaJoin: if %s" % self.cond)
     ctx.add_io_vars(self.v_irow, v_e)
@@ -236,9 +361,13 @@ class ThetaJoin(Join):
     
 class HashJoin(Join):
   """
-  Hash Join
+  Hybrid Hash Join.  The build (right) side is kept in memory up to 
+  max_rows rows, and larger inputs are partitioned to disk along with the 
+  matching probe rows (see spill.HybridHashTable)
   """
-  def __init__(self, l, r, join_attrs):
+  MAX_ROWS = 1000000
+
+  def __init__(self, l, r, join_attrs, cond=None, max_rows=None):
     """
     @l    left table of the join
     @r    right table of the join
@@ -250,20 +379,35 @@ class HashJoin(Join):
 
                 then we return all pairs of (l, r) where 
                 l.STORE = r.storee
+
+                To join on several attributes, pass a list of pairs, 
+                e.g., [("STORE", "storee"), ("DATE", "date")].  The hash
+                table is then keyed on tuples of the attributes' values.
+    @cond optional residual condition that is evaluated over the
+          concatenated left and right rows of each matching pair
+    @max_rows maximum number of build rows to keep in memory.
+              Defaults to MAX_ROWS
     """
     super(HashJoin, self).__init__(l, r)
-    self.join_attrs = join_attrs
+    self.join_attrs = self.init_join_attrs(join_attrs)
+    self.cond = cond
+    self.max_rows = max_rows or self.MAX_ROWS
 
     self.state = 0
 
     # allocate variables for all state shared between produce/consume
     self.v_ht = None   # hashtable
-    self.v_irow = None # intermediate row
     self.v_lrow = None # left row allocated by left subplan
     self.v_rrow = None # right row allocated by right subplan
     self.v_lkey = None # left row's join key
     self.v_rkey = None # right row's join key
 
+  def __str__(self):
+    keys = " AND ".join("%s = %s" % key for key in self.join_keys)
+    # the memory budget is compiled into the code, so it is part of the
+    # plan's CodeCache fingerprint
+    return "HASHJOIN(ON %s, COND %s, MAX_ROWS %d)" % (keys, self.cond, self.max_rows)
+
   def __iter__(self):
     """
     Build an index on the inner (right) source, then probe the index
@@ -273,79 +417,500 @@ class HashJoin(Join):
     """
     # initialize intermediate row to populate and pass to parent operators
     irow = ListTuple(self.schema)
+    cond = self.cond and self.cond.as_func()
 
-    # Hash join is equality on left_attr and right_attr    
-    lidx = self.join_attrs[0].idx
-    ridx = self.join_attrs[1].idx
-    index = self.build_hash_index(self.r, ridx)
-
-
-    for lrow in self.l:
-      # probe the hash index
-      lval = lrow[lidx]
-      key = hash(lval)
-      matches = index[key]
+    # Hash join is equality on the left and right join attributes
+    table = self.build_hash_table(self.r, self.key_func(self.right_attrs))
+    lkey = self.key_func(self.left_attrs)
 
+    nleft = len(self.l.schema.attrs)
+    for lrow, matches in chain(self.probe_hash_table(table, lkey), 
+                               table.spilled_matches()):
       # generate outputs for all matching tuples
-      irow.row[:len(lrow.row)] = lrow.row
+      irow.row[:nleft] = lrow
       for rrow in matches:
-        irow.row[len(lrow.row):] = rrow.row
-        yield irow
+        irow.row[nleft:] = rrow
+        if cond is None or cond(irow):
+          yield irow
 
-  def build_hash_index(self, child_iter, idx):
+  def key_func(self, attrs):
+    """
+    @attrs join attributes of one side
+    @return function that maps a row's values to its join key: the 
+            attribute's value, or the tuple of the attributes' values
+    """
+    return itemgetter(*[attr.idx for attr in attrs])
+
+  def probe_hash_table(self, table, keyf):
+    """
+    Probe the hash table with the outer (left) rows' join keys.  
+    The rows of the table's spilled partitions are instead joined by 
+    table.spilled_matches()
+
+    @return iterator over (left row's values, list of matching right rows)
+    """
+    index = table.index
+    spilled = table.spilled
+    for lrow in self.l:
+      key = keyf(lrow.row)
+      if spilled:
+        matches = table.lookup(key, lrow.row)
+      else:
+        # use get() so that probes that miss don't insert into the index
+        matches = index.get(key)
+      if matches:
+        yield lrow.row, matches
+
+  def build_hash_table(self, child_iter, keyf):
     """
     @child_iter tuple iterator to construct an index over
-    @attr attribute name to build index on
+    @keyf       function that computes a row's join key (see key_func())
 
-    Loops through a tuple iterator and creates an index based on
-    the attr value
+    Loops through a tuple iterator and creates a HybridHashTable that
+    maps each join key to the rows' values
     """
-    # defaultdict will initialize a hash entry to a new list if
-    # the entry is not found
-    index = defaultdict(list)
+    table = HybridHashTable(self.max_rows)
     for row in child_iter:
-      val = row[idx]
-      key = hash(val)
-      index[key].append(row.copy())
+      table.add(keyf(row.row), tuple(row.row))
+    return table
+
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    """
+    Vectorized hash join.  The right side is materialized into one batch,
+    then each left batch probes it to compute the (left, right) row 
+    positions of the join results.
+    """
+    right = ColumnBatch.concat(self.r.schema, self.r.iter_batches(batch_size))
+    if not right.n:
+      return
+    rkeys = self.batch_keys(right, self.right_attrs)
+    sorted_index = None
+    dict_index = None
+
+    for lbatch in self.l.iter_batches(batch_size):
+      lkeys = self.batch_keys(lbatch, self.left_attrs)
+      if (isinstance(rkeys, list) or rkeys.dtype == np.object_ or 
+          lkeys.dtype == np.object_):
+        if dict_index is None:
+          dict_index = self.build_batch_dict_index(rkeys)
+        lpos, rpos = self.probe_batch_dict_index(dict_index, lkeys)
+      else:
+        if sorted_index is None:
+          order = np.argsort(rkeys, kind="mergesort")
+          sorted_index = (order, rkeys[order])
+        lpos, rpos = self.probe_batch_sorted_index(sorted_index, lkeys)
+
+      if not len(lpos):
+        continue
+      cols = [col[lpos] for col in lbatch.cols]
+      cols.extend([col[rpos] for col in right.cols])
+      batch = self.filter_batch(ColumnBatch(self.schema, cols, len(lpos)))
+      if batch.n:
+        yield batch
+
+  def batch_keys(self, batch, attrs):
+    """
+    @return array of the join attribute's values in @batch, or for joins 
+            on several attributes, the list of tuples of their values
+    """
+    if len(attrs) == 1:
+      return batch.cols[attrs[0].idx]
+    return zip(*[batch.cols[attr.idx].tolist() for attr in attrs])
+
+  def build_batch_dict_index(self, keys):
+    """
+    @keys array or list of join keys
+    @return dict that maps a key to the positions of the rows that contain it
+    """
+    if isinstance(keys, np.ndarray):
+      keys = keys.tolist()
+    index = defaultdict(list)
+    for pos, key in enumerate(keys):
+      index[key].append(pos)
     return index
 
+  def probe_batch_dict_index(self, index, keys):
+    if isinstance(keys, np.ndarray):
+      keys = keys.tolist()
+    lpos, rpos = [], []
+    for pos, key in enumerate(keys):
+      matches = index.get(key)
+      if matches:
+        lpos.extend([pos] * len(matches))
+        rpos.extend(matches)
+    return np.array(lpos, dtype=np.int64), np.array(rpos, dtype=np.int64)
+
+  def probe_batch_sorted_index(self, index, keys):
+    """
+    @index (order, sorted_keys), where order sorts the build side's keys.
+           The rows that match a probe key are a contiguous range of order.
+    @keys  array of probe keys
+    @return (probe positions, build positions) of every matching pair
+    """
+    order, sorted_keys = index
+    lo = np.searchsorted(sorted_keys, keys, "left")
+    hi = np.searchsorted(sorted_keys, keys, "right")
+    counts = hi - lo
+    if keys.dtype.kind == "f":
+      # NaN is sorted after every number, but matches nothing
+      counts[np.isnan(keys)] = 0
+    lpos = np.repeat(np.arange(len(keys)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rpos = order[np.repeat(lo, counts) + offsets]
+    return lpos, rpos
+
   def produce(self, ctx):
     """
-    Produce's job is to 
+    Like the iterator version, the hash table is built over the right (inner) 
+    subplan and probed by the left (outer) subplan.  Produce's job is to 
     1. allocate variable names and create hash table
-    2. create hash table
-    2. call left's produce to populate hash table
-    3. call right's produce to probe hash table 
+    2. call right's produce to populate hash table
+    3. call left's produce to probe hash table 
+
+    The probe rows of spilled partitions are joined after the left subplan
+    is exhausted, but the parent's code can only be emitted once.  So the
+    left subplan runs in a generator that probes the table and yields the
+    left rows that have matches, and the parent's code runs in a loop over
+    them followed by HybridHashTable.spilled_matches().
     """
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    self.v_ht = ctx.new_var("hj_ht")
+    ctx.add_line("%s = HybridHashTable(%d)" % (self.v_ht, self.max_rows))
+
+    ctx.request_vars(dict(row=None))
+    self.r.produce(ctx)
+
+    self.v_index = ctx.new_var("hj_index")
+    self.v_spilled = ctx.new_var("hj_spilled")
+    ctx.add_line("%s = %s.index" % (self.v_index, self.v_ht))
+    ctx.add_line("%s = %s.spilled" % (self.v_spilled, self.v_ht))
+    v_left = ctx.new_var("hj_left")
+    with ctx.compiler.indent("def %s():" % v_left):
+      ctx.request_vars(dict(row=None))
+      self.l.produce(ctx)
+
+    v_matches = ctx.new_var("hj_matches")
+    self.v_lrow = ctx.new_row_vars(self.l.schema, "hjl")
+    loop = "for %s, %s in chain(%s(), %s.spilled_matches()):" % (
+        self.v_lrow.target(), v_matches, v_left, self.v_ht)
+    with ctx.compiler.indent(loop):
+      v_match = ctx.new_row_vars(self.r.schema, "hj")
+      with ctx.compiler.indent("for %s in %s:" % (v_match.target(), v_matches)):
+        self.consume_joined(ctx, self.v_lrow + v_match)
 
   def consume(self, ctx):
     """
-    Consume will be called twice, once by the left child's
-    consume phase, and once by the right childe's consume phase.
+    Consume will be called twice, first by the right child's
+    consume phase, and then by the left child's consume phase.
 
     Need to internally keep track of which time it is being called
     """
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    if self.state == 0:
+      self.state = 1
+      self.consume_right(ctx)
+    else:
+      self.consume_left(ctx)
+      self.state = 0
 
-  def consume_left(self, ctx):
+  def consume_right(self, ctx):
     """
-    Given variable name for left row, compute left key to populate hash table
+    Given variable name for right row, compute right key to populate hash table
     """
-    # TODO: IMPLEMENT THIS
-    pass
+    self.v_rrow = ctx['row']
+    ctx.pop_vars()
 
-  def consume_right(self, ctx):
+    self.v_rrow = ctx.row_vars(self.v_rrow, self.r.schema)
+    self.v_rkey = self.compile_key(ctx, self.v_rrow, self.right_attrs)
+    ctx.add_line("%s.add(%s, %s)" % (
+      self.v_ht, self.v_rkey, self.v_rrow.tuple()))
+
+  def compile_key(self, ctx, v_row, attrs):
+    """
+    Emits code that computes a row's join key
+    @return expression of the join key: the attribute's variable, or the 
+            tuple of the attributes' variables
+    """
+    ctx.add_io_vars(v_row, None)
+    v_attrs = self.compile_exprs(ctx, attrs)
+    if len(v_attrs) == 1:
+      return v_attrs[0]
+    return "(%s)" % ", ".join(v_attrs)
+
+  def consume_left(self, ctx):
     """
-    Given variable name for right row, 
-    1. compute right key, 
+    Given variable name for left row, 
+    1. compute left key, 
     2. probe hash table, 
-    3. create intermediate row to pass to parent's consume
+    3. yield the left row and its matches from the left subplan's 
+       generator to the loop that produce() emits
+    """
+    v_lrow = ctx.row_vars(ctx['row'], self.l.schema)
+    ctx.pop_vars()
+
+    self.v_lkey = ctx.new_var("hj_lkey")
+    ctx.add_line("%s = %s" % (self.v_lkey, self.compile_key(ctx, v_lrow, self.left_attrs)))
+
+    v_matches = ctx.new_var("hj_matches")
+    with ctx.compiler.indent("if %s:" % self.v_spilled):
+      ctx.add_line("%s = %s.lookup(%s, %s)" % (
+        v_matches, self.v_ht, self.v_lkey, v_lrow.tuple()))
+    with ctx.compiler.indent("else:"):
+      # use get() so that probes that miss don't insert into the hash table
+      ctx.add_line("%s = %s.get(%s)" % (v_matches, self.v_index, self.v_lkey))
+    with ctx.compiler.indent("if %s:" % v_matches):
+      ctx.add_line("yield %s, %s" % (v_lrow.tuple(), v_matches))
+
+
+class MergeCursor(object):
+  """
+  Right input of a sort-merge join: rows sorted on their join attribute,
+  and the range of them that matches the current left row.  Left rows are
+  looked up in ascending order of their join keys, so the range only moves
+  forward, and each right row is compared with O(1) left keys in addition
+  to the left rows it matches.
+
+  Equi-joins match the right rows whose key equals the left row's key, 
+  and band joins the right rows whose key is in [key + lo, key + hi].  
+  NaN keys match nothing, and NULL keys match nothing in band joins.
+  """
+  def __init__(self, rows, idx, band=None):
+    """
+    @rows rows sorted on the join attribute, without NaN join keys
+    @idx  index of the join attribute in the rows
+    @band (lo, hi) bounds of a band join, or None for an equi-join
     """
-    # TODO: IMPLEMENT THIS
-    pass
+    self.rows = rows
+    self.idx = idx
+    self.band = band
+    self.start = 0
+    self.end = 0
+    self.key = None
+    self.matches = None
+
+  def __call__(self, key):
+    """
+    @key join key of the left row, which is not smaller than the keys of 
+         the previous calls
+    @return list of the right rows that match @key
+    """
+    if self.matches is not None and key == self.key:
+      return self.matches
+    if key != key:
+      return []
+    if self.band is None:
+      lower = upper = key
+    elif key is None:
+      return []
+    else:
+      lower, upper = key + self.band[0], key + self.band[1]
+
+    rows, idx, n = self.rows, self.idx, len(self.rows)
+    start = self.start
+    while start < n and rows[start][idx] < lower:
+      start += 1
+    end = max(start, self.end)
+    while end < n and rows[end][idx] <= upper:
+      end += 1
+    self.start, self.end = start, end
+    self.key, self.matches = key, rows[start:end]
+    return self.matches
+
+
+class SortMergeJoin(Join):
+  """
+  Sort-merge join.  The right input is materialized and sorted on its join
+  attribute, and the left rows are looked up in ascending order of their
+  join attribute with a MergeCursor.  An input that is already in order,
+  such as a Scan of a table that is sorted on the join attribute (see 
+  AttrStats.is_sorted), is not sorted again, and a left input in order is
+  streamed rather than materialized.
+
+  Equi-joins match rows whose join attributes are equal.  Band joins match
+  rows whose right attribute is within [left + lo, left + hi], e.g.,
+
+    a.t BETWEEN b.t - 5 AND b.t + 5
+
+  where b is the left and a the right input, and (lo, hi) = (-5, 5).  The
+  output is in ascending order of the left join attribute.
+  """
+  def __init__(self, l, r, join_attrs, cond=None, band=None, 
+               lsorted=False, rsorted=False):
+    """
+    @l          left subplan of the join
+    @r          right subplan of the join
+    @join_attrs [left attribute, right attribute] to join on
+    @cond       optional residual condition that is evaluated over the
+                concatenated left and right rows of each matching pair
+    @band       (lo, hi) constant bounds of a band join, or None for an
+                equi-join
+    @lsorted    whether the left input is in ascending order of its join
+                attribute
+    @rsorted    same for the right input
+    """
+    super(SortMergeJoin, self).__init__(l, r)
+    self.join_attrs = join_attrs
+    self.cond = cond
+    self.band = band
+    self.lsorted = lsorted
+    self.rsorted = rsorted
+
+    self.state = 0
+    self.v_lrows = None # sorted left rows
+    self.v_rrows = None # sorted right rows
+    # the compiled merge inlines MergeCursor: the range of the right rows
+    # that match the last left key, and that key's matching rows
+    self.v_nrrows = None
+    self.v_start = None
+    self.v_end = None
+    self.v_key = None
+    self.v_run = None
+
+  def __iter__(self):
+    irow = ListTuple(self.schema)
+    cond = self.cond and self.cond.as_func()
+    lidx = self.join_attrs[0].idx
+    ridx = self.join_attrs[1].idx
+    nlattrs = len(self.l.schema.attrs)
+
+    # NaN keys match nothing, and would break the sort order
+    rrows = [tuple(row.row) for row in self.r if row.row[ridx] == row.row[ridx]]
+    if not self.rsorted:
+      rrows.sort(key=itemgetter(ridx))
+    matches = MergeCursor(rrows, ridx, self.band)
+
+    if self.lsorted:
+      lrows = (row.row for row in self.l)
+    else:
+      lrows = [tuple(row.row) for row in self.l if row.row[lidx] == row.row[lidx]]
+      lrows.sort(key=itemgetter(lidx))
+
+    for lrow in lrows:
+      rrun = matches(lrow[lidx])
+      if not rrun:
+        continue
+      irow.row[:nlattrs] = lrow
+      for rrow in rrun:
+        irow.row[nlattrs:] = rrow
+        if cond is None or cond(irow):
+          yield irow
+
+  def produce(self, ctx):
+    """
+    Materialize the right subplan and sort it, then look up the left 
+    subplan's rows, which are materialized and sorted first unless they 
+    are already in order.
+    """
+    lidx = self.join_attrs[0].idx
+    ridx = self.join_attrs[1].idx
+    self.v_rrows = ctx.new_var("smj_rrows")
+    self.v_nrrows = ctx.new_var("smj_nrrows")
+    self.v_start = ctx.new_var("smj_start")
+    self.v_end = ctx.new_var("smj_end")
+    self.v_key = ctx.new_var("smj_key")
+    self.v_run = ctx.new_var("smj_run")
+    ctx.add_line("%s = []" % self.v_rrows)
+    ctx.request_vars(dict(row=None))
+    self.r.produce(ctx)
+
+    ctx.add_line("# %s" % self)
+    if not self.rsorted:
+      ctx.add_line("%s.sort(key=itemgetter(%d))" % (self.v_rrows, ridx))
+    ctx.add_lines([
+      "%s = len(%s)" % (self.v_nrrows, self.v_rrows),
+      "%s = %s = 0" % (self.v_start, self.v_end),
+      "%s = %s = None" % (self.v_key, self.v_run)
+    ])
+
+    if self.lsorted:
+      # the left rows are looked up as the left subplan produces them
+      ctx.request_vars(dict(row=None))
+      self.l.produce(ctx)
+      return
+
+    self.v_lrows = ctx.new_var("smj_lrows")
+    ctx.add_line("%s = []" % self.v_lrows)
+    ctx.request_vars(dict(row=None))
+    self.l.produce(ctx)
+
+    v_lrow = ctx.new_row_vars(self.l.schema, "smj")
+    ctx.add_line("%s.sort(key=itemgetter(%d))" % (self.v_lrows, lidx))
+    with ctx.compiler.indent("for %s in %s:" % (v_lrow.target(), self.v_lrows)):
+      self.consume_matches(ctx, v_lrow)
+
+  def consume(self, ctx):
+    """
+    Called first by the right child's consume phase, which appends the 
+    input row to the right rows, and then by the left child's, which
+    appends it to the left rows, or looks it up if the left input is in
+    order.  Rows with NaN join keys match nothing, and are not kept.
+    """
+    if self.state == 0:
+      self.state = 1
+      v_rows, child, idx = self.v_rrows, self.r, self.join_attrs[1].idx
+    else:
+      self.state = 0
+      v_rows, child, idx = self.v_lrows, self.l, self.join_attrs[0].idx
+    v_in = ctx.row_vars(ctx['row'], child.schema)
+    ctx.pop_vars()
+
+    if child is self.l and self.lsorted:
+      self.consume_matches(ctx, v_in)
+      return
+    with ctx.compiler.indent("if %s == %s:" % (v_in[idx], v_in[idx])):
+      ctx.add_line("%s.append(%s)" % (v_rows, v_in.tuple()))
+
+  def __str__(self):
+    lattr, rattr = self.join_attrs
+    if self.band is None:
+      on = "%s = %s" % (lattr, rattr)
+    else:
+      on = "%s BETWEEN %s + %r AND %s + %r" % (
+          rattr, lattr, self.band[0], lattr, self.band[1])
+    # the sort flags change the generated code, so they are part of the
+    # plan's string and its CodeCache fingerprint
+    return "SORTMERGEJOIN(ON %s, COND %s, LSORTED %s, RSORTED %s)" % (
+        on, self.cond, self.lsorted, self.rsorted)
+
+  def consume_matches(self, ctx, v_lrow):
+    """
+    Emits the code that finds the right rows that match the left row
+    @v_lrow, as MergeCursor does, and loops over them
+    """
+    ridx = self.join_attrs[1].idx
+    v_lkey = v_lrow[self.join_attrs[0].idx]
+    v_rows, v_start, v_end = self.v_rrows, self.v_start, self.v_end
+    v_lower = ctx.new_var("smj_lower")
+    v_upper = ctx.new_var("smj_upper")
+    v_rrow = ctx.new_row_vars(self.r.schema, "smj")
+
+    # the matches are only looked up again if the key changes
+    with ctx.compiler.indent("if %s != %s or %s is None:" % (
+        v_lkey, self.v_key, self.v_run)):
+      ctx.add_line("%s = %s" % (self.v_key, v_lkey))
+      if self.band is None:
+        nomatch = "%s != %s" % (v_lkey, v_lkey)
+      else:
+        nomatch = "%s != %s or %s is None" % (v_lkey, v_lkey, v_lkey)
+      with ctx.compiler.indent("if %s:" % nomatch):
+        ctx.add_line("%s = ()" % self.v_run)
+      with ctx.compiler.indent("else:"):
+        if self.band is None:
+          ctx.add_line("%s = %s = %s" % (v_lower, v_upper, v_lkey))
+        else:
+          ctx.add_lines([
+            "%s = %s + %r" % (v_lower, v_lkey, self.band[0]),
+            "%s = %s + %r" % (v_upper, v_lkey, self.band[1])
+          ])
+        ctx.add_lines([
+          "while %s < %s and %s[%s][%d] < %s: %s += 1" % (
+            v_start, self.v_nrrows, v_rows, v_start, ridx, v_lower, v_start),
+          "%s = max(%s, %s)" % (v_end, v_start, v_end),
+          "while %s < %s and %s[%s][%d] <= %s: %s += 1" % (
+            v_end, self.v_nrrows, v_rows, v_end, ridx, v_upper, v_end),
+          "%s = %s[%s:%s]" % (self.v_run, v_rows, v_start, v_end)
+        ])
+
+    with ctx.compiler.indent("for %s in %s:" % (v_rrow.target(), self.v_run)):
+      self.consume_joined(ctx, v_lrow + v_rrow)
 
 
 ########################################################
@@ -380,6 +945,10 @@ class GroupBy(UnaryOp):
     #
     self.group_attrs = []
 
+    # (AggUDF, argument expressions) of each aggregate function computed by 
+    # the operators above the GroupBy.  See self.collect_aggs()
+    self.aggs = []
+
     # Compiler variables
     self.v_ht = None       # hash table
     self.v_bucket = None   # value (bucket) in v_ht
@@ -387,8 +956,9 @@ class GroupBy(UnaryOp):
     self.v_key = None      # a group's key
     self.v_attrvals = None # holds values of Attrs referenced in # grouping expression.
                            # See self.group_attrs
-    self.v_irow = None     # intermediate row
+    self.v_irow = None     # RowVars of the intermediate row
     self.v_in = None       # input row from child subplan
+    self.v_udfs = []       # AggUDF of each aggregate in self.aggs
 
 
   def init_schema(self):
@@ -415,8 +985,16 @@ class GroupBy(UnaryOp):
         (a, b, __key__, __group__)
 
     The values of a, b can be set to those of the LAST tuple added to the group.
+
+    GroupBy also computes the aggregate functions that its parents evaluate 
+    over the groups, so that it doesn't need to keep each group's rows in 
+    __group__.  One attribute per aggregate (AggFunc.agg_attr) is appended 
+    after __group__, whose value is always None:
+
+        (a, b, __key__, __group__, __agg0__)
     """
     self.group_attrs = []
+    self.aggs = []
     self.schema = Schema([])
     seen = set()
 
@@ -437,8 +1015,52 @@ class GroupBy(UnaryOp):
     child_schema = self.c.schema.copy()
     self.schema.attrs.append(Attr("__key__", "str"))
     self.schema.attrs.append(Attr("__group__", group_schema=child_schema))
+    anames = {}
+    for agg in self.collect_aggs():
+      # identical aggregates, e.g., in the SELECT and HAVING clauses, 
+      # share the same attribute
+      keys = tuple(arg.cse_key() for arg in agg.args)
+      key = (agg.name, keys) if None not in keys else agg.agg_attr.id
+      if key in anames:
+        agg.agg_attr.aname = anames[key]
+        continue
+
+      # name the aggregates by position, so that the schema (and the code
+      # generated for it) is the same every time the query is planned
+      agg.agg_attr.aname = anames[key] = "__agg%d__" % len(self.aggs)
+      self.aggs.append((agg.f, agg.args))
+      self.schema.attrs.append(agg.agg_attr.copy())
     return self.schema
 
+  def agg_exprs(self):
+    """
+    @return list of the expressions that are evaluated over each input row: 
+            the group attributes, the group expressions, and then the 
+            aggregates' arguments
+    """
+    args = [arg for udf, args in self.aggs for arg in args]
+    return self.group_attrs + self.group_exprs + args
+
+  def collect_aggs(self):
+    """
+    @return the AggFunc expressions in the operators above the GroupBy 
+            (e.g., the HAVING Filter) up to and including the first Project
+    """
+    aggs = []
+    p = self.p
+    while p is not None and p.is_type(UnaryOp):
+      if p.is_type(Project):
+        for expr in p.exprs:
+          aggs.extend(expr.collect(AggFunc))
+        break
+      if p.is_type(Filter):
+        aggs.extend(p.cond.collect(AggFunc))
+      elif p.is_type([OrderBy, TopK]):
+        for expr in p.order_exprs:
+          aggs.extend(expr.collect(AggFunc))
+      p = p.p
+    return aggs
+
   def __iter__(self):
     """
     GroupBy works as follows:
@@ -446,31 +1068,117 @@ class GroupBy(UnaryOp):
     * Contruct and populate hash table 
       * key is defined by the group_exprs expressions  
       * Track the values of the attributes referenced in the grouping expressions
-      * Track the tuples in each bucket
+      * Track each aggregate's running state in each bucket
     * Iterate through each bucket, compose and populate a tuple that conforms to 
       this operator's output schema (see self.init_schema)
     """
 
-    hashtable = defaultdict(lambda: [None, None, []])
+    hashtable = {}
+    udfs = [udf for udf, args in self.aggs]
 
     # This initializes the intermediate row that you will populate and pass 
     # to parent operators
     irow = ListTuple(self.schema, [])
 
-
+    # all of the expressions are computed by one function, so that 
+    # common subexpressions (e.g., of the key and the arguments) are 
+    # computed once per row
+    f = self.exprs_func(self.agg_exprs())
+    nattrs = len(self.group_attrs)
+    nkeys = len(self.group_exprs)
+    aggs = []
+    start = nattrs + nkeys
+    for i, (udf, args) in enumerate(self.aggs):
+      aggs.append((i, udf, start, start + len(args)))
+      start += len(args)
+
+    # groups are keyed on their values rather than their hashes, whose
+    # collisions would merge groups.  Keys are only checked for NaNs when
+    # they are not found.  Buckets keep the hash for the __key__ attribute
     for row in self.c:
-      attrvals = [attr(row) for attr in self.group_attrs]
-      key = hash(tuple([e(row) for e in self.group_exprs]))
-      hashtable[key][0] = key
-      hashtable[key][1] = attrvals
-      hashtable[key][2].append(row.copy())
-
-    for _, (key, attrvals, group) in hashtable.items():
-      irow.row[:len(attrvals)] = attrvals
-      irow.row[-2] = key
-      irow.row[-1] = group
+      vals = f(row)
+      key = tuple(vals[nattrs:nattrs+nkeys])
+      bucket = hashtable.get(key)
+      if bucket is None:
+        key = group_key(key)
+        bucket = hashtable.get(key)
+        if bucket is None:
+          bucket = hashtable[key] = [hash(key), None, [udf.init_state() for udf in udfs]]
+      bucket[1] = vals[:nattrs]
+      states = bucket[2]
+      for i, udf, start, stop in aggs:
+        states[i] = udf.update_state(states[i], *vals[start:stop])
+
+    nattrs = len(self.group_attrs)
+    for keyhash, attrvals, states in hashtable.itervalues():
+      irow.row[:nattrs] = attrvals
+      irow.row[nattrs] = keyhash
+      irow.row[nattrs+1] = None
+      irow.row[nattrs+2:] = [udf.finalize_state(state) 
+                             for udf, state in zip(udfs, states)]
       yield irow
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    """
+    Vectorized GroupBy computes partial aggregates for each input batch, and
+    merges them into a hash table of running states.  Within a batch, the
+    argument columns are sorted by group id so that each group's values are
+    contiguous.
+    """
+    udfs = [udf for udf, args in self.aggs]
+    hashtable = {}
+    for batch in self.c.iter_batches(batch_size):
+      if not batch.n:
+        continue
+      for key, attrvals, states in self.partial_aggregate(batch):
+        bucket = hashtable.get(key)
+        if bucket is None:
+          # keys are only checked for NaNs when they are not found
+          key = group_key(key)
+          bucket = hashtable.get(key)
+        if bucket is None:
+          hashtable[key] = [hash(key), attrvals, states]
+          continue
+        bucket[1] = attrvals
+        bucket[2] = [udf.merge_state(s1, s2) 
+                     for udf, s1, s2 in zip(udfs, bucket[2], states)]
+
+    buckets = hashtable.values()
+    for start in xrange(0, len(buckets), batch_size):
+      rows = []
+      for keyhash, attrvals, states in buckets[start:start+batch_size]:
+        finals = [udf.finalize_state(state) for udf, state in zip(udfs, states)]
+        rows.append(attrvals + [keyhash, None] + finals)
+      yield ColumnBatch.from_rows(self.schema, rows)
+
+  def partial_aggregate(self, batch):
+    """
+    @batch ColumnBatch from the child operator
+    @return list of (key, attrvals, agg states) for each group in batch,
+            where key is the tuple of the group's values
+    """
+    keycols = [as_column(e.eval_batch(batch), batch.n) for e in self.group_exprs]
+    gids, ngroups = group_ids(keycols)
+    counts = np.bincount(gids, minlength=ngroups)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # attribute values are taken from the last row added to each group
+    last = np.empty(ngroups, dtype=np.int64)
+    last[gids] = np.arange(batch.n)
+    attrcols = [as_column(attr.eval_batch(batch), batch.n)[last].tolist()
+                for attr in self.group_attrs]
+    attrvals = [list(vals) for vals in zip(*attrcols)] or [[]] * ngroups
+    keys = zip(*[col[last].tolist() for col in keycols])
+
+    order = np.argsort(gids, kind="mergesort")
+    aggstates = []
+    for udf, args in self.aggs:
+      argcols = [as_column(arg.eval_batch(batch), batch.n)[order] for arg in args]
+      aggstates.append(udf.group_states(starts, ends, *argcols))
+    states = [list(s) for s in zip(*aggstates)] or [[]] * ngroups
+    return zip(keys, attrvals, states)
+
   def produce(self, ctx):
     """
     Produce sets up the variables and hash table so that they can be populated by
@@ -479,17 +1187,77 @@ class GroupBy(UnaryOp):
     Once the hash table is populated, it should then loop through the hash table
     and emit output records that adhere to the output schema
     """
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    self.v_ht = ctx.new_var("gb_ht")
+    ctx.add_line("%s = {}" % self.v_ht)
+    self.v_udfs = []
+    for udf, args in self.aggs:
+      v_udf = ctx.new_var("gb_udf")
+      ctx.add_line("%s = UDFRegistry.registry()['%s']" % (v_udf, udf.name))
+      self.v_udfs.append(v_udf)
+
+    ctx.request_vars(dict(row=None))
+    self.c.produce(ctx)
+
+    # each bucket is [hash of the key, attrvals, agg states].  See self.consume()
+    # Unpack it directly into the output row's variables
+    nattrs = len(self.group_attrs)
+    self.v_irow = ctx.new_row_vars(self.schema, "gb")
+    self.v_irow.vars[nattrs + 1] = "None"
+    v_attrvals = RowVars(self.v_irow[:nattrs])
+    v_states = ctx.new_var("gb_states")
+    loop = "for %s, %s, %s in %s.itervalues():" % (
+        self.v_irow[nattrs], v_attrvals.target(), v_states, self.v_ht)
+    with ctx.compiler.indent(loop):
+      for i, v_udf in enumerate(self.v_udfs):
+        ctx.add_line("%s = %s.finalize_state(%s[%d])" % (
+          self.v_irow[nattrs + 2 + i], v_udf, v_states, i))
+      ctx['row'] = self.v_irow
+      self.consume_parent(ctx)
 
   def consume(self, ctx):
     """
     Emits code that takes as input the child operator's row and adds it to the hash table.
     Note that this should NOT call the parent's consume, since this doesn't actually
     compute output records.
+
+    The hash table is populated in a single pass: a bucket is looked up once
+    per row, and only created the first time its key is seen.  The group 
+    attributes, keys and aggregate arguments are compiled together, so that
+    their common subexpressions are computed once.
     """
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    self.v_in = ctx['row']
+    ctx.pop_vars()
+
+    ctx.add_line("# GroupBy: %s" % ", ".join(map(str, self.group_exprs)))
+    ctx.add_io_vars(self.v_in, None)
+    v_vals = self.compile_exprs(ctx, self.agg_exprs())
+    nattrs = len(self.group_attrs)
+    nkeys = len(self.group_exprs)
+    self.v_attrvals = v_vals[:nattrs]
+    v_keyvals = v_vals[nattrs:nattrs+nkeys]
+    v_args = v_vals[nattrs+nkeys:]
+
+    self.v_key = ctx.new_var("gb_key")
+    self.v_bucket = ctx.new_var("gb_bucket")
+    # groups are keyed on their values, as in __iter__
+    ctx.add_line("%s = (%s,)" % (self.v_key, ", ".join(v_keyvals)))
+    ctx.add_line("%s = %s.get(%s)" % (self.v_bucket, self.v_ht, self.v_key))
+    inits = ["%s.init_state()" % v_udf for v_udf in self.v_udfs]
+    with ctx.compiler.indent("if %s is None:" % self.v_bucket):
+      ctx.add_line("%s = group_key(%s)" % (self.v_key, self.v_key))
+      ctx.add_line("%s = %s.get(%s)" % (self.v_bucket, self.v_ht, self.v_key))
+      with ctx.compiler.indent("if %s is None:" % self.v_bucket):
+        ctx.add_line("%s = %s[%s] = [hash(%s), None, [%s]]" % (
+          self.v_bucket, self.v_ht, self.v_key, self.v_key, ", ".join(inits)))
+    ctx.add_line("%s[1] = [%s]" % (self.v_bucket, ", ".join(self.v_attrvals)))
+
+    # fold the row into each aggregate's state
+    v_states = ctx.new_var("gb_states")
+    ctx.add_line("%s = %s[2]" % (v_states, self.v_bucket))
+    for i, (v_udf, (udf, args)) in enumerate(zip(self.v_udfs, self.aggs)):
+      v_agg_args, v_args = v_args[:len(args)], v_args[len(args):]
+      ctx.add_line("%s[%d] = %s.update_state(%s)" % (
+        v_states, i, v_udf, ", ".join(["%s[%d]" % (v_states, i)] + v_agg_args)))
 
   def __str__(self):
     s = "GROUPBY(%s)" % ", ".join(map(str, self.group_exprs))
@@ -598,16 +1366,23 @@ class Project(UnaryOp):
     if self.c == None:
       child_iter = [dict()]
 
+    f = self.exprs_func(self.exprs)
     for row in child_iter:
-      for i, (exp) in enumerate(self.exprs):
-        irow.row[i] = exp(row)
+      irow.row = f(row)
       yield irow
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    if self.c == None:
+      batches = [ColumnBatch(Schema([]), [], 1)]
+    else:
+      batches = self.c.iter_batches(batch_size)
+
+    for batch in batches:
+      cols = [as_column(e.eval_batch(batch), batch.n) for e in self.exprs]
+      yield ColumnBatch(self.schema, cols, batch.n)
+
   def produce(self, ctx):
     """
-    Setup output tuple variable and generate code to initialize it 
-    as an empty tuple with the correct schema..  
-
     There is a special case when if there is no child operator, such as
     
             SELECT 1
@@ -615,13 +1390,8 @@ class Project(UnaryOp):
     where produce should pretend it is an access method that emits a 
     single empty tuple to its own consume method.
     """
-    schema_str = self.schema.compile_constructor()
-    self.v_out = ctx.new_var("proj_row")
-    line = "%s = ListTuple(%s)" % (self.v_out, schema_str)
-    ctx.add_line(line)
-
     if self.c == None:
-      ctx.request_vars(dict(row=self.v_out))
+      ctx.request_vars(dict(row=RowVars([])))
       self.consume(ctx)
       return
 
@@ -629,15 +1399,15 @@ class Project(UnaryOp):
     self.c.produce(ctx)
 
   def consume(self, ctx):
+    """
+    The output row is the variables that hold the expressions' results
+    """
     self.v_in = ctx['row']
     ctx.pop_vars()
 
     ctx.add_io_vars(self.v_in, None)
     v_exprs = self.compile_exprs(ctx, self.exprs)
-
-    line = "%s.row[:] = [%s]" % (self.v_out, ", ".join(v_exprs))
-    ctx.add_line(line)
-    ctx['row'] = self.v_out
+    ctx['row'] = RowVars(v_exprs)
     self.consume_parent(ctx)
 
   def __str__(self):
@@ -655,6 +1425,25 @@ class Project(UnaryOp):
 ########################################################
 
 
+def sort_key_columns(batch, order_exprs, ascdescs):
+  """
+  @return list of numeric key columns, one per order expression, whose
+          ascending order is the order that the expressions specify.
+          Non-numeric keys are replaced by their rank, and descending keys 
+          are negated.
+  """
+  keys = []
+  for expr, ascdesc in zip(order_exprs, ascdescs):
+    col = as_column(expr.eval_batch(batch), batch.n)
+    if col.dtype.kind not in "biuf":
+      col = np.unique(col, return_inverse=True)[1]
+    elif col.dtype.kind == "b":
+      col = col.astype(np.int64)
+    if ascdesc == "desc":
+      col = -col
+    keys.append(col)
+  return keys
+
 class OrderBy(UnaryOp):
   """
   XXX:  There is a slight bug with this implementation, which is that
@@ -663,16 +1452,23 @@ class OrderBy(UnaryOp):
         by the Project operator.  Thus the following will result in an error:
 
           SELECT a+b FROM data ORDER BY a
+
+  Inputs with more than max_rows rows are sorted with an external merge
+  sort (see spill.ExternalSort).
   """
+  MAX_ROWS = 1000000
 
-  def __init__(self, c, order_exprs, ascdescs="asc"):
+  def __init__(self, c, order_exprs, ascdescs="asc", max_rows=None):
     """
     @c            child operator
     @order_exprs  ordered list of Expression objects
+    @max_rows     maximum number of rows to keep in memory.  
+                  Defaults to MAX_ROWS
     """
     super(OrderBy, self).__init__(c)
     self.order_exprs = order_exprs
     self.ascdescs = ascdescs
+    self.max_rows = max_rows or self.MAX_ROWS
     self.normalize_ascdescs()
 
   def normalize_ascdescs(self):
@@ -694,56 +1490,78 @@ class OrderBy(UnaryOp):
     operator's outputs before sorting by the order expressions.
 
     Note: each row from the child operator may be the _same_ ListTuple
+
+    The sort keys are computed once per row, and sorted natively by 
+    sort_order().  Only the rows' values are materialized, and they are 
+    output through a single intermediate tuple.
     """
-    order = [1 if x == "asc" else -1 for x in self.ascdescs]
+    f = self.exprs_func(self.order_exprs)
+    sorter = ExternalSort(self.ascdescs, self.max_rows)
+    keys, rows = sorter.keys, sorter.rows
+    for row in self.c:
+      keys.append(tuple(f(row)))
+      rows.append(tuple(row.row))
+      if len(rows) > self.max_rows:
+        sorter.spill()
+
+    irow = ListTuple(self.c.schema, [])
+    for row in sorter:
+      irow.row = list(row)
+      yield irow
 
-    def keyf(row):
-      vals = tuple(expr(row) for expr in self.order_exprs)
-      return OBTuple(vals, order)
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    """
+    Vectorized OrderBy sorts its materialized input with np.lexsort.
+    See sort_key_columns()
+    """
+    batch = ColumnBatch.concat(self.c.schema, self.c.iter_batches(batch_size))
+    if not batch.n:
+      return
 
-    rows = [row.copy() for row in self.c]
-    rows.sort(key=keyf)
-    for row in rows:
-      yield row
+    keys = sort_key_columns(batch, self.order_exprs, self.ascdescs)
+    # lexsort is stable and uses the last key as the primary key
+    batch = batch.take(np.lexsort(keys[::-1]))
+    batch.schema = self.schema
+    for start in xrange(0, batch.n, batch_size):
+      yield batch.slice(start, start + batch_size)
 
   def produce(self, ctx):
+    self.v_sorter = ctx.new_var("ord_sorter")
+    self.v_keys = ctx.new_var("ord_keys")
     self.v_rows = ctx.new_var("ord_rows")
-    self.v_keyf = ctx.new_var("ord_keyf")
-    self.v_irow = ctx.new_var("ord_irow")
-    self.v_schema = ctx.new_var("ord_schema")
-    self.v_ordersort = ctx.new_var("ordersort")
     ctx.request_vars(dict(row=None))
 
-    asc_args = ", ".join(["%s" % '1' if (e == "asc") else '-1' for (e) in self.ascdescs])
-    schema_str = self.schema.compile_constructor()
-    ctx.add_line("%s = %s" % (self.v_schema, schema_str))
-    ctx.add_line("%s = []" % self.v_rows)
-    ctx.add_line("%s = [%s]" % (self.v_ordersort, asc_args))
-
-    with ctx.compiler.indent("def %s(row):" % self.v_keyf):
-      ctx.add_io_vars("row", None)
-      v_all = self.compile_exprs(ctx, self.order_exprs)
-      ctx.add_line("return OBTuple((%s,), %s)" % (", ".join(v_all), self.v_ordersort))
+    # the rows are materialized as tuples of values, next to their keys
+    ctx.add_line("%s = ExternalSort(%r, %d)" % (
+      self.v_sorter, list(self.ascdescs), self.max_rows))
+    ctx.add_line("%s = %s.keys" % (self.v_keys, self.v_sorter))
+    ctx.add_line("%s = %s.rows" % (self.v_rows, self.v_sorter))
 
     self.c.produce(ctx)
 
-    ctx.add_line("%s.sort(key=%s)" % (self.v_rows, self.v_keyf))
-
-    cond = "for %s in %s:" % (self.v_irow, self.v_rows)
+    self.v_irow = ctx.new_row_vars(self.schema, "ord")
+    cond = "for %s in %s:" % (self.v_irow.target(), self.v_sorter)
     with ctx.compiler.indent(cond):
       ctx['row'] = self.v_irow
       self.consume_parent(ctx)
 
   def consume(self, ctx):
-    self.v_in = ctx['row']
+    v_in = ctx.row_vars(ctx['row'], self.c.schema)
     ctx.pop_vars()
-    ctx.add_line("%s.append(ListTuple(%s, list(%s.row)))" % (
-      self.v_rows, self.v_schema, self.v_in))
+
+    ctx.add_io_vars(v_in, None)
+    v_all = self.compile_exprs(ctx, self.order_exprs)
+    ctx.add_line("%s.append((%s,))" % (self.v_keys, ", ".join(v_all)))
+    ctx.add_line("%s.append(%s)" % (self.v_rows, v_in.tuple()))
+    with ctx.compiler.indent("if len(%s) > %d:" % (self.v_rows, self.max_rows)):
+      ctx.add_line("%s.spill()" % self.v_sorter)
 
   def __str__(self):
     args = ", ".join(["%s %s" % (e, ad) 
       for (e, ad) in  zip(self.order_exprs, self.ascdescs)])
-    return "ORDERBY(%s)" % args
+    # the memory budget is compiled into the code, so it is part of the
+    # plan's CodeCache fingerprint
+    return "ORDERBY(%s MAX_ROWS %d)" % (args, self.max_rows)
 
 class Filter(UnaryOp):
   def __init__(self, c, cond):
@@ -755,25 +1573,43 @@ class Filter(UnaryOp):
     self.cond = cond
 
   def __iter__(self):
+    cond = self.cond.as_func()
     for row in self.c:
-      if self.cond(row):
+      if cond(row):
         yield row
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    for batch in self.c.iter_batches(batch_size):
+      mask = truthy(self.cond.eval_batch(batch))
+      if not isinstance(mask, np.ndarray):
+        if mask:
+          yield batch
+        continue
+      batch = batch.take(mask)
+      if batch.n:
+        yield batch
+
   def produce(self, ctx):
     self.c.produce(ctx)
 
   def consume(self, ctx):
     v_in = ctx['row']
-    v_cond = ctx.new_var("fil_cond")
 
     ctx.add_line("# if %s" % str(self.cond))
-    ctx.add_io_vars(v_in, v_cond)
-    self.cond.compile(ctx)
+    ctx.add_io_vars(v_in, None)
+    v_cond, = self.compile_exprs(ctx, [self.cond])
 
     cond = "if (%s):" % v_cond
     with ctx.compiler.indent(cond):
       self.consume_parent(ctx)
 
+class LimitReached(Exception):
+  """
+  Raised by compiled Limit operators to exit their child's loops.
+  See Limit.produce()
+  """
+  pass
+
 class Limit(UnaryOp):
   def __init__(self, c, limit, offset=0):
     """
@@ -787,7 +1623,7 @@ class Limit(UnaryOp):
 
     self._limit =  int(self.limit(None))
     if self._limit < 0:
-      raise Exception("LIMIT must not be negative: %d" % l)
+      raise Exception("LIMIT must not be negative: %d" % self._limit)
 
     self.offset = offset or 0
     if isinstance(self.offset, numbers.Number):
@@ -795,7 +1631,7 @@ class Limit(UnaryOp):
 
     self._offset = int(self.offset(None))
     if self._offset < 0:
-      raise Exception("OFFSET must not be negative: %d" % o)
+      raise Exception("OFFSET must not be negative: %d" % self._offset)
 
 
   def __iter__(self):
@@ -812,17 +1648,203 @@ class Limit(UnaryOp):
       nyielded += 1
       yield row
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    skip = self._offset
+    remaining = self._limit
+    if remaining <= 0:
+      return
+
+    for batch in self.c.iter_batches(batch_size):
+      if skip >= batch.n:
+        skip -= batch.n
+        continue
+      batch = batch.slice(skip, skip + remaining)
+      skip = 0
+      remaining -= batch.n
+      yield batch
+      if remaining <= 0:
+        break
+
   def produce(self, ctx):
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    """
+    The child's loops are wrapped in a try block, so that consume can stop
+    all of the enclosing loops by raising an exception as soon as the limit
+    is reached.
+    """
+    self.v_count = ctx.new_var("limit_count")
+    self.v_stop = ctx.new_var("limit_stop")
+    v_err = ctx.new_var("limit_err")
+    ctx.add_line("%s = LimitReached()" % self.v_stop)
+    ctx.add_line("%s = 0" % self.v_count)
+
+    ctx.request_vars(dict(row=None))
+    with ctx.compiler.indent("try:"):
+      self.c.produce(ctx)
+    # only catch this Limit's exception, and not those of other Limits in the plan
+    with ctx.compiler.indent("except LimitReached as %s:" % v_err):
+      with ctx.compiler.indent("if %s is not %s:" % (v_err, self.v_stop)):
+        ctx.add_line("raise")
 
   def consume(self, ctx):
-    # TODO: IMPLEMENT THIS
-    raise Exception("Not implemented")
+    v_in = ctx['row']
+    ctx.pop_vars()
+
+    ctx.add_line("%s += 1" % self.v_count)
+    with ctx.compiler.indent("if %s > %d:" % (self.v_count, self._offset)):
+      if self._limit == 0:
+        ctx.add_line("raise %s" % self.v_stop)
+      ctx['row'] = v_in
+      self.consume_parent(ctx)
+      end = self._offset + self._limit
+      with ctx.compiler.indent("if %s >= %d:" % (self.v_count, end)):
+        ctx.add_line("raise %s" % self.v_stop)
 
   def __str__(self):
     return "LIMIT(%s OFFSET %s)" % (self.limit, self.offset)
 
+class TopK(UnaryOp):
+  """
+  ORDER BY ... LIMIT ... OFFSET.  Rather than sorting all of its child's
+  rows, TopK keeps the first k = limit + offset rows in the sort order.
+  Rows are added to a buffer of max(2k, MIN_BUFFER) rows, and whenever the
+  buffer is full, it is sorted and truncated to its first k rows (see 
+  top_rows()).  That is O(k log k) work per k input rows, so TopK takes 
+  O(n log k) time and O(k) memory.
+  The optimizer replaces Limit operators over OrderBy operators with TopK.
+
+  The kept rows precede the buffer's other rows in the input, so the 
+  stable sorts output rows with equal keys in their input order, as 
+  OrderBy does.
+  """
+  MIN_BUFFER = 1024
+
+  def __init__(self, c, order_exprs, ascdescs, limit, offset=0):
+    """
+    @c            child operator
+    @order_exprs  ordered list of Expression objects
+    @ascdescs     "asc" or "desc" for each order expression
+    @limit        number of tuples to return
+    @offset       number of tuples to skip
+    """
+    super(TopK, self).__init__(c)
+    self.order_exprs = order_exprs
+    self.ascdescs = ascdescs
+    self.limit = limit
+    if isinstance(self.limit, numbers.Number):
+      self.limit = Literal(self.limit)
+    self.offset = offset or 0
+    if isinstance(self.offset, numbers.Number):
+      self.offset = Literal(self.offset)
+
+    self._limit = int(self.limit(None))
+    self._offset = int(self.offset(None))
+    if self._limit < 0:
+      raise Exception("LIMIT must not be negative: %d" % self._limit)
+    if self._offset < 0:
+      raise Exception("OFFSET must not be negative: %d" % self._offset)
+
+  @property
+  def k(self):
+    """
+    number of rows that are kept
+    """
+    if self._limit == 0:
+      return 0
+    return self._limit + self._offset
+
+  @property
+  def buffer_size(self):
+    return max(2 * self.k, self.MIN_BUFFER)
+
+  def __iter__(self):
+    """
+    Note: each row from the child operator may be the _same_ ListTuple
+    """
+    k = self.k
+    if k == 0:
+      return
+    f = self.exprs_func(self.order_exprs)
+
+    keys, rows = [], []
+    for row in self.c:
+      keys.append(tuple(f(row)))
+      rows.append(tuple(row.row))
+      if len(rows) >= self.buffer_size:
+        keys, rows = top_rows(keys, rows, self.ascdescs, k)
+
+    keys, rows = top_rows(keys, rows, self.ascdescs, k)
+    irow = ListTuple(self.c.schema, [])
+    for row in rows[self._offset:]:
+      irow.row = list(row)
+      yield irow
+
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    """
+    Vectorized TopK only sorts the rows whose primary key is not after the
+    k'th smallest primary key, which np.partition finds in linear time.
+    """
+    k = self.k
+    if k == 0:
+      return
+    batch = ColumnBatch.concat(self.c.schema, self.c.iter_batches(batch_size))
+    if not batch.n:
+      return
+
+    keys = sort_key_columns(batch, self.order_exprs, self.ascdescs)
+    if k < batch.n:
+      primary = keys[0]
+      # NaNs are partitioned to the end, and are never greater than the bound
+      bound = np.partition(primary, k - 1)[k - 1]
+      mask = ~(primary > bound)
+      batch = batch.take(mask)
+      keys = [key[mask] for key in keys]
+
+    # lexsort is stable and uses the last key as the primary key
+    batch = batch.take(np.lexsort(keys[::-1])[self._offset:k])
+    batch.schema = self.schema
+    for start in xrange(0, batch.n, batch_size):
+      yield batch.slice(start, start + batch_size)
+
+  def produce(self, ctx):
+    self.v_keys = ctx.new_var("topk_keys")
+    self.v_rows = ctx.new_var("topk_rows")
+    self.v_ascdescs = ctx.new_var("topk_ascdescs")
+    ctx.request_vars(dict(row=None))
+
+    ctx.add_line("%s = []" % self.v_keys)
+    ctx.add_line("%s = []" % self.v_rows)
+    ctx.add_line("%s = %r" % (self.v_ascdescs, list(self.ascdescs)))
+
+    if self.k > 0:
+      self.c.produce(ctx)
+    else:
+      ctx.pop_vars()
+
+    ctx.add_line("%s, %s = top_rows(%s, %s, %s, %d)" % (
+      self.v_keys, self.v_rows, self.v_keys, self.v_rows, self.v_ascdescs, self.k))
+    self.v_irow = ctx.new_row_vars(self.schema, "topk")
+    cond = "for %s in %s[%d:]:" % (self.v_irow.target(), self.v_rows, self._offset)
+    with ctx.compiler.indent(cond):
+      ctx['row'] = self.v_irow
+      self.consume_parent(ctx)
+
+  def consume(self, ctx):
+    v_in = ctx.row_vars(ctx['row'], self.c.schema)
+    ctx.pop_vars()
+
+    ctx.add_io_vars(v_in, None)
+    v_all = self.compile_exprs(ctx, self.order_exprs)
+    ctx.add_line("%s.append((%s,))" % (self.v_keys, ", ".join(v_all)))
+    ctx.add_line("%s.append(%s)" % (self.v_rows, v_in.tuple()))
+    with ctx.compiler.indent("if len(%s) >= %d:" % (self.v_rows, self.buffer_size)):
+      ctx.add_line("%s, %s = top_rows(%s, %s, %s, %d)" % (
+        self.v_keys, self.v_rows, self.v_keys, self.v_rows, self.v_ascdescs, self.k))
+
+  def __str__(self):
+    args = ", ".join(["%s %s" % (e, ad) 
+      for (e, ad) in  zip(self.order_exprs, self.ascdescs)])
+    return "TOPK(%s LIMIT %s OFFSET %s)" % (args, self.limit, self.offset)
+
 class Distinct(UnaryOp):
   def __iter__(self):
     """
@@ -848,15 +1870,16 @@ class Distinct(UnaryOp):
     v_in = ctx['row']
     ctx.pop_vars()
 
+    # hash the row's values the same way as ListTuple.__hash__
     v_key = ctx.new_var("distinct_key")
-    lines = [
-      "%s = hash(%s)" % (v_key, v_in),
-      "if %s in %s: continue" % (v_key, self.v_seen),
-      "%s.add(%s)" % (self.v_seen, v_key)]
-    ctx.add_lines(lines)
+    ctx.add_line("%s = hash(str(%s))" % (v_key, ctx.row_values(v_in)))
 
-    ctx['row'] = v_in
-    self.consume_parent(ctx)
+    # use an if block rather than continue, so that code that ancestor
+    # operators emit after their parent's consume (e.g., Limit) still runs
+    with ctx.compiler.indent("if %s not in %s:" % (v_key, self.v_seen)):
+      ctx.add_line("%s.add(%s)" % (self.v_seen, v_key))
+      ctx['row'] = v_in
+      self.consume_parent(ctx)
 
 
 class Yield(UnaryOp):
@@ -867,12 +1890,30 @@ class Yield(UnaryOp):
   def __iter__(self):
     return iter(self.c)
 
+  def iter_batches(self, batch_size=ColumnBatch.SIZE):
+    return self.c.iter_batches(batch_size)
+
+  def vectorized(self, batch_size=ColumnBatch.SIZE):
+    """
+    Run the query plan in vectorized mode, and yield the result rows
+    in the same format as the tuple-at-a-time iterator.
+    """
+    irow = ListTuple(self.schema, [])
+    for batch in self.iter_batches(batch_size):
+      for row in batch.iter_rows():
+        irow.row = row
+        yield irow
+
   def produce(self, ctx):
+    # like the iterators, reuse a single tuple for every result row
+    self.v_out = ctx.new_var("yield_row")
+    ctx.add_line("%s = ListTuple(%s)" % (
+      self.v_out, self.schema.compile_constructor()))
     self.c.produce(ctx)
 
   def consume(self, ctx):
-    v_in = ctx['row']
-    ctx.add_line("yield %s" % v_in)
+    ctx.add_line("%s.row = %s" % (self.v_out, ctx.row_values(ctx['row'])))
+    ctx.add_line("yield %s" % self.v_out)
     self.consume_parent(ctx)
 
 class Print(UnaryOp):
@@ -886,11 +1927,14 @@ class Print(UnaryOp):
     yield 
 
   def produce(self, ctx):
+    self.v_out = ctx.new_var("print_row")
+    ctx.add_line("%s = ListTuple(%s)" % (
+      self.v_out, self.schema.compile_constructor()))
     self.c.produce(ctx)
 
   def consume(self, ctx):
-    v_in = ctx['row']
-    ctx.add_line("print %s" % v_in)
+    ctx.add_line("%s.row = %s" % (self.v_out, ctx.row_values(ctx['row'])))
+    ctx.add_line("print %s" % self.v_out)
     self.consume_parent(ctx)
 
 
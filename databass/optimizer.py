@@ -3,6 +3,7 @@ from db import Database
 from util import *
 from itertools import *
 from collections import *
+import math
 
 
 class Optimizer(object):
@@ -18,19 +19,33 @@ class Optimizer(object):
      to be initialized and disambiguated again.
   """
 
-  def __init__(self):
+  def __init__(self, bushy=False):
+    """
+    @bushy consider bushy join plans rather than only left-deep plans
+    """
     self.db = Database.db()
+    self.bushy = bushy
 
   def __call__(self, op):
     if not op: return None
 
     self.initialize_plan(op)
+    op = self.fold_constants(op)
 
     # If there's a From operator in the tree, 
     # then replace with join tree
+    self.join_preds = []
     while op.collectone("From"):
       op = self.expand_from_op(op)
 
+    self.initialize_plan(op)
+    op = self.push_down_predicates(op)
+    self.initialize_plan(op)
+    op = self.use_band_joins(op)
+    self.initialize_plan(op)
+    self.push_down_projections(op)
+    self.initialize_plan(op)
+    op = self.use_top_k(op)
     self.initialize_plan(op)
     return op
 
@@ -74,8 +89,10 @@ class Optimizer(object):
     schemas
     """
     root = op
-    # clear all schemas
+    # clear all schemas, and the fused expression functions, since
+    # the attribute references will be re-resolved
     for cop in op.collect(Op):
+      cop.clear_func()
       if cop.is_type(ExprBase): continue
       cop.schema = None
 
@@ -92,13 +109,15 @@ class Optimizer(object):
     attrs = []
     if op.is_type(ThetaJoin):
       attrs = op.cond.collect(Attr)
-    elif op.is_type(HashJoin):
-      attrs = op.join_attrs
+    elif op.is_type([HashJoin, SortMergeJoin]):
+      attrs = list(op.join_attrs)
+      if op.cond is not None:
+        attrs.extend(op.cond.collect(Attr))
     elif op.is_type(GroupBy):
       attrs = []
       for expr in chain(op.group_exprs, op.group_attrs):
         attrs.extend(expr.collect(Attr))
-    elif op.is_type(OrderBy):
+    elif op.is_type([OrderBy, TopK]):
       attrs = []
       for expr in op.order_exprs:
         attrs.extend(expr.collect(Attr))
@@ -170,9 +189,18 @@ class Optimizer(object):
       attr.tablename = mattr.tablename
       attr.typ = mattr.get_type()
       attr.idx = mattrs[0]['idx']
+      # Join conditions are evaluated over the concatenated left and right
+      # rows, whereas each join attribute indexes into its own side's row
+      if op.is_type(Join) and mop == op.r and self.is_cond_attr(op, attr):
+        attr.idx += len(op.l.schema.attrs)
       if is_agg:
         attr.gidx = mattrs[0]['gidx']
 
+  def is_cond_attr(self, join, attr):
+    if join.cond is None:
+      return False
+    return any(attr is cattr for cattr in join.cond.collect(Attr))
+
   def verify_attr_refs(self, root):
     # Verify that all attributes are bound
     for attr in root.collect(Attr):
@@ -197,33 +225,354 @@ class Optimizer(object):
     sources = fromop.cs
     sourcealiases = [s.alias for s in sources]
 
-    # get all equi-join predicates 
+    # get all equi-join predicates between the sources.  Only top-level 
+    # conjuncts of the WHERE clauses must hold for every output row.
     filters = op.collect("Filter")
     preds = []
     for f in filters:
       if fromop.is_ancestor(f):
-        for e in f.collect(Expr):
-          if self.valid_join_expr(e):
+        for e in split_conjuncts(f.cond):
+          if (self.valid_join_expr(e) and 
+              e.l.tablename in sourcealiases and
+              e.r.tablename in sourcealiases):
             preds.append(e)
 
-    join_tree = None
-    for source in sources:
-      if join_tree is None:
-        join_tree = source
-      else:
-        join_tree = ThetaJoin(join_tree, source, Bool(True))
-    
-    
-    # XXX: Uncomment the following two lines of code and run this file to
-    #      try out our naive Selinger implementation.  Note that the current
-    #      implementation does NOT generate good plans because you need to implement
-    #      cost and cardinality estimates first!
-    # opt = SelingerOpt(self.db)
-    # join_tree = opt(preds, sources)
+    self.join_preds.extend(preds)
+    opt = SelingerOpt(self.db, self.bushy)
+    join_tree = opt(preds, sources)
 
     fromop.replace(join_tree)
     return op
 
+  def fold_constants(self, op):
+    """
+    Simplify the expressions of every operator (see simplify()).  Filters 
+    whose conditions are always true are removed, and Filters and joins 
+    whose conditions are always false are replaced with an Empty operator, 
+    so that their subplans are never run.
+
+    @return the root of the rewritten plan
+    """
+    def replace(o, newop):
+      if o is op:
+        newop.p = None
+        return newop
+      o.replace(newop)
+      return op
+
+    for o in op.collect(Op):
+      if o.is_type(ExprBase):
+        continue
+      if o.is_type(Project):
+        o.exprs = [simplify(e) for e in o.exprs]
+      elif o.is_type(GroupBy):
+        o.group_exprs = [simplify(e, "numeric") for e in o.group_exprs]
+      elif o.is_type(OrderBy):
+        o.order_exprs = [simplify(e, "numeric") for e in o.order_exprs]
+      elif o.is_type([Filter, Join]) and getattr(o, "cond", None) is not None:
+        o.cond = simplify(o.cond, "bool")
+        if not is_literal(o.cond):
+          continue
+        if not o.cond.v:
+          op = replace(o, Empty(o.schema))
+        elif o.is_type(Filter):
+          op = replace(o, o.c)
+        elif o.is_type([HashJoin, SortMergeJoin]):
+          o.cond = None
+    return op
+
+  def use_top_k(self, op):
+    """
+    Replace each Limit over an OrderBy with a TopK operator, which only 
+    keeps the rows within the limit and offset rather than sorting all of
+    the OrderBy's input.  If those rows would exceed the OrderBy's memory 
+    budget, the OrderBy is kept, since its external sort can spill and
+    the Limit stops its merge early.
+
+    @return the root of the rewritten plan
+    """
+    for limit in op.collect(Limit):
+      if not limit.c.is_type(OrderBy):
+        continue
+      orderby = limit.c
+      if limit._limit + limit._offset > orderby.max_rows:
+        continue
+      topk = TopK(orderby.c, orderby.order_exprs, orderby.ascdescs,
+                  limit.limit, limit.offset)
+      if limit is op:
+        op = topk
+      else:
+        limit.replace(topk)
+    return op
+
+  def use_band_joins(self, op):
+    """
+    Replace each ThetaJoin whose condition bounds an attribute of one input
+    to a constant range around an attribute of the other input, e.g.,
+
+      a.t BETWEEN b.t - 5 AND b.t + 5
+
+    with a band SortMergeJoin, which only compares each row with the rows
+    of the other input in the range, rather than with all of them.
+
+    @return the root of the rewritten plan
+    """
+    for join in op.collect(ThetaJoin):
+      band = self.find_band(join)
+      if band is None:
+        continue
+      lattr, rattr, lo, hi, rest = band
+      cond = join_conjuncts(rest) if rest else None
+      smj = SortMergeJoin(join.l, join.r, [lattr.copy(), rattr.copy()], cond,
+          (lo, hi), 
+          attr_key(lattr) in plan_order(join.l, self.db),
+          attr_key(rattr) in plan_order(join.r, self.db))
+      if join is op:
+        op = smj
+      else:
+        join.replace(smj)
+    return op
+
+  def find_band(self, join):
+    """
+    @join ThetaJoin
+    @return (left attr, right attr, lo, hi, rest) for the first pair of 
+            numeric attributes in @join's condition such that it implies
+            left attr + lo <= right attr <= left attr + hi, where rest is 
+            the list of the conjuncts that the band does not imply.  None
+            if there is no such pair.
+    """
+    laliases = self.source_aliases(join.l)
+    raliases = self.source_aliases(join.r)
+    conjuncts = split_conjuncts(join.cond)
+
+    # (left attr key, right attr key) --> [left attr, right attr, lo, hi]
+    bands = OrderedDict()
+    # (conjunct index, key, op, c) for each comparison right attr op left
+    # attr + c, where key is None if the comparison is not a bound
+    bounds = []
+    for i, e in enumerate(conjuncts):
+      for x, y, op, c in band_comparisons(e):
+        if x.tablename in raliases and y.tablename in laliases:
+          l, r = y, x
+        elif x.tablename in laliases and y.tablename in raliases:
+          l, r, op, c = x, y, FLIPPED_COMPARISONS[op], -c
+        else:
+          bounds.append((i, None, op, c))
+          continue
+        if not (is_numeric(l) and is_numeric(r)):
+          bounds.append((i, None, op, c))
+          continue
+
+        key = (attr_key(l), attr_key(r))
+        band = bands.setdefault(key, [l, r, None, None])
+        if op in (">", ">=", "=", "=="):
+          band[2] = c if band[2] is None else max(band[2], c)
+        if op in ("<", "<=", "=", "=="):
+          band[3] = c if band[3] is None else min(band[3], c)
+        bounds.append((i, key, op, c))
+
+    for key, (l, r, lo, hi) in bands.iteritems():
+      if lo is None or hi is None:
+        continue
+      # the band only implies the non-strict comparisons with its bounds
+      keep = set()
+      for i, bkey, op, c in bounds:
+        if (bkey != key or op in ("<", ">") or 
+            op in (">=", "=", "==") and c != lo or 
+            op in ("<=", "=", "==") and c != hi):
+          keep.add(i)
+      drop = set(bound[0] for bound in bounds) - keep
+      rest = [e for i, e in enumerate(conjuncts) if i not in drop]
+      return l, r, lo, hi, rest
+    return None
+
+  def push_down_predicates(self, op):
+    """
+    Split the conditions of the Filter operators into their conjuncts, and
+    evaluate each conjunct as early as possible:
+
+    * predicates over a single source are evaluated by a new Filter right
+      above the source's Scan, or pushed into a subquery's body
+    * predicates over multiple sources are added to the condition of the 
+      lowest join that has all of the sources
+    * predicates over grouping attributes are evaluated before grouping
+    * join predicates used by the join optimizer are already evaluated by
+      the joins, so they are removed
+
+    @return the root of the rewritten plan
+    """
+    for f in op.collect(Filter):
+      if f.cond.collect(AggFunc):
+        continue
+      keep = []
+      for e in split_conjuncts(f.cond):
+        if any(e is pred for pred in self.join_preds):
+          continue
+        if not self.push_down_pred(f.c, e):
+          keep.append(e)
+
+      if keep:
+        f.cond = join_conjuncts(keep)
+      elif f.p:
+        f.replace(f.c)
+      else:
+        op, op.p = f.c, None
+    return op
+
+  def push_down_pred(self, op, e):
+    """
+    @op root of the subplan that @e filters
+    @e  conjunct of a Filter's condition
+    @return True if @e was pushed into the subplan, False if it should 
+            stay in the Filter
+    """
+    aliases = set(attr.tablename for attr in e.collect(Attr))
+    if not aliases or None in aliases:
+      return False
+
+    node = op
+    while True:
+      if node.is_type(Filter):
+        node = node.c
+      elif node.is_type(Join) and aliases <= self.source_aliases(node.l):
+        node = node.l
+      elif node.is_type(Join) and aliases <= self.source_aliases(node.r):
+        node = node.r
+      elif node.is_type(GroupBy) and self.is_group_pred(node, e):
+        node = node.c
+      else:
+        break
+
+    if node.is_type(Join):
+      if aliases <= self.source_aliases(node):
+        self.add_join_cond(node, e)
+        return True
+      return False
+    if not node.is_type(Source) or aliases != set([node.alias]):
+      return False
+    if node.is_type(SubQuerySource):
+      return self.push_into_subquery(node, e)
+    if node is op:
+      return False
+    if node.p.is_type(Filter):
+      node.p.cond = Expr("and", node.p.cond, e)
+      return True
+    f = Filter(None, e)
+    node.replace(f)
+    f.c = node
+    return True
+
+  def is_group_pred(self, gby, e):
+    """
+    A predicate over only grouping attributes can be evaluated before 
+    grouping, because it keeps or drops whole groups.
+    """
+    for attr in e.collect(Attr):
+      if not any(g.is_type(Attr) and g.tablename == attr.tablename and 
+                 g.aname == attr.aname for g in gby.group_exprs):
+        return False
+    return True
+
+  def source_aliases(self, op):
+    """
+    @return set of aliases of the sources in a join subplan
+    """
+    if op.is_type(Join):
+      return self.source_aliases(op.l) | self.source_aliases(op.r)
+    if op.is_type(Filter):
+      return self.source_aliases(op.c)
+    if op.is_type(Source):
+      return set([op.alias])
+    return set()
+
+  def add_join_cond(self, join, e):
+    if join.cond is None or join.cond.is_type(Bool) and join.cond(None):
+      join.cond = e
+    else:
+      join.cond = Expr("and", join.cond, e)
+
+  def push_into_subquery(self, source, e):
+    """
+    Rewrite @e, which references @source's output attributes, in terms of the
+    expressions of the subquery's Project, and push it below the Project.
+    This is only safe if the operators above the Project commute with 
+    filters, and the Project's expressions do not compute aggregates.
+    """
+    node = source.c
+    while node.is_type([OrderBy, Distinct]):
+      node = node.c
+    if not node.is_type(Project):
+      return False
+
+    exprs = dict(zip(node.aliases, node.exprs))
+    if not all(attr.aname in exprs for attr in e.collect(Attr)):
+      return False
+    e = e.substitute(lambda attr: exprs[attr.aname].copy())
+    if e.collect(AggFunc):
+      return False
+
+    f = Filter(node.c, e)
+    node.c = f
+    if not self.push_down_pred(f.c, e):
+      return True
+    # the predicate was pushed further into the subquery
+    node.c = f.c
+    return True
+
+  def push_down_projections(self, op):
+    """
+    Compute the attributes that each operator's parent needs, and narrow
+    the Scans and the subqueries' Projects to only output those.  Joins
+    concatenate their children's rows, so their outputs narrow as well.
+    The plan must be initialized again afterwards to re-resolve the Attr 
+    references' indexes.
+    """
+    self.prune_attrs(op, set(map(attr_key, op.schema)))
+
+  def prune_attrs(self, op, required):
+    """
+    @op       operator with an initialized schema
+    @required set of (tablename, attribute name) of the attributes in 
+              op's output that are used by its ancestors
+    """
+    if op.is_type(Scan):
+      attrs = [attr.aname for attr in op.schema if attr_key(attr) in required]
+      # keep an attribute so that rows are still produced
+      attrs = attrs or [op.schema.attrs[0].aname]
+      if len(attrs) < len(self.db.schema(op.tablename).attrs):
+        op.attrs = attrs
+      return
+
+    if op.is_type(SubQuerySource):
+      # translate to the names of the subquery's output attributes
+      required = set(attr_key(cattr) 
+          for attr, cattr in zip(op.schema, op.c.schema) 
+          if attr_key(attr) in required)
+      self.prune_attrs(op.c, required)
+      return
+
+    if op.is_type(Project):
+      keep = [i for i, attr in enumerate(op.schema) if attr_key(attr) in required]
+      keep = keep or [0]
+      op.exprs = [op.exprs[i] for i in keep]
+      op.aliases = [op.aliases[i] for i in keep]
+
+    if op.is_type([Project, GroupBy]):
+      # the output is computed from the expressions alone
+      required = set()
+    elif op.is_type(Distinct) or not op.is_type([UnaryOp, Join]):
+      # the operator needs all of its input attributes
+      required = set(map(attr_key, chain(*[c.schema for c in op.children()])))
+
+    required = required | set(map(attr_key, self.attrs_from_nonsource_op(op)))
+    if op.is_type(GroupBy):
+      for udf, args in op.aggs:
+        for arg in args:
+          required.update(map(attr_key, arg.collect(Attr)))
+    for c in op.children():
+      self.prune_attrs(c, required)
+
   def valid_join_expr(self, expr):
     """
     @expr     candidate join expression
@@ -240,7 +589,7 @@ class Optimizer(object):
          T.a = S.b + 1        -- not valid
     """
 
-    if expr.op != "=":
+    if not expr.is_type(Expr) or expr.op not in ("=", "=="):
       return False
 
     l, r = expr.l, expr.r
@@ -256,9 +605,258 @@ class Optimizer(object):
     return l.tablename != r.tablename
 
 
+def split_conjuncts(expr):
+  """
+  @expr boolean expression
+  @return list of expressions whose conjunction is @expr
+          e.g., (a = 1 and b = 2) and c = 3  -->  [a = 1, b = 2, c = 3]
+  """
+  if expr.is_type(Paren):
+    return split_conjuncts(expr.c)
+  if expr.is_type(Expr) and expr.op == "and":
+    return split_conjuncts(expr.l) + split_conjuncts(expr.r)
+  return [expr]
+
+def join_conjuncts(exprs):
+  """
+  @exprs list of boolean expressions
+  @return the conjunction of @exprs, or Bool(True) if there are none
+  """
+  if not exprs:
+    return Bool(True)
+  ret = exprs[0]
+  for e in exprs[1:]:
+    ret = Expr("and", ret, e)
+  return ret
+
+
+def attr_key(attr):
+  """
+  @return (tablename, attribute name) that identifies a source attribute
+  """
+  return (attr.tablename, attr.aname)
+
+def plan_order(op, db):
+  """
+  @op subplan
+  @db Database of the subplan's tables
+  @return set of the keys (see attr_key()) of the attributes that @op's
+          output rows are in ascending order of.  Scans are in the order 
+          of their table's sorted attributes (see AttrStats.is_sorted), 
+          and OrderBys of their first order expression if it is an 
+          ascending attribute.
+  """
+  if op.is_type(Scan):
+    stats = db[op.tablename].stats
+    return frozenset((op.alias, aname) 
+        for aname, stat in stats.attrs.iteritems() if stat.is_sorted)
+  if op.is_type(SubQuerySource):
+    return frozenset((op.alias, aname) for tablename, aname in plan_order(op.c, db))
+  if op.is_type([OrderBy, TopK]):
+    e = op.order_exprs[0]
+    if e.is_type(Attr) and op.ascdescs[0] != "desc":
+      return frozenset([attr_key(e)])
+    return frozenset()
+  if op.is_type(Project):
+    order = plan_order(op.c, db)
+    return frozenset((None, alias) for e, alias in zip(op.exprs, op.aliases)
+        if e.is_type(Attr) and attr_key(e) in order)
+  if op.is_type([Filter, Limit]):
+    return plan_order(op.c, db)
+  if op.is_type(SortMergeJoin):
+    lattr, rattr = op.join_attrs
+    order = set([attr_key(lattr)])
+    if op.band is None:
+      order.add(attr_key(rattr))
+    if op.lsorted:
+      # the left input is streamed, so the output keeps its order
+      order |= plan_order(op.l, db)
+    return frozenset(order)
+  return frozenset()
+
+
+# x op y <==> y FLIPPED_COMPARISONS[op] x
+FLIPPED_COMPARISONS = {
+  "=": "=", "==": "==", "<": ">", "<=": ">=", ">": "<", ">=": "<="
+}
+
+def linear_attr(e):
+  """
+  @return (attr, c) if @e is an attribute plus or minus a numeric literal 
+          c, e.g., T.a - 5 --> (T.a, -5), otherwise None
+  """
+  if e.is_type(Paren):
+    return linear_attr(e.c)
+  if e.is_type(Attr):
+    return e, 0
+  if not (e.is_type(Expr) and e.op in ("+", "-") and e.r is not None):
+    return None
+  if e.l.is_type(Attr) and is_number(e.r):
+    return e.l, e.r.v if e.op == "+" else -e.r.v
+  if e.op == "+" and is_number(e.l) and e.r.is_type(Attr):
+    return e.r, e.l.v
+  return None
+
+def band_comparisons(e):
+  """
+  @e conjunct of a join condition
+  @return list of (x, y, op, c) for each comparison x op y + c between 
+          attributes x and y that @e consists of, e.g., 
+
+            a.t BETWEEN b.t - 5 AND b.t + 5 
+            --> [(a.t, b.t, ">=", -5), (a.t, b.t, "<=", 5)]
+
+          or [] if @e is not such a comparison
+  """
+  if e.is_type(Paren):
+    return band_comparisons(e.c)
+  if e.is_type(Between):
+    comparisons = [(e.expr, ">=", e.lower), (e.expr, "<=", e.upper)]
+  elif e.is_type(Expr) and e.op in FLIPPED_COMPARISONS:
+    comparisons = [(e.l, e.op, e.r)]
+  else:
+    return []
+
+  ret = []
+  for l, op, r in comparisons:
+    l, r = linear_attr(l), linear_attr(r)
+    if l is None or r is None:
+      return []
+    ret.append((l[0], r[0], op, r[1] - l[1]))
+  return ret
+
+
+# literal operand values that leave the other operand of an arithmetic
+# operator unchanged: op -> (left identities, right identities)
+IDENTITIES = {
+  "+": ((0,), (0,)),
+  "-": ((), (0,)),
+  "*": ((1,), (1,)),
+  "/": ((), (1,))
+}
+COMPARISONS = ["=", "==", "<>", "!=", "<", ">", "<=", ">="]
+
+def is_literal(e):
+  return e.is_type(Literal) and not e.is_type(Param)
+
+def is_number(e):
+  return is_literal(e) and not e.is_type(Bool) and \
+      isinstance(e.v, (int, long, float))
+
+def is_constant(e):
+  """
+  @return True if @e's value doesn't depend on the input row, the bound
+          parameters, or a UDF
+  """
+  return not e.collect([Attr, Param, AggFunc, ScalarFunc, Star])
+
+def is_numeric(e):
+  """
+  @return True if @e is known to evaluate to a number
+  """
+  if e.is_type(Attr):
+    return e.typ == "num"
+  return e.is_type(Expr) and e.r is not None and e.op in IDENTITIES
+
+def to_literal(v):
+  if isinstance(v, bool):
+    return Bool(v)
+  return Literal(v)
+
+def fold(e):
+  """
+  @e constant expression
+  @return Literal of @e's value, or @e if evaluating it fails, so that the
+          error is raised when the query runs
+  """
+  try:
+    return to_literal(e(None))
+  except (ArithmeticError, TypeError, ValueError):
+    return e
+
+def simplify(e, context="value"):
+  """
+  Fold the constant subexpressions of @e, and remove operations that don't
+  change its value.  @e's subexpressions are rewritten in place.
+
+  @context how the expression's value is used:
+           "value"   the value itself, e.g., a Project expression
+           "numeric" only compared or computed with, so x * 1 can be x
+           "bool"    only its truthiness, e.g., a Filter condition
+  @return the simplified expression, which may be @e
+  """
+  if e.is_type(Paren):
+    return simplify(e.c, context)
+
+  if e.is_type([ScalarFunc, AggFunc]):
+    e.args = [simplify(arg) for arg in e.args]
+    return e
+
+  if e.is_type(Between):
+    e.expr = simplify(e.expr, "numeric")
+    e.lower = simplify(e.lower, "numeric")
+    e.upper = simplify(e.upper, "numeric")
+    if is_constant(e):
+      return fold(e)
+    if is_literal(e.lower) and is_literal(e.upper) and e.lower.v > e.upper.v:
+      return Bool(False)
+    return e
+
+  if not e.is_type(Expr):
+    return e
+
+  op = e.op.lower()
+  if op in ("and", "or"):
+    ctx = "bool" if context == "bool" else "value"
+  elif op == "not":
+    ctx = "bool"
+  elif op in COMPARISONS:
+    ctx = "numeric"
+  else:
+    ctx = "value" if context == "value" else "numeric"
+  e.l = simplify(e.l, ctx)
+  if e.r is not None:
+    e.r = simplify(e.r, ctx)
+  if is_constant(e):
+    return fold(e)
+
+  l, r = e.l, e.r
+  if op in ("and", "or"):
+    # "and" returns its left operand if it is false, otherwise its right
+    # operand, and "or" the reverse.  If only the truthiness matters, a 
+    # literal right operand can be removed as well.
+    if is_literal(l):
+      return r if bool(l.v) == (op == "and") else l
+    if is_literal(r) and context == "bool":
+      return l if bool(r.v) == (op == "and") else r
+
+  if op in IDENTITIES and r is not None and context != "value":
+    lids, rids = IDENTITIES[op]
+    if is_literal(r) and is_identity(r.v, rids) and is_numeric(l):
+      return l
+    if is_literal(l) and is_identity(l.v, lids) and is_numeric(r):
+      return r
+  return e
+
+def is_identity(v, identities):
+  return not isinstance(v, (bool, basestring)) and v in identities
+
+
 class SelingerOpt(object):
-  def __init__(self, db):
+  # Join orders are found with dynamic programming for up to this many 
+  # tables, and greedily for more tables
+  DP_THRESHOLD = 10
+
+  # relative cost of inserting a row into a hash table vs probing it
+  HASH_BUILD_COST = 2.0
+
+  def __init__(self, db, bushy=False):
+    """
+    @db    Database
+    @bushy consider bushy plans during dynamic programming
+    """
     self.db = db
+    self.bushy = bushy
     self.costs = dict()
     self.cards = dict()
 
@@ -270,13 +868,11 @@ class SelingerOpt(object):
     self.pred_index = self.build_predicate_index(preds)
     self.plans_tested = 0
 
-    # This is an exhaustive algorithm that uses recursion
-    # You will implement a faster bottom-up algorithm based on Selinger
-    plan = self.best_plan_exhaustive(sources)
-    
-    # XXX: Uncomment the following once you have implemented best_plan()
-    # plan = self.best_plan(sources)
-
+    if len(sources) <= self.DP_THRESHOLD:
+      plan = self.best_plan_dp(sources)
+    else:
+      plan = self.best_plan(sources)
+    self.set_parents(plan)
 
     # print "# plans tested: ", self.plans_tested
     return plan
@@ -293,47 +889,238 @@ class SelingerOpt(object):
    
     creates the lookup table:
    
-      A,B --> "A.a = B.b"
-      B,A --> "A.a = B.b"
+      A,B --> ["A.a = B.b"]
+      B,A --> ["A.a = B.b"]
    """
     pred_index = defaultdict(list)
     for pred in preds:
       lname = pred.l.tablename
       rname = pred.r.tablename
-      pred_index[(lname,rname)] = pred
-      pred_index[(rname,lname)] = pred
+      pred_index[(lname,rname)].append(pred)
+      pred_index[(rname,lname)].append(pred)
     return pred_index
 
+  def aliases(self, plan):
+    """
+    @plan a source or a join subplan of sources
+    @return list of the aliases of the sources in the subplan
+    """
+    if plan.is_type(Join):
+      return self.aliases(plan.l) + self.aliases(plan.r)
+    return [plan.alias]
+
   def get_join_pred(self, l, r):
     """
     @l left subplan
-    @r right Scan operator
-
-    This method looks for any predicate that involves a table in the left
-    subplan and right Scan operator.  If it can't find a predicate, then it 
-    returns the predicate True
-    """
-    if l.is_type(Scan):
-      key = (l.alias, r.alias)
-      return self.pred_index.get(key, Bool(True))
-    for lsource in l.collect("Scan"):
-      key = (lsource.alias, r.alias)
-      if key in self.pred_index:
-        return self.pred_index[key]
-    return Bool(True)
+    @r right subplan
+
+    This method looks for the predicates that involve a table in the left
+    subplan and a table in the right subplan.  It returns a copy of their
+    conjunction, or the predicate True if there are none.
+    """
+    preds = []
+    for lalias in self.aliases(l):
+      for ralias in self.aliases(r):
+        preds.extend(self.pred_index.get((lalias, ralias), []))
+    return join_conjuncts([pred.copy() for pred in preds])
+
+  def get_join_keys(self, l, r):
+    """
+    @l left subplan
+    @r right subplan
+    @return list of (left attr, right attr) pairs of the equi-join 
+            predicates between @l and @r, most selective first.  The list is
+            empty if there are no predicates between the subplans.
+
+    Ties are broken by the order of the predicates in the query, as in
+    best_plan_dp().
+    """
+    laliases = self.aliases(l)
+    preds = []
+    for lalias in laliases:
+      for ralias in self.aliases(r):
+        preds.extend(self.pred_index.get((lalias, ralias), []))
+
+    positions = dict((id(pred), i) for i, pred in enumerate(self.preds))
+    keys = []
+    for pred in preds:
+      lattr, rattr = pred.l, pred.r
+      if lattr.tablename not in laliases:
+        lattr, rattr = rattr, lattr
+      sel = min(self.selectivity_attr(l, lattr), self.selectivity_attr(r, rattr))
+      keys.append((sel, positions[id(pred)], lattr, rattr))
+    keys.sort(key=lambda key: key[:2])
+    return [(lattr, rattr) for sel, pos, lattr, rattr in keys]
+
+  def join_klasses(self, l, r):
+    """
+    @return join algorithms that can join subplans @l and @r.  Hash and 
+            sort-merge joins need an equi-join predicate.
+    """
+    if not self.get_join_keys(l, r):
+      return [ThetaJoin]
+    return [ThetaJoin, HashJoin, SortMergeJoin]
+
+  def make_join(self, join_klass, l, r):
+    """
+    Create a @join_klass join between the subplans @l and @r.  Hash joins
+    are keyed on all of the equi-join predicates between the subplans.  
+    Sort-merge joins merge on the most selective one, and check the rest 
+    as the residual condition.
+    """
+    if join_klass is ThetaJoin:
+      return self.create_new_join_plan(ThetaJoin, l, r, self.get_join_pred(l, r))
+    keys = [(lattr.copy(), rattr.copy()) for lattr, rattr in self.get_join_keys(l, r)]
+    if join_klass is HashJoin:
+      return self.create_new_join_plan(HashJoin, l, r, keys)
+
+    cond = None
+    if len(keys) > 1:
+      cond = join_conjuncts([Expr("=", lattr, rattr) for lattr, rattr in keys[1:]])
+    lattr, rattr = keys[0]
+    return self.create_new_join_plan(join_klass, l, r, [lattr, rattr], cond,
+        None, attr_key(lattr) in self.order(l), attr_key(rattr) in self.order(r))
+
+  def set_parents(self, plan):
+    """
+    Candidate plans share subplans, so child operators' parent pointers are
+    not maintained during optimization.  Set them for the chosen plan.
+    """
+    if plan.is_type(Join):
+      for c in (plan.l, plan.r):
+        c.p = plan
+        self.set_parents(c)
+
+  def best_plan_dp(self, sources):
+    """
+    @sources list of tables that we will build a join plan for
 
+    Bottom-up Selinger optimization using dynamic programming.  The best 
+    plan for each subset of the sources is computed from the best plans 
+    of its subsets, so each subset's cost and cardinality are only 
+    estimated once.  Plans are left-deep unless self.bushy is set.
+    """
+    n = len(sources)
+    aliases = [source.alias for source in sources]
+
+    # bitmasks of the two sources each join predicate references, the 
+    # predicate's selectivity, and the keys of its attributes
+    predsels = []
+    for pred in self.preds:
+      i = aliases.index(pred.l.tablename)
+      j = aliases.index(pred.r.tablename)
+      sel = min(self.selectivity_attr(sources[i], pred.l),
+                self.selectivity_attr(sources[j], pred.r))
+      predsels.append((1 << i, 1 << j, sel, attr_key(pred.l), attr_key(pred.r)))
+
+    # bitmask of the sources in a subset --> 
+    #   (cost, cardinality, left subset, right subset, join class, order) 
+    # of its best plan, where order is the set of attribute keys that the
+    # plan's output is sorted on
+    best = {}
+    for i, source in enumerate(sources):
+      best[1 << i] = (self.cost(source), self.card(source), None, None, 
+          None, self.order(source))
+
+    for size in xrange(2, n + 1):
+      for idxs in combinations(range(n), size):
+        mask = sum(1 << i for i in idxs)
+        for lmask, rmask in self.splits(mask, idxs):
+          self.plans_tested += 1
+          lcost, lcard = best[lmask][:2]
+          rcost, rcard = best[rmask][:2]
+          sel = 1.0
+          key, keysel = None, None
+          for imask, jmask, psel, ikey, jkey in predsels:
+            if imask & lmask and jmask & rmask:
+              pkey = (ikey, jkey)
+            elif jmask & lmask and imask & rmask:
+              pkey = (jkey, ikey)
+            else:
+              continue
+            sel *= psel
+            if key is None or psel < keysel:
+              key, keysel = pkey, psel
+          card = self.join_card(lcard, rcard, sel)
+          for klass, cost, order in self.join_algorithms(
+              lcost, lcard, best[lmask][5], rcost, rcard, best[rmask][5], 
+              card, key):
+            if mask not in best or cost < best[mask][0]:
+              best[mask] = (cost, card, lmask, rmask, klass, order)
+
+    return self.build_dp_plan(best, sources, (1 << n) - 1)
+
+  def build_dp_plan(self, best, sources, mask):
+    """
+    Construct the join plan for subset @mask chosen by best_plan_dp()
+    """
+    cost, card, lmask, rmask, klass, order = best[mask]
+    if lmask is None:
+      return sources[mask.bit_length() - 1]
+    l = self.build_dp_plan(best, sources, lmask)
+    r = self.build_dp_plan(best, sources, rmask)
+    plan = self.make_join(klass, l, r)
+    self.costs[plan] = cost
+    self.cards[plan] = card
+    return plan
+
+  def join_algorithms(self, lcost, lcard, lorder, rcost, rcard, rorder, card, key):
+    """
+    @lcost, @lcard, @lorder cost, cardinality and sort order of the left subplan
+    @rcost, @rcard, @rorder cost, cardinality and sort order of the right subplan
+    @card                   cardinality of the join
+    @key                    (left, right) attribute keys of the equi-join 
+                            predicate used as the join key, or None
+
+    @return list of (join class, cost, sort order of the output) candidates
+    """
+    ret = [(ThetaJoin, self.join_cost(lcost, lcard, rcost, card), frozenset())]
+    if key is None:
+      return ret
+    ret.append((HashJoin, 
+      self.hash_join_cost(lcost, lcard, rcost, rcard, card), frozenset()))
+    # the output is in the left input's order if it is streamed
+    order = frozenset(key)
+    if key[0] in lorder:
+      order |= lorder
+    ret.append((SortMergeJoin, 
+      self.sort_merge_join_cost(lcost, lcard, key[0] in lorder, 
+                                rcost, rcard, key[1] in rorder, card),
+      order))
+    return ret
+
+  def order(self, plan):
+    """
+    @return set of attribute keys that @plan's output is sorted on
+    """
+    return plan_order(plan, self.db)
+
+  def splits(self, mask, idxs):
+    """
+    @mask bitmask of a subset of the sources
+    @idxs indexes of the sources in the subset
+    @return (left, right) subsets to join to compute the subset
+    """
+    if not self.bushy:
+      return [(mask & ~(1 << i), 1 << i) for i in idxs]
+    ret = []
+    lmask = (mask - 1) & mask
+    while lmask:
+      ret.append((lmask, mask & ~lmask))
+      lmask = (lmask - 1) & mask
+    return ret
 
   def best_plan(self, sources):
     """
     @sources list of tables that we will build a join plan for
 
-    This implements a Selinger-based Bottom-up join optimization
-    and returns a left-deep ThetaJoin plan.  The algorithm 
+    Greedy Selinger-based Bottom-up join optimization that returns a 
+    left-deep join plan.  It is used when there are too many tables 
+    for dynamic programming.  The algorithm 
 
     1. picks the best 2-table join plan
     2. then iteratively picks the next table to join based on
-       the cost model that you will implement.  
-
+       the cost model
     """
     # make a copy of sources 
     sources = list(sources)
@@ -352,17 +1139,12 @@ class SelingerOpt(object):
       best_cand = None
       best_cost = float("inf")
       for r in sources:
-        self.plans_tested += 1
-        pred = self.get_join_pred(best_plan, r)
-
-        
-        # XXX: Write code to construct a candidate plan with r as the
-        # inner table, and compute its cost using self.cost()
-        #
-        # Keep the lowest cost candidate plan in best_cand
-        #      Make sure to track the child operators' 
-        #      parent pointers, as described in best_plan_exhaustive()
-        pass
+        for klass in self.join_klasses(best_plan, r):
+          self.plans_tested += 1
+          plan = self.make_join(klass, best_plan, r)
+          cost = self.cost(plan)
+          if cost < best_cost:
+            best_cand, best_cost = plan, cost
 
       best_plan = best_cand
       sources.remove(best_plan.r)
@@ -382,19 +1164,19 @@ class SelingerOpt(object):
 
     for (l, r) in product(sources, sources):
       if l == r: continue
-      self.plans_tested += 1
-      pred = self.get_join_pred(l, r)
-
-      # XXX: Write your code here
-      #      Make sure to track the child operators' 
-      #      parent pointers, as described in best_plan_exhaustive()
+      for klass in self.join_klasses(l, r):
+        self.plans_tested += 1
+        plan = self.make_join(klass, l, r)
+        cost = self.cost(plan)
+        if cost < best_cost:
+          best_plan, best_cost = plan, cost
 
     return best_plan
 
   def best_plan_exhaustive(self, sources):
     """
     @sources list of tables that we will build a join plan for
-    @return A left-deep ThetaJoin plan
+    @return A left-deep join plan
 
     This is an example implementation of a exhaustive plan optimizer.
     It is slower than the bottom-up Selinnger approach
@@ -414,20 +1196,20 @@ class SelingerOpt(object):
       if rest_plan is None:
         continue
 
-      self.plans_tested += 1
-      pred = self.get_join_pred(rest_plan, r)
-      plan = self.create_new_join_plan(ThetaJoin, rest_plan, r, pred)
-      cost = self.cost(plan)
+      for klass in self.join_klasses(rest_plan, r):
+        self.plans_tested += 1
+        plan = self.make_join(klass, rest_plan, r)
+        cost = self.cost(plan)
 
-      if cost <= best_cost:
-        plan.init_schema()
-        plan.l.p = plan
-        plan.r.p = plan
-        best_plan, best_cost = plan, cost
+        if cost <= best_cost:
+          plan.init_schema()
+          plan.l.p = plan
+          plan.r.p = plan
+          best_plan, best_cost = plan, cost
 
     return best_plan
 
-  def create_new_join_plan(self, join_klass, l, r, pred):
+  def create_new_join_plan(self, join_klass, l, r, *args):
     """
     When an operator is initialized, the constructor
     modifies the child operators' parent pointers
@@ -438,7 +1220,7 @@ class SelingerOpt(object):
     """
     lp = l.p
     rp = r.p
-    plan = join_klass(l, r, pred)
+    plan = join_klass(l, r, *args)
     l.p = lp
     r.p = rp
     return plan
@@ -456,20 +1238,19 @@ class SelingerOpt(object):
       return self.costs[join]
 
     if join.is_type(Scan):
-      # XXX: Implement the cost to scan this Scan operator
-      # Take a look at db.py:Stats, which provides some database statistics.
-      # To use its functionality, you may need to implement parts of db.py
-      cost = 0
+      # reading each row of the table
+      cost = self.db[join.tablename].stats.card
+    elif join.is_type(HashJoin):
+      cost = self.hash_join_cost(self.cost(join.l), self.card(join.l),
+          self.cost(join.r), self.card(join.r), self.card(join))
+    elif join.is_type(SortMergeJoin):
+      cost = self.sort_merge_join_cost(
+          self.cost(join.l), self.card(join.l), join.lsorted,
+          self.cost(join.r), self.card(join.r), join.rsorted,
+          self.card(join))
     elif join.is_type(Join):
-      # XXX: Compute the cost of the tuple-based nested loops join operation
-      # in terms of the cost to compute the outer (left) subplan and the number
-      # of tuples we need to examine from the inner (right) table.
-      #
-      # Hint: You may want to compute the cost recursively.
-      cost = 0
-
-      # We penalize high cardinality joins a little bit
-      cost += 0.1 * self.card(join)
+      cost = self.join_cost(self.cost(join.l), self.card(join.l), 
+          self.cost(join.r), self.card(join))
     elif join.is_type(SubQuerySource):
       cost = self.cost(join.c)
     else:
@@ -491,13 +1272,10 @@ class SelingerOpt(object):
       return self.cards[join]
 
     if join.is_type(Scan):
-      # XXX: Compute the cardinality of the join if it is a Scan operator
-      # Similar to self.cost() above, take a look at db.py:Stats.
-      card = 1
+      card = self.db[join.tablename].stats.card
     elif join.is_type(Join):
-      # XXX: Compute the cardinality of the join subplan as described in lecture.
-      # Hint: You may want to compute the cardinality recursively
-      card = 1
+      card = self.join_card(self.card(join.l), self.card(join.r), 
+          self.selectivity(join))
     elif join.is_type(SubQuerySource):
       card = self.card(join.c)
     else:
@@ -507,6 +1285,53 @@ class SelingerOpt(object):
     self.cards[join] = card
     return card
 
+  def join_cost(self, lcost, lcard, rcost, card):
+    """
+    @lcost, @lcard  cost and cardinality of the left (outer) subplan
+    @rcost          cost of the right (inner) subplan
+    @card           cardinality of the join
+    """
+    # tuple-based nested loops: the inner (right) subplan is computed 
+    # once for each tuple of the outer (left) subplan
+    cost = lcost + lcard * rcost
+
+    # We penalize high cardinality joins a little bit
+    return cost + 0.1 * card
+
+  def hash_join_cost(self, lcost, lcard, rcost, rcard, card):
+    """
+    @lcost, @lcard  cost and cardinality of the left (probe) subplan
+    @rcost, @rcard  cost and cardinality of the right (build) subplan
+    @card           cardinality of the join
+    """
+    # each subplan is computed once; the right rows are inserted into a 
+    # hash table that each left row probes
+    cost = lcost + rcost + self.HASH_BUILD_COST * rcard + lcard
+    return cost + 0.1 * card
+
+  def sort_merge_join_cost(self, lcost, lcard, lsorted, rcost, rcard, rsorted, card):
+    """
+    @lsorted, @rsorted whether the subplans are already sorted on the join key
+
+    The other arguments are the same as hash_join_cost()
+    """
+    cost = lcost + rcost + self.sort_cost(lcard, lsorted) + \
+        self.sort_cost(rcard, rsorted) + lcard + rcard
+    return cost + 0.1 * card
+
+  def sort_cost(self, card, is_sorted=False):
+    """
+    Input that is already in order does not need to be sorted
+    """
+    if is_sorted:
+      return 0
+    if card <= 2:
+      return card
+    return card * math.log(card, 2)
+
+  def join_card(self, lcard, rcard, sel):
+    return lcard * rcard * sel
+
   def selectivity(self, join):
     """
     @join join subplan
@@ -518,14 +1343,33 @@ class SelingerOpt(object):
     if join.is_type(Scan):
       return self.DEFAULT_SELECTIVITY
 
-    # if the predicate is a boolean, then the selectivity
-    # is 1 if True (cross-product), or 0 if False
-    if join.cond.is_type(Bool):
-      return join.cond(None) * 1.0
+    conds = []
+    if join.is_type([HashJoin, SortMergeJoin]):
+      conds.extend(Expr("=", l, r) for l, r in join.join_keys)
+    if join.cond is not None:
+      # if the predicate is a boolean, then the selectivity
+      # is 1 if True (cross-product), or 0 if False
+      if join.cond.is_type(Bool):
+        return join.cond(None) * 1.0
+      conds.extend(split_conjuncts(join.cond))
+
+    # assume the conjuncts are independent
+    sel = 1.0
+    for cond in conds:
+      if not (cond.is_type(Expr) and cond.op in ("=", "==") and 
+          cond.l.is_type(Attr) and cond.r.is_type(Attr)):
+        sel *= self.DEFAULT_SELECTIVITY
+        continue
 
-    lsel = self.selectivity_attr(join.l, join.cond.l)
-    rsel = self.selectivity_attr(join.r, join.cond.r)
-    return min(lsel, rsel)
+      # the predicate's attributes are not necessarily in the same order
+      # as the join's children
+      lattr, rattr = cond.l, cond.r
+      if lattr.tablename not in self.aliases(join.l):
+        lattr, rattr = rattr, lattr
+      lsel = self.selectivity_attr(join.l, lattr)
+      rsel = self.selectivity_attr(join.r, rattr)
+      sel *= min(lsel, rsel)
+    return sel
 
   def selectivity_attr(self, source, attr):
     """
@@ -535,25 +1379,18 @@ class SelingerOpt(object):
     Estimate the selectivity of a join attribute.  
     We make the following assumptions:
 
-    * if the source is not a base table, then the selectivity is 1
-    * if the attribute is numeric then we assume the attribute values are
-      uniformly distributed between the min and max values.
-    * if the attribute is non-numeric, we assume the values are 
-      uniformly distributed across the distinct attribute values
+    * if the attribute is not from a base table, then the selectivity is 1
+    * otherwise, the non-NULL values are uniformly distributed across the 
+      distinct attribute values (see Stats)
     """
+    while source.is_type(Join):
+      if attr.tablename in self.aliases(source.l):
+        source = source.l
+      else:
+        source = source.r
     if not source.is_type(Scan):
       return 1.0
 
     table = self.db[source.tablename]
     stat = table.stats[attr]
-    typ = table.schema.get_type(attr)
-    if typ == "num":
-      # XXX: Write code to estimate the selectivity of the numeric attribute.
-      # You can add 1 to the denominator to avoid divide by 0 errors
-      sel = 1.0
-    elif typ == "str":
-      # XXX: Write code to estimaote the selectivity of the non-numeric attribute
-      sel = 1.0
-    else:
-      sel = 0.05
-    return sel
+    return stat.selectivity_eq()
@@ -42,14 +42,12 @@ grammar = Grammar(
     gb_clause      = GROUP BY group_clause having_clause?
     group_clause   = grouping_term (ws "," grouping_term)*
     grouping_term  = ws expr
-    having_clause  = HAVING expr
+    having_clause  = HAVING wsp expr
 
     orderby        = ORDER BY ordering_term (ws "," ordering_term)*
     ordering_term  = ws expr (ASC/DESC)?
 
-    # TODO: edit this grammar rule to support the OFFSET syntax
-    #       Note that the offset is allowed to be an expression.
-    limit          = LIMIT wsp expr
+    limit          = LIMIT wsp expr (OFFSET wsp expr)?
 
     col_ref        = (table_name ".")? column_name
 
@@ -65,6 +63,7 @@ grammar = Grammar(
                function /
                col_ref /
                string /
+               param /
                attr
     parenval = "(" ws expr ws ")"
     function = fname "(" ws arg_list? ws ")"
@@ -72,13 +71,14 @@ grammar = Grammar(
     number   = ~"\d*\.?\d+"i
     string   = ~"([\"\'])(\\\\?.)*?\\1"i
     attr     = ~"\w[\w\d]*"i
+    param    = "?" / ~":[a-zA-Z]\w*"i
     fname    = ~"\w[\w\d]*"i
     boolean  = "true" / "false"
     compound_op = "UNION" / "union"
     binaryop = "+" / "-" / "*" / "/" / "==" / "=" / "<>" / "!=" / 
-               "<=" / ">" / "<" / ">" / "and" / "AND" / "or" / "OR" / "like" / "LIKE"
+               "<=" / ">=" / "<" / ">" / "and" / "AND" / "or" / "OR" / "like" / "LIKE"
     binaryop_no_andor = "+" / "-" / "*" / "/" / "==" / "=" / "<>" / "!=" / 
-               "<=" / ">" / "<" / ">" / "like" / "LIKE"
+               "<=" / ">=" / "<" / ">" / "like" / "LIKE"
     unaryop  = "+" / "-" / "not" / "NOT"
     ws       = ~"\s*"i
     wsp      = ~"\s+"i
@@ -186,6 +186,11 @@ class Visitor(NodeVisitor):
   """
   grammar = grammar
 
+  def __init__(self):
+    super(Visitor, self).__init__()
+    # names of the parameters, or None for ? placeholders, by index 
+    self.params = []
+
   def visit_query(self, node, children):
     ret = None
     for node in (filter(bool, children)):
@@ -207,7 +212,7 @@ class Visitor(NodeVisitor):
 
   def visit_select_core(self, node, children):
     distinctc, _,  selectc, fromc, wherec, gbc = tuple(children[1:])
-    nodes = filter(bool, [fromc, wherec, gbc, selectc, distinctc])
+    nodes = filter(bool, [fromc, wherec] + (gbc or []) + [selectc, distinctc])
     ret = None
     for n in nodes:
       if not ret: 
@@ -281,9 +286,8 @@ class Visitor(NodeVisitor):
     gb = children[2] 
     having = children[3]
     if having:
-      having.c = gb
-      return having
-    return gb
+      return [gb, having]
+    return [gb]
 
   def visit_group_clause(self, node, children):
     groups = flatten(children, 0, 1)
@@ -293,7 +297,7 @@ class Visitor(NodeVisitor):
     return children[1]
 
   def visit_having_clause(self, node, children):
-    return children[1]
+    return Filter(None, children[2])
 
   def visit_orderby(self, node, children):
     terms = flatten(children, 2, 3)
@@ -320,8 +324,8 @@ class Visitor(NodeVisitor):
     return "desc"
 
   def visit_limit(self, node, children):
-    # TODO: edit this code to pass OFFSET information to the Limit operator
-    return Limit(None, children[2])
+    offset = children[3] or 0
+    return Limit(None, children[2], offset)
 
   def visit_col_ref(self, node, children):
     tname = children[0]
@@ -355,7 +359,7 @@ class Visitor(NodeVisitor):
 
   def visit_btwnexpr(self, node, children):
     v1, v2, v3 = children[0], children[3], children[-1]
-    return Between(v2, v1, v3)
+    return Between(v1, v2, v3)
 
   def visit_expr(self, node, children):
     return children[0]
@@ -382,6 +386,16 @@ class Visitor(NodeVisitor):
   def visit_string(self, node, children):
     return Literal(node.text)
 
+  def visit_param(self, node, children):
+    """
+    Each ? is a new parameter, whereas all occurrences of a :name 
+    placeholder refer to the same parameter
+    """
+    name = node.text[1:] or None
+    if name is None or name not in self.params:
+      self.params.append(name)
+    return Param(self.params.index(name) if name else len(self.params) - 1, name)
+
   def visit_parenval(self, node, children):
     return Paren(children[2])
 
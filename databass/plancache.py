@@ -0,0 +1,85 @@
+"""
+Cache of optimized query plans, so that repeated queries skip parsing and
+optimization.
+"""
+import re
+from collections import OrderedDict
+from db import Database
+
+# string literals, or runs of whitespace outside of them
+_tokens_re = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(\s+)""")
+
+
+def normalize_query(qstr):
+  """
+  @qstr query string
+  @return the query with runs of whitespace outside of string literals
+          collapsed to a single space, and without a trailing semicolon
+  """
+  def f(m):
+    if m.group(1) is not None:
+      return m.group(1)
+    return " "
+  qstr = _tokens_re.sub(f, qstr).strip()
+  while qstr.endswith(";"):
+    qstr = qstr[:-1].rstrip()
+  return qstr
+
+
+class PlanCache(object):
+  """
+  LRU cache in front of a function that parses and optimizes a query string
+  into a physical plan.  Plans are keyed by the normalized query string and
+  the Database's version, which changes whenever a table is (re-)registered,
+  so plans over stale schemas and statistics are never returned.
+
+  The plans are reused across executions, so they must not be modified by
+  the caller.
+  """
+
+  def __init__(self, planner, capacity=128):
+    """
+    @planner  function that takes a query string and returns a plan
+    @capacity maximum number of plans to keep
+    """
+    self.planner = planner
+    self.capacity = capacity
+    self.plans = OrderedDict()
+    self.version = None
+    self.hits = 0
+    self.misses = 0
+
+  def __call__(self, qstr):
+    db = Database.db()
+    if db.version != self.version:
+      # the catalog changed, so none of the cached plans are valid
+      self.plans.clear()
+      self.version = db.version
+
+    qstr = normalize_query(qstr)
+    key = (qstr, db.version)
+    plan = self.plans.pop(key, None)
+    if plan is None:
+      self.misses += 1
+      plan = self.planner(qstr)
+      while len(self.plans) >= self.capacity:
+        self.plans.popitem(last=False)
+    else:
+      self.hits += 1
+    # most recently used plans are at the end
+    self.plans[key] = plan
+    return plan
+
+  def __len__(self):
+    return len(self.plans)
+
+  def __contains__(self, qstr):
+    return (normalize_query(qstr), Database.db().version) in self.plans
+
+  def clear(self):
+    self.plans.clear()
+    self.hits = self.misses = 0
+
+  def __str__(self):
+    return "PlanCache(%d/%d plans, %d hits, %d misses)" % (
+        len(self.plans), self.capacity, self.hits, self.misses)
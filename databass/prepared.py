@@ -0,0 +1,91 @@
+"""
+Prepared statements: queries with ? and :name parameter placeholders that
+are parsed, optimized and compiled once, and then executed many times with
+different parameter values.
+
+    stmt = prepare("SELECT a FROM data WHERE a > ? and c = :c")
+    for row in stmt.execute(10, c='x'):
+      print row
+"""
+from exprs import Param
+from ops import Yield
+from optimizer import Optimizer
+from parse_sql import Visitor
+from codecache import CodeCache
+
+
+class PreparedStatement(object):
+  MODES = ("interpreted", "compiled", "vectorized")
+
+  def __init__(self, qstr, mode="compiled", code_cache=None):
+    """
+    @qstr       query string
+    @mode       how execute() runs the query: interpreted, compiled or
+                vectorized
+    @code_cache optional CodeCache to look up the compiled query in
+    """
+    if mode not in self.MODES:
+      raise Exception("Unknown execution mode %s" % mode)
+    visitor = Visitor()
+    self.qstr = qstr
+    self.mode = mode
+    self.plan = Optimizer()(Yield(visitor.parse(qstr)))
+    self.names = visitor.params
+    self.params = self.plan.collect(Param)
+    if code_cache is None:
+      code_cache = CodeCache(capacity=1)
+    self.code_cache = code_cache
+    self.query = None
+
+  @property
+  def nparams(self):
+    return len(self.names)
+
+  def bind(self, *args, **kwargs):
+    """
+    Set the parameters' values.  Positional arguments are assigned to the
+    parameters in the order they appear in the query, and :name parameters
+    may also be set by keyword.
+
+    @return list of the values by parameter index
+    """
+    if len(args) > self.nparams:
+      raise Exception("Expected %d parameters, got %d" % (self.nparams, len(args)))
+    vals = list(args)
+    for name in self.names[len(args):]:
+      if name is None or name not in kwargs:
+        raise Exception("No value bound for parameter %s" % (
+          ":" + name if name else "?%d" % len(vals)))
+      vals.append(kwargs.pop(name))
+    if kwargs:
+      raise Exception("Unknown parameters %s" % ", ".join(sorted(kwargs)))
+
+    for param in self.params:
+      param.v = vals[param.idx]
+    return vals
+
+  def execute(self, *args, **kwargs):
+    """
+    Bind the parameters and run the query
+    @return iterator over the result rows
+    """
+    vals = self.bind(*args, **kwargs)
+    if self.mode == "interpreted":
+      return iter(self.plan)
+    if self.mode == "vectorized":
+      return self.plan.vectorized()
+    if self.query is None:
+      self.query = self.code_cache(self.plan)
+    return self.query(vals)
+
+  __call__ = execute
+
+  def __str__(self):
+    return "PreparedStatement(%s)" % self.qstr
+
+
+def prepare(qstr, mode="compiled", code_cache=None):
+  """
+  @return PreparedStatement for the query string
+  """
+  return PreparedStatement(qstr, mode, code_cache)
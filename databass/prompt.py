@@ -3,6 +3,8 @@ import traceback
 import readline
 import click
 from . import *
+from .plancache import PlanCache
+from .codecache import CodeCache
 
 WELCOMETEXT = """Welcome to DataBass.  
 Type "help" for help, and "q" to exit"""
@@ -13,18 +15,23 @@ List of commands
 
 <query>                           runs query string
 COMPILE [AND RUN] <query>         compile and optionally run query string
+VECTORIZED <query>                run query string in vectorized batch mode
 PARSE [query or expression str]   parse and print AST for expression or query
 TRACE                             print stack trace of last error
 SHOW TABLES                       print list of database tables
+SHOW PLAN CACHE                   print plan cache hit and miss counts
+SHOW CODE CACHE                   print compiled query cache hit and miss counts
 SHOW <tablename>                  print schema for <tablename>
 """
 
-def compile_and_write(plan, fname="./_code.py", funcname="compiled_q"):
-  ctx = Context()
-  plan.produce(ctx)
-  code = ctx.compiler.compile_to_func(funcname)
-  code_w_comments = """'''\n%s\n'''\n\n%s\n""" % (
-      plan.pretty_print(), code)
+def compile_and_write(plan, fname="./_code.py"):
+  """
+  Compile the plan, or look it up in the code cache, and write its code 
+  to a standalone script
+  @return the CompiledQuery
+  """
+  query = code_cache(plan)
+  code = query.source
 
   header = """
 from databass import *
@@ -45,7 +52,7 @@ if __name__ == "__main__":
     out.write(code)
     out.write("\n")
     out.write(footer)
-  return code
+  return query
 
 def parse_and_optimize(qstr):
   plan = parse(qstr)
@@ -58,10 +65,19 @@ def parse_and_optimize(qstr):
   opt.disambiguate_op_attrs(plan)
   return plan
 
+# repeated queries reuse the plans and compiled code of earlier runs
+plan_cache = PlanCache(parse_and_optimize)
+code_cache = CodeCache()
+
 if __name__ == "__main__":
 
   @click.command()
-  def main():
+  @click.option("--code-cache", "cachedir", default=None, 
+      help="directory to persist compiled queries to")
+  def main(cachedir):
+    global code_cache
+    if cachedir:
+      code_cache = CodeCache(cachedir=cachedir)
     print(WELCOMETEXT)
     service_inputs()
 
@@ -101,6 +117,12 @@ if __name__ == "__main__":
       for tablename in _db.tablenames:
         print tablename
       
+    elif cmd.upper().startswith("SHOW PLAN CACHE"):
+      print plan_cache
+
+    elif cmd.upper().startswith("SHOW CODE CACHE"):
+      print code_cache
+
     elif cmd.upper().startswith("SHOW "):
       tname = cmd[len("SHOW "):].strip()
       if tname in _db:
@@ -118,19 +140,18 @@ if __name__ == "__main__":
         cmd = cmd[len("AND RUN "):].strip()
 
       try:
-        plan = parse_and_optimize(cmd)
+        plan = plan_cache(cmd)
         print plan.pretty_print()
-        code = compile_and_write(plan, "./_code.py", "compiled_q")
+        query = compile_and_write(plan, "./_code.py")
         print
-        print code
+        print query.source
         print
         print "wrote compiled query to ./_code.py.  Type `python _code.py` to run it."
 
         if b_run:
           print "Running compiled query"
-          exec(code)
           start = time.clock()
-          for row in compiled_q():
+          for row in query():
             print row
           end = time.clock()
           print "Compiled query took %f seconds" % (end - start)
@@ -138,9 +159,22 @@ if __name__ == "__main__":
       except Exception as err:
         print("ERROR:", err)
 
+    elif cmd.upper().startswith("VECTORIZED "):
+      cmd = cmd[len("VECTORIZED "):].strip()
+      try:
+        plan = plan_cache(cmd)
+        print plan.pretty_print()
+        start = time.clock()
+        for row in plan.vectorized():
+          print row
+        end = time.clock()
+        print "Vectorized query took %f seconds" % (end - start)
+      except Exception as err:
+        print("ERROR:", err)
+
     else:
       try:
-        plan = parse_and_optimize(cmd)
+        plan = plan_cache(cmd)
         print plan.pretty_print()
         start = time.clock()
         for row in plan:
@@ -0,0 +1,333 @@
+"""
+Temporary files for operators whose inputs do not fit in memory: the
+external merge sort that OrderBy uses to sort inputs larger than its
+memory budget, and the hybrid hash table that HashJoin builds.
+
+The module-level `stats` counts the files, rows and bytes that all
+operators have spilled.
+"""
+import marshal
+import cPickle
+import tempfile
+from heapq import merge
+from collections import defaultdict
+from itertools import chain
+from util import sort_order
+
+
+class SpillStats(object):
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.nfiles = 0
+    self.nrows = 0
+    self.nbytes = 0
+
+  def __str__(self):
+    return "SpillStats(%d files, %d rows, %d bytes)" % (
+        self.nfiles, self.nrows, self.nbytes)
+
+stats = SpillStats()
+
+
+class SpillFile(object):
+  """
+  Temporary file of rows, which are written in blocks and read back in the
+  same order.  Blocks are encoded with marshal, which is compact and fast
+  for python's basic types, and blocks with other values are pickled.
+  The file is deleted when it is closed.
+  """
+  BLOCK_SIZE = 4096
+
+  def __init__(self):
+    self.f = tempfile.TemporaryFile()
+    self.block = []
+    self.nrows = 0
+    self.nbytes = 0
+    stats.nfiles += 1
+
+  def append(self, row):
+    self.block.append(row)
+    if len(self.block) >= self.BLOCK_SIZE:
+      self.flush()
+
+  def write(self, rows):
+    """
+    @rows list of rows to append to the file
+    """
+    self.flush()
+    for start in xrange(0, len(rows), self.BLOCK_SIZE):
+      self.write_block(rows[start:start + self.BLOCK_SIZE])
+
+  def flush(self):
+    if self.block:
+      self.write_block(self.block)
+      self.block = []
+
+  def write_block(self, rows):
+    try:
+      data = "M" + marshal.dumps(rows, 2)
+    except ValueError:
+      data = "P" + cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL)
+    self.f.write(data)
+    self.nrows += len(rows)
+    self.nbytes += len(data)
+    stats.nrows += len(rows)
+    stats.nbytes += len(data)
+
+  def __len__(self):
+    return self.nrows + len(self.block)
+
+  def __iter__(self):
+    self.flush()
+    self.f.seek(0)
+    while True:
+      tag = self.f.read(1)
+      if not tag:
+        return
+      if tag == "M":
+        rows = marshal.load(self.f)
+      else:
+        rows = cPickle.load(self.f)
+      for row in rows:
+        yield row
+
+  def close(self):
+    self.f.close()
+
+
+class Desc(object):
+  """
+  Wraps a sort key value so that it compares in descending order
+  """
+  __slots__ = ("v",)
+
+  def __init__(self, v):
+    self.v = v
+
+  def __eq__(self, other):
+    return self.v == other.v
+
+  def __ne__(self, other):
+    return self.v != other.v
+
+  def __lt__(self, other):
+    return other.v < self.v
+
+
+def merge_key(ascdescs):
+  """
+  @ascdescs "asc" or "desc" for each sort key
+  @return function that maps a key tuple to a value that compares in the
+          sort order
+  """
+  descs = [i for i, ascdesc in enumerate(ascdescs) if ascdesc == "desc"]
+  if not descs:
+    return tuple
+
+  def f(key):
+    key = list(key)
+    for i in descs:
+      key[i] = Desc(key[i])
+    return tuple(key)
+  return f
+
+
+class ExternalSort(object):
+  """
+  Sorts rows by precomputed key tuples within a budget of @max_rows rows in
+  memory.  Callers append to the keys and rows lists, and call spill()
+  whenever there are more than @max_rows rows, which sorts them and writes
+  them to a SpillFile as a sorted run.
+
+  Iterating merges the runs and the rows still in memory with a heap, and
+  streams the sorted rows, so a consumer that stops early, such as a Limit,
+  does not read the rest of the runs.  Rows with equal keys are output in
+  the order they were added.
+  """
+
+  def __init__(self, ascdescs, max_rows):
+    """
+    @ascdescs "asc" or "desc" for each sort key
+    @max_rows maximum number of rows to keep in memory
+    """
+    self.ascdescs = ascdescs
+    self.max_rows = max_rows
+    self.keys = []
+    self.rows = []
+    self.runs = []
+
+  @property
+  def nbytes(self):
+    """
+    number of bytes written to the runs' files
+    """
+    return sum(run.nbytes for run in self.runs)
+
+  def sorted_pairs(self):
+    """
+    @return the (key, row) pairs in memory in sort order
+    """
+    keys, rows = self.keys, self.rows
+    return [(keys[i], rows[i]) for i in sort_order(keys, self.ascdescs)]
+
+  def spill(self):
+    run = SpillFile()
+    run.write(self.sorted_pairs())
+    self.runs.append(run)
+    # the callers hold references to the lists, so clear them in place
+    del self.keys[:]
+    del self.rows[:]
+
+  def __iter__(self):
+    if not self.runs:
+      rows = self.rows
+      for i in sort_order(self.keys, self.ascdescs):
+        yield rows[i]
+      return
+
+    runs = [iter(run) for run in self.runs]
+    runs.append(iter(self.sorted_pairs()))
+    # ties are broken by the run's index and the position in the run,
+    # so that the rows themselves are never compared
+    entries = [self.merge_entries(i, run) for i, run in enumerate(runs)]
+    try:
+      for key, i, seq, row in merge(*entries):
+        yield row
+    finally:
+      for run in self.runs:
+        run.close()
+      self.runs = []
+
+  def merge_entries(self, i, run):
+    mkey = merge_key(self.ascdescs)
+    for seq, (key, row) in enumerate(run):
+      yield mkey(key), i, seq, row
+
+
+class HybridHashTable(object):
+  """
+  Build side of a hybrid hash join, which holds at most @max_rows rows in
+  memory.  Rows are added with add(key, row) into `index`, a dict from 
+  join key to the list of rows with that key.
+
+  Once there are more than @max_rows rows, the table is split into FANOUT
+  partitions by the hash of the key.  Partition 0 stays in memory as the 
+  index, unless it also grows beyond @max_rows rows, and the others are 
+  written to SpillFiles.  Once the table is `spilled`, probe rows are 
+  looked up with lookup(), which writes the probe rows of the spilled 
+  partitions to their own SpillFiles, and spilled_matches() joins each 
+  pair of spilled partitions afterwards with a new HybridHashTable, which 
+  partitions them again if they are still too large.  Each level 
+  partitions by a different hash function, and after MAX_LEVEL levels, 
+  partitions are kept in memory regardless, since their rows may all have
+  the same key.
+  """
+  FANOUT = 8
+  MAX_LEVEL = 4
+
+  def __init__(self, max_rows, level=0):
+    """
+    @max_rows maximum number of rows to keep in memory
+    @level    number of times the rows have been partitioned
+    """
+    self.max_rows = max_rows
+    self.level = level
+    self.index = defaultdict(list)
+    self.nrows = 0
+    # build and probe side partitions, or None until the table spills.
+    # The in-memory partition 0 is self.index
+    self.parts = None
+    self.probe_parts = None
+
+  @property
+  def spilled(self):
+    return self.parts is not None
+
+  def partition(self, key):
+    return hash((self.level, key)) % self.FANOUT
+
+  def add(self, key, row):
+    if self.parts is not None:
+      p = self.partition(key)
+      if p != 0 or self.index is None:
+        self.parts[p].append((key, row))
+        return
+
+    self.index[key].append(row)
+    self.nrows += 1
+    if self.nrows > self.max_rows and self.level < self.MAX_LEVEL:
+      self.spill()
+
+  def spill(self):
+    """
+    Partition the table if it is in memory, and otherwise spill the
+    in-memory partition 0
+    """
+    if self.parts is None:
+      self.parts = [SpillFile() for p in xrange(self.FANOUT)]
+      self.probe_parts = [SpillFile() for p in xrange(self.FANOUT)]
+      index, self.index = self.index, defaultdict(list)
+      self.nrows = 0
+      for key, rows in index.iteritems():
+        p = self.partition(key)
+        if p == 0:
+          self.index[key] = rows
+          self.nrows += len(rows)
+        else:
+          self.parts[p].write([(key, row) for row in rows])
+      if self.nrows <= self.max_rows:
+        return
+
+    self.parts[0].write([(key, row) 
+      for key, rows in self.index.iteritems() for row in rows])
+    self.index = None
+    self.nrows = 0
+
+  def lookup(self, key, row):
+    """
+    Probe a table that has spilled.  
+
+    @return the rows that match @key, or None if @key's partition was 
+            spilled, in which case the probe @row is spilled to be joined
+            by spilled_matches()
+    """
+    p = self.partition(key)
+    if p == 0 and self.index is not None:
+      return self.index.get(key)
+    if len(self.parts[p]):
+      # the rows may be reused by the probe side, so copy them
+      self.probe_parts[p].append((key, tuple(row)))
+    return None
+
+  def spilled_matches(self):
+    """
+    Join the spilled partitions, once all probe rows have been looked up.
+    @return iterator over (probe row, list of matching rows)
+    """
+    if self.parts is None:
+      return
+    try:
+      for build, probe in zip(self.parts, self.probe_parts):
+        if not len(probe):
+          continue
+        table = HybridHashTable(self.max_rows, self.level + 1)
+        for key, row in build:
+          table.add(key, row)
+        build.close()
+
+        index = table.index
+        for key, row in probe:
+          if table.spilled:
+            matches = table.lookup(key, row)
+          else:
+            matches = index.get(key)
+          if matches:
+            yield row, matches
+        probe.close()
+        for match in table.spilled_matches():
+          yield match
+    finally:
+      for f in chain(self.parts, self.probe_parts):
+        f.close()
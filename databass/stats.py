@@ -1,12 +1,527 @@
+"""
+Table statistics used by the optimizer's cost model.
+
+Stats are computed once per table when the table is registered in the
+Database (see Table.stats), and then looked up by attribute:
+
+    stat = table.stats[attr]
+    stat.card, stat.nulls, stat.ndv, stat.min, stat.max, stat.hist
+
+Large tables are summarized with sketches instead of exact statistics
+(see Stats.SKETCH_THRESHOLD and SketchAttrStats).
+"""
+import numpy as np
+from itertools import islice, chain
+from tuples import to_column
+
+
+def is_null(col):
+  """
+  @col NumPy array
+  @return boolean mask of the NULL (None or NaN) values in col
+  """
+  if col.dtype.kind == "f":
+    return np.isnan(col)
+  if col.dtype.kind == "O":
+    return np.array([v is None or (isinstance(v, float) and v != v)
+                     for v in col.tolist()], dtype=np.bool_)
+  return np.zeros(len(col), dtype=np.bool_)
+
+
+def sketch_column(attr, vals):
+  """
+  Numeric values are sketched as floats, so that the same value is hashed
+  the same way in every chunk of a row-oriented table.  Other values are
+  sketched as python objects.
+
+  @attr Attr of the values
+  @vals sequence of python values
+  @return NumPy array of @vals
+  """
+  if attr.typ == "num":
+    try:
+      return np.array(vals, dtype=np.float64)
+    except (TypeError, ValueError):
+      pass
+  col = np.empty(len(vals), dtype=object)
+  col[:] = vals
+  return col
+
+
+class Histogram(object):
+  """
+  Equi-depth histogram over a numeric attribute.  Bucket i covers the
+  values in [lows[i], highs[i]].  Each bucket contains roughly the same
+  number of values, so buckets are narrow where the data is dense.  All
+  copies of a value are in the same bucket, and a value that is frequent 
+  enough to fill a bucket gets a bucket of its own.
+  """
+  def __init__(self, lows, highs, counts, ndvs):
+    """
+    @lows, @highs  sorted arrays of the bucket boundaries
+    @counts        number of values in each bucket
+    @ndvs          number of distinct values in each bucket
+    """
+    self.lows = lows
+    self.highs = highs
+    self.counts = counts
+    self.ndvs = ndvs
+    self.total = float(counts.sum())
+
+  @staticmethod
+  def from_values(vals, nbuckets):
+    """
+    @vals sorted array of non-null numeric values
+    """
+    n = len(vals)
+    if not n:
+      return None
+    depth = max(1, -(-n // nbuckets))
+    bounds = []
+    i = 0
+    while i < n:
+      j = min(n, i + depth)
+      first = np.searchsorted(vals, vals[j-1], side="left")
+      last = np.searchsorted(vals, vals[j-1], side="right")
+      if first > i and last - first >= depth:
+        # end the bucket before the next frequent value
+        j = first
+      else:
+        j = last
+      bounds.append((i, j))
+      i = j
+
+    starts = np.array([b[0] for b in bounds])
+    ends = np.array([b[1] for b in bounds])
+    newval = np.ones(n, dtype=np.int64)
+    newval[1:] = vals[1:] != vals[:-1]
+    return Histogram(vals[starts], vals[ends - 1], ends - starts, 
+        np.add.reduceat(newval, starts))
+
+  @property
+  def nbuckets(self):
+    return len(self.counts)
+
+  def selectivity_eq(self, v):
+    """
+    Fraction of values equal to v, assuming the distinct values in a bucket
+    are equally frequent
+    """
+    b = np.searchsorted(self.lows, v, side="right") - 1
+    if b < 0 or v > self.highs[b]:
+      return 0.0
+    return self.counts[b] / float(self.ndvs[b]) / self.total
+
+  def selectivity_range(self, lo=None, hi=None):
+    """
+    Fraction of values in [lo, hi], assuming values are uniformly
+    distributed within a bucket.  None means unbounded.
+    """
+    lo = self.lows[0] if lo is None else lo
+    hi = self.highs[-1] if hi is None else hi
+    n = 0.0
+    for l, u, count, ndv in zip(self.lows, self.highs, self.counts, self.ndvs):
+      if u < lo or l > hi:
+        continue
+      if l >= lo and u <= hi:
+        n += count
+        continue
+      overlap = (min(u, hi) - max(l, lo)) / float(u - l)
+      n += count * max(overlap, 1.0 / ndv)
+    return min(1.0, n / self.total)
+
+
+#
+# Sketches used to compute statistics of large tables in a single pass
+# with a fixed amount of memory per attribute
+#
+
+def hash_values(col):
+  """
+  Vectorized 64-bit hash of each value in @col, using the splitmix64 
+  finalizer to mix the bits of the values (or of Python's hash for 
+  non-numeric values)
+
+  @col NumPy array
+  @return uint64 array
+  """
+  if col.dtype.kind in "biu":
+    h = col.astype(np.int64).view(np.uint64)
+  elif col.dtype.kind == "f":
+    h = col.astype(np.float64).view(np.uint64)
+  else:
+    h = np.array([hash(v) for v in col.tolist()], dtype=np.int64).view(np.uint64)
+  h = h + np.uint64(0x9E3779B97F4A7C15)
+  h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+  h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+  return h ^ (h >> np.uint64(31))
+
+
+class HyperLogLog(object):
+  """
+  Estimates the number of distinct values using 2^p one-byte registers.
+  The standard error is about 1.04 / sqrt(2^p)
+  """
+  def __init__(self, p=12):
+    self.p = p
+    self.m = 1 << p
+    self.registers = np.zeros(self.m, dtype=np.uint8)
+
+  def add_hashes(self, h):
+    """
+    @h uint64 array of hashed values
+    """
+    idx = (h >> np.uint64(64 - self.p)).astype(np.int64)
+    rest = h & np.uint64((1 << (64 - self.p)) - 1)
+    # bit length of rest; frexp is only exact for values below 2^53
+    hi = (rest >> np.uint64(11)).astype(np.float64)
+    lo = (rest & np.uint64(0x7ff)).astype(np.float64)
+    nbits = np.where(hi > 0, np.frexp(hi)[1] + 11, np.frexp(lo)[1])
+    # position of the leftmost 1 bit
+    rank = (64 - self.p - nbits + 1).astype(np.uint8)
+
+    # once the registers fill up, few values increase them, so only
+    # update the registers using those values
+    larger = rank > self.registers[idx]
+    np.maximum.at(self.registers, idx[larger], rank[larger])
+
+  def merge(self, hll):
+    self.registers = np.maximum(self.registers, hll.registers)
+
+  def estimate(self):
+    alpha = 0.7213 / (1 + 1.079 / self.m)
+    est = alpha * self.m * self.m / np.sum(2.0 ** -self.registers.astype(np.float64))
+    zeros = np.count_nonzero(self.registers == 0)
+    if est <= 2.5 * self.m and zeros:
+      # linear counting is more accurate for small cardinalities
+      est = self.m * np.log(self.m / float(zeros))
+    return int(round(est))
+
+
+class CountMin(object):
+  """
+  Count-Min sketch that estimates the frequency of a value.  Estimates 
+  never undercount, and overcount by at most e/width * total with 
+  probability 1 - exp(-depth).
+  """
+  def __init__(self, logwidth=14, depth=4):
+    if logwidth * depth > 64:
+      raise Exception("CountMin: needs logwidth * depth <= 64 hash bits")
+    self.logwidth = logwidth
+    self.width = 1 << logwidth
+    self.depth = depth
+    self.counts = np.zeros((depth, self.width), dtype=np.int64)
+
+  def cells(self, h, i):
+    # each row uses a different slice of the hash's bits
+    return (h.view(np.int64) >> (i * self.logwidth)) & (self.width - 1)
+
+  def add_hashes(self, h):
+    for i in xrange(self.depth):
+      self.counts[i] += np.bincount(self.cells(h, i), minlength=self.width)
+
+  def merge(self, cm):
+    self.counts += cm.counts
+
+  def estimate(self, h):
+    """
+    Count-Mean-Min estimate: subtract the expected number of collisions 
+    from each row's count, which is more accurate for infrequent values.
+
+    @h uint64 array of hashed values
+    @return array of estimated frequencies
+    """
+    total = self.counts[0].sum()
+    counts = np.array([self.counts[i][self.cells(h, i)] 
+                       for i in xrange(self.depth)], dtype=np.float64)
+    noise = (total - counts) / (self.width - 1)
+    est = np.median(counts - noise, axis=0)
+    return np.clip(est, 0, counts.min(axis=0))
+
+
+class Reservoir(object):
+  """
+  Uniform random sample of at most @size values from a stream 
+  """
+  def __init__(self, size=2048):
+    self.size = size
+    self.sample = None
+    self.n = 0
+
+  def add(self, vals):
+    """
+    @vals NumPy array of the next values in the stream
+    """
+    if self.sample is None:
+      self.sample = vals[:self.size].copy()
+    elif len(self.sample) < self.size:
+      self.sample = np.concatenate([self.sample, vals[:self.size - len(self.sample)]])
+    nfilled = len(self.sample) - min(self.n, self.size)
+    self.n += nfilled
+    vals = vals[nfilled:]
+    if not len(vals):
+      return
+
+    # the i'th value of the stream replaces a random sample with 
+    # probability size / (i+1)
+    pos = self.n + np.arange(len(vals))
+    slots = (np.random.random(len(vals)) * (pos + 1)).astype(np.int64)
+    keep = slots < self.size
+    self.sample[slots[keep]] = vals[keep]
+    self.n += len(vals)
+
+
+class AttrStats(object):
+  """
+  Statistics of a single attribute
+  """
+  def __init__(self, card, nulls, ndv, min=None, max=None, hist=None, 
+               is_sorted=False):
+    """
+    @card      number of rows in the table
+    @nulls     number of NULL values
+    @ndv       number of distinct non-NULL values
+    @min       smallest non-NULL value
+    @max       largest non-NULL value
+    @hist      equi-depth Histogram for numeric attributes, otherwise None
+    @is_sorted whether the non-NULL values of a numeric attribute are in 
+               ascending order in the table
+    """
+    self.card = card
+    self.nulls = nulls
+    self.ndv = ndv
+    self.min = min
+    self.max = max
+    self.hist = hist
+    self.is_sorted = is_sorted
+
+  @staticmethod
+  def from_column(col, nbuckets):
+    """
+    @col NumPy array containing the attribute's values
+    """
+    card = len(col)
+    nulls = is_null(col)
+    vals = col[~nulls]
+    if not len(vals):
+      return AttrStats(card, card, 0)
+
+    if vals.dtype.kind in "biuf":
+      is_sorted = bool(np.all(vals[1:] >= vals[:-1]))
+      if not is_sorted:
+        vals = np.sort(vals)
+      ndv = int(np.count_nonzero(vals[1:] != vals[:-1]) + 1)
+      hist = Histogram.from_values(vals, nbuckets)
+      return AttrStats(card, card - len(vals), ndv,
+          vals[0].item(), vals[-1].item(), hist, is_sorted)
+
+    vals = vals.tolist()
+    return AttrStats(card, card - len(vals), len(set(vals)),
+        min(vals), max(vals))
+
+  @property
+  def domain(self):
+    return [self.min, self.max]
+
+  def selectivity_eq(self, v=None):
+    """
+    Fraction of rows whose value equals v.  If v is unknown (e.g., for
+    join predicates), assume each distinct value is equally frequent.
+    """
+    if not self.card or not self.ndv:
+      return 0.0
+    notnull = (self.card - self.nulls) / float(self.card)
+    if v is None or self.hist is None:
+      return notnull / self.ndv
+    return notnull * self.hist.selectivity_eq(v)
+
+  def selectivity_range(self, lo=None, hi=None):
+    """
+    Fraction of rows whose value is in [lo, hi]
+    """
+    if not self.card or not self.ndv:
+      return 0.0
+    notnull = (self.card - self.nulls) / float(self.card)
+    if self.hist is None:
+      return notnull / 3.0
+    return notnull * self.hist.selectivity_range(lo, hi)
+
+  def __str__(self):
+    return "card=%s nulls=%s ndv=%s min=%s max=%s" % (
+        self.card, self.nulls, self.ndv, self.min, self.max)
+
+
+class SketchAttrStats(AttrStats):
+  """
+  Approximate statistics of a single attribute, computed in one pass over
+  the attribute's values.  The distinct count comes from a HyperLogLog 
+  sketch, the frequency of a given value from a Count-Min sketch, and the 
+  histogram is built from a reservoir sample.  The row count, NULL count 
+  and min/max are exact.
+  """
+
+  # number of values read at a time
+  CHUNK_SIZE = 65536
+
+  def __init__(self, card, nulls, ndv, min, max, hist, cm, dtype, 
+               is_sorted=False):
+    super(SketchAttrStats, self).__init__(
+        card, nulls, ndv, min, max, hist, is_sorted)
+    self.cm = cm
+    self.dtype = dtype
+
+  @staticmethod
+  def from_column(col, nbuckets):
+    sketch = AttrSketch()
+    for start in xrange(0, len(col), SketchAttrStats.CHUNK_SIZE):
+      sketch.add(col[start:start + SketchAttrStats.CHUNK_SIZE])
+    return sketch.stats(nbuckets)
+
+  def selectivity_eq(self, v=None):
+    if v is None:
+      return super(SketchAttrStats, self).selectivity_eq(v)
+    try:
+      h = hash_values(np.array([v], dtype=self.dtype))
+    except (TypeError, ValueError):
+      return 0.0
+    return self.cm.estimate(h)[0] / float(self.card)
+
+
+class AttrSketch(object):
+  """
+  Sketches of a single attribute that are updated a chunk of values at a
+  time, so that a table's attributes can be summarized together in one 
+  pass over its rows.  See SketchAttrStats
+  """
+  def __init__(self):
+    self.hll = HyperLogLog()
+    self.cm = CountMin()
+    self.sample = Reservoir()
+    self.card = 0
+    self.nulls = 0
+    self.lo = self.hi = None
+    self.dtype = None
+    # whether the values so far are numeric and in ascending order, and 
+    # the last one
+    self.is_sorted = True
+    self.last = None
+
+  def add(self, chunk):
+    """
+    @chunk NumPy array of the attribute's next values
+    """
+    if self.dtype is None:
+      self.dtype = chunk.dtype
+    self.is_sorted = self.is_sorted and chunk.dtype.kind in "biuf"
+    nchunk = len(chunk)
+    self.card += nchunk
+    chunk = chunk[~is_null(chunk)]
+    self.nulls += nchunk - len(chunk)
+    if not len(chunk):
+      return
+    h = hash_values(chunk)
+    self.hll.add_hashes(h)
+    self.cm.add_hashes(h)
+    self.sample.add(chunk)
+    cmin, cmax = chunk.min(), chunk.max()
+    self.lo = cmin if self.lo is None else min(self.lo, cmin)
+    self.hi = cmax if self.hi is None else max(self.hi, cmax)
+    if self.is_sorted:
+      self.is_sorted = bool(np.all(chunk[1:] >= chunk[:-1])) and \
+          (self.last is None or chunk[0] >= self.last)
+      self.last = chunk[-1]
+
+  def stats(self, nbuckets):
+    """
+    @return SketchAttrStats of the values added so far
+    """
+    card, nulls = self.card, self.nulls
+    if nulls == card:
+      return AttrStats(card, card, 0)
+    lo, hi, hist = self.lo, self.hi, None
+    if self.dtype.kind in "biuf":
+      hist = Histogram.from_values(np.sort(self.sample.sample), nbuckets)
+      lo, hi = lo.item(), hi.item()
+    ndv = max(1, min(self.hll.estimate(), card - nulls))
+    return SketchAttrStats(card, nulls, ndv, lo, hi, hist, self.cm, 
+        self.dtype, self.is_sorted)
+
+
 class Stats(object):
-  
-  # XXX: Edit this to compute the table cardinality
+  """
+  Per-attribute statistics of a table
+  """
+
+  # target number of buckets in each numeric attribute's histogram
+  NBUCKETS = 20
+
+  # tables with more rows than this are summarized using sketches
+  # (see SketchAttrStats) rather than exact statistics
+  SKETCH_THRESHOLD = 100000
+
   def __init__(self, table):
     self.table = table
-    self.card = 10
+    self.attrs = {}
+    self.card = 0
+    if hasattr(table, "columns"):
+      self.from_columns(table)
+    else:
+      self.from_rows(table)
 
-  # XXX: edit this to return the domain of the attr
-  def __getitem__(self, attr):
-    return [0, 1]
+  def from_columns(self, table):
+    """
+    Columnar tables store each attribute's values as an array, so each
+    attribute is summarized on its own
+    """
+    for attr in table.schema:
+      col = table.column(attr.aname)
+      self.card = len(col)
+      if self.card > self.SKETCH_THRESHOLD:
+        stat = SketchAttrStats.from_column(col, self.NBUCKETS)
+      else:
+        stat = AttrStats.from_column(col, self.NBUCKETS)
+      self.attrs[attr.aname] = stat
+
+  def from_rows(self, table):
+    """
+    Other tables are read in one pass over their rows, a chunk at a time.  
+    The chunks are kept until the table has more than SKETCH_THRESHOLD rows,
+    and then they and the rest of the rows are added to each attribute's 
+    AttrSketch, so memory use stays fixed for large tables.
+    """
+    attrs = table.schema.attrs
+    rows = table.iter_rows()
+    chunks = []
+    sketches = None
+    while True:
+      chunk = list(islice(rows, SketchAttrStats.CHUNK_SIZE))
+      if not chunk:
+        break
+      self.card += len(chunk)
+      chunks.append(chunk)
+      if sketches is None:
+        if self.card <= self.SKETCH_THRESHOLD:
+          continue
+        sketches = [AttrSketch() for attr in attrs]
+      for chunk in chunks:
+        for attr, sketch, vals in zip(attrs, sketches, zip(*chunk)):
+          sketch.add(sketch_column(attr, vals))
+      chunks = []
 
+    if sketches is not None:
+      for attr, sketch in zip(attrs, sketches):
+        self.attrs[attr.aname] = sketch.stats(self.NBUCKETS)
+      return
+    rows = list(chain.from_iterable(chunks))
+    for i, attr in enumerate(attrs):
+      col = to_column([row[i] for row in rows])
+      self.attrs[attr.aname] = AttrStats.from_column(col, self.NBUCKETS)
 
+  def __getitem__(self, attr):
+    """
+    @attr Attr instance or attribute name
+    """
+    aname = getattr(attr, "aname", attr)
+    if aname not in self.attrs:
+      raise Exception("Stats: no attribute named %s in %s" % (aname, self.table.schema))
+    return self.attrs[aname]
@@ -1,6 +1,8 @@
 import pandas
 import numbers
 import os
+import numpy as np
+from itertools import izip
 from stats import Stats
 from tuples import *
 from exprs import Attr
@@ -13,6 +15,7 @@ class Table(object):
   """
   def __init__(self, schema):
     self.schema = schema
+    self._stats = None
 
   @staticmethod
   def from_rows(rows):
@@ -23,12 +26,38 @@ class Table(object):
 
   @property
   def stats(self):
-    return Stats(self)
+    """
+    Statistics are computed the first time they are needed (the Database 
+    does so when the table is registered) and then reused.
+    """
+    if getattr(self, "_stats", None) is None:
+      self._stats = Stats(self)
+    return self._stats
 
   def col_values(self, field):
     idx = self.schema.idx(Attr(field.aname))
     return [row[idx] for row in self]
 
+  def column(self, aname):
+    """
+    @aname attribute name
+    @return NumPy array of the attribute's values
+    """
+    return to_column(self.col_values(Attr(aname)))
+
+  def iter_rows(self, idxs=None):
+    """
+    Iterate over the raw list of attribute values of each row.
+    Subclasses can override this to avoid constructing a ListTuple per row.
+
+    @idxs optional list of the indexes of the attributes to return
+    """
+    for tup in self:
+      if idxs is None:
+        yield tup.row
+      else:
+        yield [tup.row[i] for i in idxs]
+
   def __iter__(self):
     yield
 
@@ -43,7 +72,89 @@ class InMemoryTable(Table):
     self.attr_to_idx = { a.aname: i 
         for i,a in enumerate(self.schema)}
 
+  def iter_rows(self, idxs=None):
+    if idxs is None:
+      return iter(self.rows)
+    return ([row[i] for i in idxs] for row in self.rows)
+
   def __iter__(self):
     for row in self.rows:
       yield ListTuple(self.schema, row)
 
+
+class ColumnarTable(Table):
+  """
+  Column-oriented table that stores one NumPy array per attribute.
+  Numeric attributes keep their native dtypes; only string attributes
+  are stored as object arrays.
+
+  The table can still be iterated row-wise (e.g., by Scan), in which case
+  rows are materialized a chunk at a time.  Operators that understand
+  columns can instead access the arrays directly via column()/columns.
+  """
+
+  # number of rows converted from arrays to python values at a time
+  # when iterating row-wise
+  CHUNK_SIZE = 4096
+
+  def __init__(self, schema, columns):
+    """
+    @schema  table schema
+    @columns list of 1-d NumPy arrays, one per attribute in schema order.
+             All arrays must have the same length.
+    """
+    super(ColumnarTable, self).__init__(schema)
+    self.columns = list(columns)
+    if len(self.columns) != len(self.schema.attrs):
+      raise Exception("ColumnarTable: expected %d columns, got %d" % (
+        len(self.schema.attrs), len(self.columns)))
+    lens = set(len(col) for col in self.columns)
+    if len(lens) > 1:
+      raise Exception("ColumnarTable: columns have different lengths %s" % lens)
+    self.nrows = lens.pop() if lens else 0
+    self.attr_to_idx = { a.aname: i 
+        for i,a in enumerate(self.schema)}
+
+  @staticmethod
+  def from_dataframe(schema, df):
+    """
+    Build a table from a pandas DataFrame whose columns are named after
+    the attributes in @schema
+    """
+    columns = []
+    for attr in schema:
+      col = df[attr.aname].values
+      if attr.typ != "num" and col.dtype != np.object_:
+        col = col.astype(np.object_)
+      columns.append(np.ascontiguousarray(col))
+    return ColumnarTable(schema, columns)
+
+  def __len__(self):
+    return self.nrows
+
+  def column(self, aname):
+    """
+    @aname attribute name
+    @return the NumPy array that stores the attribute's values
+    """
+    if aname not in self.attr_to_idx:
+      raise Exception("ColumnarTable: no attribute named %s" % aname)
+    return self.columns[self.attr_to_idx[aname]]
+
+  def col_values(self, field):
+    return self.column(field.aname).tolist()
+
+  def iter_rows(self, idxs=None):
+    n = self.CHUNK_SIZE
+    columns = self.columns
+    if idxs is not None:
+      # only the requested columns are converted to python values
+      columns = [columns[i] for i in idxs]
+    for start in xrange(0, self.nrows, n):
+      chunk = [col[start:start+n].tolist() for col in columns]
+      for vals in izip(*chunk):
+        yield list(vals)
+
+  def __iter__(self):
+    for row in self.iter_rows():
+      yield ListTuple(self.schema, row)
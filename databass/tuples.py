@@ -1,3 +1,5 @@
+import numpy as np
+
 class ListTuple(object):
   """
   A tuple consists of a schema (should be same schema as the containing Table)
@@ -28,3 +30,141 @@ class ListTuple(object):
   def __str__(self):
     return "(%s)" % ", ".join(map(str, self.row))
 
+
+
+def as_column(v, n):
+  """
+  Turn the result of a vectorized expression into a NumPy array of length @n.
+  Expressions over only literals evaluate to scalars, which are broadcast.
+  """
+  if isinstance(v, np.ndarray):
+    return v
+  if isinstance(v, basestring) or v is None:
+    col = np.empty(n, dtype=object)
+  else:
+    col = np.empty(n, dtype=np.array(v).dtype)
+  col[:] = v
+  return col
+
+def to_column(vals):
+  """
+  Turn a list of python values into a NumPy array.  Strings, Nones and
+  mixed-type values are kept as python objects so that the column 
+  round-trips to the same python values.
+  """
+  col = np.array(vals)
+  if (col.dtype.kind in "SUO" or col.ndim != 1 or 
+      len(set(map(type, vals))) > 1):
+    col = np.empty(len(vals), dtype=object)
+    col[:] = vals
+  return col
+
+def truthy(v):
+  """
+  Vectorized version of Python's truth test.
+  """
+  if isinstance(v, np.ndarray):
+    if v.dtype == np.bool_:
+      return v
+    return v.astype(np.bool_)
+  return bool(v)
+
+
+class ColumnBatch(object):
+  """
+  A batch of rows stored column-wise, used by the vectorized execution mode.
+  cols contains one column per attribute in the schema, as a 1-d NumPy array.
+  """
+  # default number of rows per batch
+  SIZE = 4096
+
+  def __init__(self, schema, cols, n=None):
+    self.schema = schema
+    self.cols = cols
+    if n is None:
+      n = len(cols[0]) if cols else 0
+    self.n = n
+
+  @staticmethod
+  def from_rows(schema, rows):
+    """
+    @rows list of lists of attribute values
+    """
+    if rows:
+      cols = [to_column(list(vals)) for vals in zip(*rows)]
+    else:
+      cols = [np.empty(0, dtype=object) for a in schema.attrs]
+    return ColumnBatch(schema, cols, len(rows))
+
+  @staticmethod
+  def concat(schema, batches):
+    """
+    Concatenate a list of batches that share the same schema into one batch
+    """
+    batches = list(batches)
+    if not batches:
+      return ColumnBatch.from_rows(schema, [])
+    if len(batches) == 1:
+      return ColumnBatch(schema, batches[0].cols, batches[0].n)
+    cols = []
+    for i in xrange(len(schema.attrs)):
+      cols.append(np.concatenate([b.cols[i] for b in batches]))
+    return ColumnBatch(schema, cols, sum(b.n for b in batches))
+
+  def __len__(self):
+    return self.n
+
+  def take(self, idxs):
+    """
+    @idxs integer index array or boolean mask
+    @return new batch that only contains the selected rows
+    """
+    cols = [col[idxs] for col in self.cols]
+    if isinstance(idxs, np.ndarray) and idxs.dtype == np.bool_:
+      n = int(idxs.sum())
+    else:
+      n = len(idxs)
+    return ColumnBatch(self.schema, cols, n)
+
+  def slice(self, start, end):
+    end = min(end, self.n)
+    return ColumnBatch(self.schema, [col[start:end] for col in self.cols], max(0, end - start))
+
+  def iter_rows(self):
+    """
+    Iterate over each row in the batch as a list of python values
+    """
+    if not self.cols:
+      for i in xrange(self.n):
+        yield []
+      return
+    cols = [col.tolist() for col in self.cols]
+    for vals in zip(*cols):
+      yield list(vals)
+
+
+def group_ids(cols):
+  """
+  Assign a dense group id to each row based on its values in @cols.
+
+  @cols list of NumPy arrays of the same length
+  @return (array of group ids, number of groups)
+  """
+  n = len(cols[0]) if cols else 0
+  ids = np.zeros(n, dtype=np.int64)
+  ngroups = 1 if n else 0
+  for col in cols:
+    try:
+      uniq, codes = np.unique(col, return_inverse=True)
+      ncodes = len(uniq)
+    except TypeError:
+      # values that can't be sorted are assigned codes through a dict
+      seen = {}
+      codes = np.array([seen.setdefault(v, len(seen)) for v in col.tolist()],
+          dtype=np.int64)
+      ncodes = len(seen)
+    ids = ids * ncodes + codes
+    # renumber so that the ids stay dense and small
+    uniq, ids = np.unique(ids, return_inverse=True)
+    ngroups = len(uniq)
+  return ids, ngroups
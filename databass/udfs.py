@@ -20,6 +20,17 @@ class UDF(object):
     return False
 
 class AggUDF(UDF):
+  """
+  Aggregate UDF.  f takes one column (list of values) per argument.
+
+  GroupBy computes aggregates over partial states: it keeps one state per 
+  group, created by init_state(), folds each input row into it with 
+  update_state(), combines the states of partial aggregates with 
+  merge_state(), and calls finalize_state() once the input is exhausted.  
+  Since f needs whole columns, the state of an AggUDF simply collects the 
+  argument values.  See IncrementalAggUDF for aggregates that keep a small
+  running state instead.
+  """
   def __init__(self, name, nargs, f=None):
     UDF.__init__(self, name, nargs)
     self.f = f
@@ -28,14 +39,93 @@ class AggUDF(UDF):
   def is_agg(self):
     return True
 
+  def init_state(self):
+    return []
+
+  def update_state(self, state, *vals):
+    state.append(vals)
+    return state
+
+  def merge_state(self, state1, state2):
+    state1.extend(state2)
+    return state1
+
+  def finalize_state(self, state):
+    if not state:
+      return self(*[[] for i in xrange(self.nargs)])
+    return self(*zip(*state))
+
+  def group_states(self, starts, ends, *cols):
+    """
+    Vectorized counterpart of update_state().  
+
+    @starts, @ends group i's argument values are cols[j][starts[i]:ends[i]]
+    @cols  one NumPy array per argument, sorted by group
+    @return list containing each group's state
+    """
+    cols = [col.tolist() for col in cols]
+    return [zip(*[col[s:e] for col in cols]) for s, e in zip(starts, ends)]
+
   def __call__(self, *args):
     if len(args) != self.nargs:
       raise Exception("Number of arguments did not match expected number.  %s != %s" % (len(args), self.nargs))
-    if not all(isinstance(arg, list) or isinstance(arg, tuple) for arg in args):
+    if not all(isinstance(arg, (list, tuple, np.ndarray)) for arg in args):
       print args
       raise Exception("AggUDF expects each argument to be a column.")
     return self.f(*args)
 
+class IncrementalAggUDF(AggUDF):
+  """
+  Aggregate UDF defined by callables over a partial state:
+
+    init()                  returns the state of an empty group
+    update(state, *vals)    returns the state after adding one row's arguments
+    merge(state1, state2)   returns the state that combines two partial states
+    finalize(state)         returns the aggregate's value
+
+  States should be treated as immutable values, e.g., numbers or tuples.
+
+  group_states(starts, ends, *cols) optionally computes the states of many
+  groups at once from NumPy arrays (see AggUDF.group_states).  By default, 
+  vectorized execution calls update() on each value.
+  """
+  def __init__(self, name, nargs, init, update, merge, finalize, group_states=None):
+    AggUDF.__init__(self, name, nargs, self.aggregate)
+    self.init = init
+    self.update = update
+    self.merge = merge
+    self.finalize = finalize
+    self.vgroup_states = group_states
+
+  def aggregate(self, *cols):
+    state = self.init()
+    for vals in zip(*cols):
+      state = self.update(state, *vals)
+    return self.finalize(state)
+
+  def init_state(self):
+    return self.init()
+
+  def update_state(self, state, *vals):
+    return self.update(state, *vals)
+
+  def merge_state(self, state1, state2):
+    return self.merge(state1, state2)
+
+  def finalize_state(self, state):
+    return self.finalize(state)
+
+  def group_states(self, starts, ends, *cols):
+    if self.vgroup_states:
+      return self.vgroup_states(starts, ends, *cols)
+    states = []
+    for vals in AggUDF.group_states(self, starts, ends, *cols):
+      state = self.init()
+      for v in vals:
+        state = self.update(state, *v)
+      states.append(state)
+    return states
+
 class ScalarUDF(UDF):
   def __init__(self, name, nargs, f=None):
     UDF.__init__(self, name, nargs)
@@ -81,14 +171,72 @@ class UDFRegistry(object):
     raise Exception("Could not find UDF named %s" % name)
 
 
+#
+# Built-in aggregates
+#
+
+def std_update(state, v):
+  """
+  std state is (count, mean, sum of squared differences from the mean), 
+  updated using Welford's method
+  """
+  n, mean, m2 = state
+  n += 1
+  delta = v - mean
+  mean += delta / float(n)
+  return (n, mean, m2 + delta * (v - mean))
+
+def std_merge(state1, state2):
+  n1, mean1, m21 = state1
+  n2, mean2, m22 = state2
+  n = n1 + n2
+  if not n:
+    return state1
+  delta = mean2 - mean1
+  mean = mean1 + delta * n2 / float(n)
+  return (n, mean, m21 + m22 + delta * delta * n1 * n2 / float(n))
+
+def std_group_states(starts, ends, col):
+  counts = ends - starts
+  col = col.astype(np.float64)
+  means = np.add.reduceat(col, starts) / counts
+  devs = col - np.repeat(means, counts)
+  m2s = np.add.reduceat(devs * devs, starts)
+  return zip(counts.tolist(), means.tolist(), m2s.tolist())
+
+def make_std(name):
+  return IncrementalAggUDF(name, 1,
+      init=lambda: (0, 0.0, 0.0),
+      update=std_update,
+      merge=std_merge,
+      finalize=lambda (n, mean, m2): (m2 / n) ** 0.5,
+      group_states=std_group_states)
+
+
 # Prepopulate registry with simple functions
 registry = UDFRegistry.registry()
 registry.add(ScalarUDF("lower", 1, lambda s: str(s).lower()))
-registry.add(AggUDF("avg", 1, np.mean))
-registry.add(AggUDF("count", 1, len))
-registry.add(AggUDF("sum", 1, np.sum))
-registry.add(AggUDF("std", 1, np.std))
-registry.add(AggUDF("stddev", 1, np.std))
+registry.add(IncrementalAggUDF("avg", 1,
+  init=lambda: (0, 0),
+  update=lambda (n, total), v: (n + 1, total + v),
+  merge=lambda (n1, total1), (n2, total2): (n1 + n2, total1 + total2),
+  finalize=lambda (n, total): total / float(n),
+  group_states=lambda starts, ends, col: zip(
+    (ends - starts).tolist(), np.add.reduceat(col, starts).tolist())))
+registry.add(IncrementalAggUDF("count", 1,
+  init=lambda: 0,
+  update=lambda n, v: n + 1,
+  merge=lambda n1, n2: n1 + n2,
+  finalize=lambda n: n,
+  group_states=lambda starts, ends, col: (ends - starts).tolist()))
+registry.add(IncrementalAggUDF("sum", 1,
+  init=lambda: 0,
+  update=lambda total, v: total + v,
+  merge=lambda total1, total2: total1 + total2,
+  finalize=lambda total: total,
+  group_states=lambda starts, ends, col: np.add.reduceat(col, starts).tolist()))
+registry.add(make_std("std"))
+registry.add(make_std("stddev"))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import numbers
+import numpy as np
 from functools import partial
+from operator import itemgetter
 
 def pickone(l, attr):
   return [(i and getattr(i, attr) or None) for i in l]
@@ -41,6 +43,18 @@ def guess_type(v):
     return "num"
   return "str"
 
+# NaN is not equal to itself, so group keys use this one NaN object for
+# all NaN values, which makes keys with NaNs equal in tuple comparisons
+NAN = float("nan")
+
+def group_key(key):
+  """
+  @key tuple of grouping values
+  @return @key with its NaN values replaced by NAN, so that rows with NaN
+          values fall into the same group
+  """
+  return tuple(NAN if v != v else v for v in key)
+
 def print_qplan_pointers(q):
   queue = [q]
   while queue:
@@ -50,21 +64,61 @@ def print_qplan_pointers(q):
       print "\t%d\t->\t%d" % (op.id, cop.id)
     queue.extend(op.children())
 
-class OBTuple(object):
-  '''
-  Function to order tuples based on asc or desc order
-  '''
-  def __init__(self, vals, ascdesc):
-    self.vals = vals
-    self.ascdesc = ascdesc
-
-  def __cmp__(self, other):
-    for reverse, v1, v2 in zip(self.ascdesc, self.vals, other.vals):
-      if v1 < v2:
-        return -1 * reverse
-      elif v1 > v2:
-        return 1 * reverse
-      else: # v1 == v2
-        continue
-
-    return 0
+def sort_passes(ascdescs):
+  """
+  @ascdescs "asc" or "desc" for each sort key
+  @return list of (key indexes, reverse) for stable sorts that, run in 
+          order, sort by all of the keys.  Consecutive keys in the same 
+          direction share a pass, and the least significant keys go first.
+  """
+  passes = []
+  for i, ascdesc in enumerate(ascdescs):
+    reverse = (ascdesc == "desc")
+    if passes and passes[-1][1] == reverse:
+      passes[-1][0].append(i)
+    else:
+      passes.append(([i], reverse))
+  return passes[::-1]
+
+def sort_order(keys, ascdescs):
+  """
+  Stable sort by precomputed keys.  If every key is numeric, the keys are
+  sorted with np.lexsort, and descending keys are negated.  Otherwise, the
+  keys are sorted with one list.sort() per sort_passes() pass, which
+  compares the key values natively.
+
+  @keys     list of tuples of sort key values, one per row
+  @ascdescs "asc" or "desc" for each sort key
+  @return   list of the row indexes in sorted order
+  """
+  if not keys:
+    return []
+
+  cols = []
+  for col, ascdesc in zip(zip(*keys), ascdescs):
+    col = np.array(col)
+    if col.dtype.kind not in "bif":
+      break
+    if col.dtype.kind == "b":
+      col = col.astype(np.int64)
+    if ascdesc == "desc":
+      col = -col
+    cols.append(col)
+  else:
+    # lexsort uses the last key as the primary key
+    return np.lexsort(cols[::-1]).tolist()
+
+  items = [key + (i,) for i, key in enumerate(keys)]
+  for idxs, reverse in sort_passes(ascdescs):
+    # reverse=True sorts are still stable
+    items.sort(key=itemgetter(*idxs), reverse=reverse)
+  return [item[-1] for item in items]
+
+def top_rows(keys, rows, ascdescs, k):
+  """
+  @keys     list of tuples of sort key values, one per row
+  @rows     list of rows
+  @return   the keys and rows of the first @k rows in sort order
+  """
+  order = sort_order(keys, ascdescs)[:k]
+  return [keys[i] for i in order], [rows[i] for i in order]
@@ -0,0 +1,107 @@
+"""
+Compiled query cache tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from databass import *
+from databass.codecache import *
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+    self.cachedir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cachedir)
+
+  def parse(self, s):
+    return self.opt(Yield(parse(s)))
+
+  def test_hits(self):
+    cache = CodeCache()
+    q1 = "SELECT a, b FROM data WHERE a > 2"
+    query = cache(self.parse(q1))
+    self.assertTrue(cache(self.parse(q1)) is query)
+    self.assertTrue(cache(self.parse("SELECT a, b FROM data WHERE a > 3")) is not query)
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+    expected = [str(row) for row in self.parse(q1)]
+    self.assertEqual([str(row) for row in query()], expected)
+    self.assertEqual([str(row) for row in query()], expected)
+
+  def test_fingerprint(self):
+    q = "SELECT d1.a FROM data AS d1, data AS d2 WHERE d1.a = d2.b"
+    self.assertEqual(plan_fingerprint(self.parse(q)), plan_fingerprint(self.parse(q)))
+    # the scans read different attributes
+    q2 = "SELECT d1.c FROM data AS d1, data AS d2 WHERE d1.a = d2.b"
+    self.assertNotEqual(plan_fingerprint(self.parse(q)), plan_fingerprint(self.parse(q2)))
+
+  def test_float_literals(self):
+    # str() rounds both literals to 17.0, but they select different rows
+    cache = CodeCache()
+    for lit in ("17.0000000000001", "16.9999999999999"):
+      q = "SELECT a FROM data WHERE a > %s" % lit
+      expected = sorted(str(row) for row in self.parse(q))
+      self.assertEqual(sorted(str(row) for row in cache(self.parse(q))()), expected)
+    self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+  def test_persist(self):
+    q = "SELECT c, count(a) FROM data GROUP BY c"
+    expected = sorted(str(row) for row in self.parse(q))
+    cache = CodeCache(cachedir=self.cachedir)
+    cache(self.parse(q))
+
+    # a new cache, e.g. in a restarted process, loads the code from disk
+    cache = CodeCache(cachedir=self.cachedir)
+    query = cache(self.parse(q))
+    self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+    self.assertEqual(sorted(str(row) for row in query()), expected)
+
+    # corrupted files are ignored
+    for fname in os.listdir(self.cachedir):
+      with open(os.path.join(self.cachedir, fname), "wb") as f:
+        f.write("garbage")
+    cache = CodeCache(cachedir=self.cachedir)
+    query = cache(self.parse(q))
+    self.assertEqual((cache.disk_hits, cache.misses), (0, 1))
+    self.assertEqual(sorted(str(row) for row in query()), expected)
+
+  def test_eviction(self):
+    cache = CodeCache(capacity=2, cachedir=self.cachedir, disk_capacity=3)
+    for i in xrange(5):
+      cache(self.parse("SELECT a FROM data WHERE a > %d" % i))
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(len(os.listdir(self.cachedir)), 3)
+
+  def test_sorted_inputs(self):
+    # sort-merge joins skip sorting inputs that are known to be in order, 
+    # so re-registering a table with unsorted rows must not reuse the code
+    import numpy as np
+    import pandas as pd
+    q = "SELECT ta.v, tb.w FROM ta, tb WHERE ta.t BETWEEN (tb.t - 2) AND (tb.t + 2)"
+    cache = CodeCache(cachedir=self.cachedir)
+    for sort in (True, False):
+      ts = np.arange(50) * 3
+      if not sort:
+        ts = np.random.RandomState(0).permutation(ts)
+      self.db.register_dataframe("ta", pd.DataFrame({"t": ts, "v": np.arange(50)}))
+      self.db.register_dataframe("tb", pd.DataFrame({"t": ts[::-1] + 1, "w": np.arange(50)}))
+      plan = self.parse(q)
+      expected = sorted(str(row) for row in plan)
+      self.assertEqual(sorted(str(row) for row in cache(plan)()), expected)
+    self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+  def test_memory_budget(self):
+    # plans that only differ in their memory budgets compile differently
+    q = "SELECT a, b FROM data ORDER BY b"
+    plans = [self.parse(q), self.parse(q)]
+    plans[1].c.max_rows = 2
+    self.assertNotEqual(plan_fingerprint(plans[0]), plan_fingerprint(plans[1]))
+
+    q = "SELECT d1.a FROM data AS d1, data AS d2 WHERE d1.a = d2.b"
+    plans = [self.parse(q), self.parse(q)]
+    plans[1].collect("HashJoin")[0].max_rows = 2
+    self.assertNotEqual(plan_fingerprint(plans[0]), plan_fingerprint(plans[1]))
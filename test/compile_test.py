@@ -0,0 +1,119 @@
+"""
+Query compilation tests beyond the homework tests
+"""
+import unittest
+from databass import *
+from databass.tables import InMemoryTable
+
+
+class CountingTable(InMemoryTable):
+  """
+  Table that counts the number of rows that have been read from it
+  """
+  def __init__(self, schema, rows):
+    super(CountingTable, self).__init__(schema, rows)
+    self.nread = 0
+
+  def iter_rows(self):
+    for row in self.rows:
+      self.nread += 1
+      yield row
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+    schema = Schema([Attr("a", "num", "counting")])
+    self.table = CountingTable(schema, [[i] for i in xrange(1000)])
+    self.db.register_table("counting", schema, self.table)
+
+  def parse(self, s):
+    return self.opt(Yield(parse(s)))
+
+  def compile(self, q):
+    ctx = Context()
+    q.produce(ctx)
+    code = ctx.compiler.compile_to_func("compiled_q")
+    exec(code)
+    return compiled_q
+
+  def run_query(self, s, ordered=False):
+    q = self.parse(s)
+    res1 = [str(row) for row in q]
+    res2 = [str(row) for row in self.compile(q)()]
+    if not ordered:
+      res1.sort()
+      res2.sort()
+    self.assertEqual(res1, res2)
+    return res2
+
+  def test_limit_stops_scan(self):
+    q = self.compile(self.parse("SELECT a FROM counting WHERE a > 10 LIMIT 3"))
+    self.table.nread = 0
+    res = [str(row) for row in q()]
+    self.assertEqual(res, ['(11)', '(12)', '(13)'])
+    self.assertEqual(self.table.nread, 14)
+
+  def test_nested_limits(self):
+    qs = ["SELECT a FROM counting LIMIT 0",
+          """SELECT c1.a FROM (SELECT a FROM counting LIMIT 3) AS c1, 
+                             (SELECT a FROM counting LIMIT 5) AS c2 LIMIT 7""",
+          "SELECT DISTINCT d1.a FROM data AS d1, data AS d2 WHERE d1.a = d2.b LIMIT 2"]
+    for q in qs:
+      self.run_query(q)
+
+  def test_groupby_hashjoin(self):
+    qs = ["SELECT c, count(b), sum(f) FROM data GROUP BY c",
+          "SELECT a+b, count(c) FROM data GROUP BY a+b, c",
+          """SELECT d1.a, count(d2.b) FROM data AS d1, data AS d2 
+             WHERE d1.a = d2.b GROUP BY d1.a"""]
+    for q in qs:
+      self.run_query(q)
+
+  def test_row_variables(self):
+    q = self.parse("""SELECT d1.a + d2.b AS x, d2.c FROM data AS d1, data AS d2
+                      WHERE d1.a = d2.b and d1.b > 1""")
+    ctx = Context()
+    q.produce(ctx)
+    code = ctx.compiler.compile_to_func("compiled_q")
+    # attribute values are passed between operators in local variables, and
+    # the only tuple that is constructed is the reused result row
+    self.assertEqual(code.count("ListTuple("), 1)
+    self.assertTrue(".row[" not in code)
+
+    qs = ["SELECT x, c FROM (SELECT a + b AS x, c FROM data WHERE a > 1) AS s",
+          "SELECT d1.a, d2.c FROM data AS d1, data AS d2 WHERE d1.a < d2.b",
+          "SELECT a FROM data ORDER BY a DESC",
+          "SELECT 1"]
+    for q in qs:
+      self.run_query(q, ordered=True)
+
+  def test_expr_funcs(self):
+    schema = Schema([Attr("a", "num", "t"), Attr("b", "num", "t"), Attr("e", "str", "t")])
+    row = ListTuple(schema, [3, 4, "Abc"])
+    param = Param(0)
+    exprs = [cond_to_func("t.a + t.b * 2"), cond_to_func("not(t.a > 2)"),
+             Between(cond_to_func("t.a"), Literal(3), cond_to_func("t.b")),
+             ScalarFunc(UDFRegistry.registry()["lower"], [cond_to_func("t.e")]),
+             Expr("<", cond_to_func("t.b"), param), Literal(7),
+             Expr("=", cond_to_func("t.e"), Literal("Abc")),
+             Literal("it's \"quoted\"")]
+    for e in exprs:
+      for attr in e.collect(Attr):
+        attr.idx = schema.idx(attr)
+    for v in (1, 10):
+      param.v = v
+      for e in exprs:
+        self.assertEqual(e.as_func()(row), e(row))
+
+    # the function is cached, but not shared with copies of the expression
+    e = exprs[0]
+    self.assertTrue(e.as_func() is e.as_func())
+    self.assertFalse(e.copy().__dict__.get("_func"))
+
+    qs = ["SELECT a FROM data WHERE a BETWEEN 2 AND 5",
+          "SELECT lower(e), e FROM data",
+          "SELECT a, e FROM data WHERE e = 'cde'"]
+    for q in qs:
+      self.run_query(q)
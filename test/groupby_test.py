@@ -0,0 +1,138 @@
+"""
+Aggregation tests.  GroupBy computes aggregates incrementally, so check
+the built-in aggregates against NumPy, and that list-style AggUDFs,
+HAVING and every execution mode agree.
+"""
+import unittest
+import numpy as np
+from databass import *
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+    UDFRegistry.registry().add(AggUDF("median", 1, np.median))
+
+  def parse(self, s):
+    return self.opt(Yield(parse(s)))
+
+  def compile(self, q):
+    ctx = Context()
+    q.produce(ctx)
+    code = ctx.compiler.compile_to_func("compiled_q")
+    exec(code)
+    return compiled_q
+
+  def compile_source(self, q):
+    ctx = Context()
+    q.produce(ctx)
+    return ctx.compiler.compile_to_func("compiled_q")
+
+  def run_all(self, s):
+    """
+    Run the query in tuple, compiled and vectorized mode
+    @return sorted result rows as lists
+    """
+    q = self.parse(s)
+    res1 = sorted([list(row.row) for row in q])
+    res2 = sorted([list(row.row) for row in self.compile(q)()])
+    res3 = sorted([list(row.row) for row in q.vectorized(7)])
+    for res in (res2, res3):
+      self.assertEqual(len(res1), len(res))
+      for r1, r in zip(res1, res):
+        self.assertTrue(np.allclose(r1, r))
+    return res1
+
+  def test_builtins(self):
+    data = self.db["data"]
+    res = self.run_all("""SELECT c, count(a), sum(b), avg(f), std(a+f)
+                          FROM data GROUP BY c""")
+    for c, count, total, avg, std in res:
+      rows = [row for row in data if row[2] == c]
+      a = np.array([row[0] for row in rows])
+      f = np.array([row[5] for row in rows])
+      self.assertEqual(count, len(rows))
+      self.assertEqual(total, sum(row[1] for row in rows))
+      self.assertAlmostEqual(avg, np.mean(f))
+      self.assertAlmostEqual(std, np.std(a + f))
+
+  def test_list_udf(self):
+    registry = UDFRegistry.registry()
+    registry.add(AggUDF("spread", 2, lambda x, y: max(x) - min(y)))
+    res = self.run_all("SELECT c, median(a), spread(a, b) FROM data GROUP BY c")
+    data = self.db["data"]
+    for c, median, spread in res:
+      a = [row[0] for row in data if row[2] == c]
+      b = [row[1] for row in data if row[2] == c]
+      self.assertEqual(median, np.median(a))
+      self.assertEqual(spread, max(a) - min(b))
+
+  def test_incremental_udf(self):
+    registry = UDFRegistry.registry()
+    registry.add(IncrementalAggUDF("maxabs", 1,
+      init=lambda: None,
+      update=lambda m, v: abs(v) if m is None else max(m, abs(v)),
+      merge=lambda m1, m2: m2 if m1 is None else max(m1, m2),
+      finalize=lambda m: m))
+    self.assertEqual(registry["maxabs"].f([1, -3, 2]), 3)
+    res = self.run_all("SELECT c, maxabs(b-a) FROM data GROUP BY c")
+    data = self.db["data"]
+    for c, m in res:
+      self.assertEqual(m, max(abs(row[1] - row[0]) for row in data if row[2] == c))
+
+  def test_merge_states(self):
+    vals = np.random.rand(100) * 100
+    for name, expected in [("count", len(vals)), ("sum", np.sum(vals)),
+                           ("avg", np.mean(vals)), ("std", np.std(vals)),
+                           ("median", np.median(vals))]:
+      udf = UDFRegistry.registry()[name]
+      states = [udf.init_state() for i in xrange(3)]
+      for i, v in enumerate(vals):
+        states[i % 3] = udf.update_state(states[i % 3], v)
+      state = reduce(udf.merge_state, states, udf.init_state())
+      self.assertAlmostEqual(udf.finalize_state(state), expected)
+
+  def test_having(self):
+    res = self.run_all("""SELECT a, sum(b) FROM data
+                          GROUP BY a HAVING count(b) > 3""")
+    self.assertEqual(len(res), 0)
+    res = self.run_all("""SELECT a, sum(b) FROM data
+                          GROUP BY a HAVING sum(b) > 20""")
+    self.assertTrue(all(total > 20 for a, total in res))
+
+  def test_no_group_rows(self):
+    q = self.parse("SELECT c, count(a) FROM data GROUP BY c")
+    gby = q.collect(GroupBy)[0]
+    self.assertEqual(len(gby.aggs), 1)
+    gidx = gby.schema.idx(Attr("__group__"))
+    for row in gby:
+      self.assertEqual(row[gidx], None)
+
+  def test_common_subexprs(self):
+    s = """SELECT a*b, sum(a*b), avg(a*b) FROM data 
+           GROUP BY a*b HAVING sum(a*b) > 10"""
+    q = self.parse(s)
+    # the HAVING clause's sum shares the SELECT clause's aggregate
+    self.assertEqual(len(q.collect(GroupBy)[0].aggs), 2)
+    code = self.compile_source(q)
+    # a*b is computed once per input row, and once per group by the Project
+    self.assertEqual(code.count("* (expr_"), 2)
+    self.assertTrue("gb_key_0 = (cse_0,)" in code)
+
+    data = self.db["data"]
+    sums = {}
+    for row in data:
+      sums.setdefault(row[0] * row[1], []).append(row[0] * row[1])
+    expected = sorted([k, sum(vals), np.mean(vals)] 
+                      for k, vals in sums.items() if sum(vals) > 10)
+    self.assertTrue(np.allclose(self.run_all(s), expected))
+
+  def test_group_keys(self):
+    # hash(-1) == hash(-2), but they are different groups.  NaNs are one group
+    import pandas as pd
+    self.db.register_dataframe("gk", pd.DataFrame({
+      "k": [-1, -2, -1, np.nan, np.nan, 3], "v": [1, 2, 3, 4, 5, 6]}))
+    q = self.parse("SELECT k, sum(v) FROM gk GROUP BY k")
+    for rows in (q, self.compile(q)(), q.vectorized(4)):
+      self.assertEqual(sorted(row[1] for row in rows), [2, 4, 6, 9])
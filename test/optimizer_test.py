@@ -0,0 +1,352 @@
+"""
+Join optimization tests
+"""
+import unittest
+import numpy as np
+import pandas as pd
+from itertools import product
+from collections import defaultdict
+from databass import *
+from databass.ops import Scan, ThetaJoin, HashJoin, SortMergeJoin, Empty, \
+    Limit, TopK
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    # tables of different sizes that join on k
+    for i in xrange(16):
+      n = 5 + 7 * (i % 4)
+      self.db.register_dataframe("t%d" % i, pd.DataFrame({
+        "k": np.arange(n) % 5, "v%d" % i: np.arange(n)}))
+
+  def run_query(self, s, bushy=False):
+    q = Optimizer(bushy=bushy)(Yield(parse(s)))
+    return q, sorted(str(row) for row in q)
+
+  def compile(self, q):
+    ctx = Context()
+    q.produce(ctx)
+    code = ctx.compiler.compile_to_func("compiled_q")
+    exec(code)
+    return compiled_q
+
+  def run_all(self, q):
+    """
+    Run the plan in tuple, compiled and vectorized mode
+    @return sorted result rows
+    """
+    res = sorted(tuple(row.row) for row in q)
+    self.assertEqual(sorted(tuple(row.row) for row in self.compile(q)()), res)
+    self.assertEqual(sorted(tuple(row.row) for row in q.vectorized(4)), res)
+    return res
+
+  def test_join_results(self):
+    q = """SELECT t0.v0, t1.v1, t2.v2 FROM t0, t1, t2
+           WHERE t0.k = t1.k and t2.v2 = t1.k and t0.v0 > t2.k"""
+    expected = []
+    rows = [list(self.db["t%d" % i].iter_rows()) for i in xrange(3)]
+    for r0, r1, r2 in product(*rows):
+      if r0[0] == r1[0] and r2[1] == r1[0] and r0[1] > r2[0]:
+        expected.append("(%s, %s, %s)" % (r0[1], r1[1], r2[1]))
+    for bushy in (False, True):
+      plan, res = self.run_query(q, bushy)
+      self.assertEqual(res, sorted(expected))
+      # only equality predicates are used as join predicates
+      for join in plan.collect(ThetaJoin):
+        self.assertTrue(">" not in str(join.cond))
+
+  def test_dp_matches_exhaustive(self):
+    sources = [Scan("t%d" % i, "t%d" % i) for i in xrange(5)]
+    for source in sources:
+      source.init_schema()
+    preds = [cond_to_func("t%d.k = t%d.k" % (i, i + 1)) for i in xrange(4)]
+    exhaustive = SelingerOpt(self.db)
+    exhaustive.preds = preds
+    exhaustive.pred_index = exhaustive.build_predicate_index(preds)
+    exhaustive.plans_tested = 0
+    plan1 = exhaustive.best_plan_exhaustive(sources)
+
+    dp = SelingerOpt(self.db)
+    plan2 = dp(preds, sources)
+    self.assertAlmostEqual(dp.cost(plan2), exhaustive.cost(plan1))
+    self.assertTrue(dp.plans_tested < exhaustive.plans_tested)
+
+    bushy = SelingerOpt(self.db, bushy=True)
+    plan3 = bushy(preds, sources)
+    self.assertTrue(bushy.cost(plan3) <= dp.cost(plan2))
+
+  def test_many_tables(self):
+    n = 16
+    sources = [Scan("t%d" % i, "t%d" % i) for i in xrange(n)]
+    preds = [cond_to_func("t%d.k = t%d.k" % (i, i + 1)) for i in xrange(n - 1)]
+    opt = SelingerOpt(self.db)
+    plan = opt(preds, sources)
+    self.assertEqual(len(plan.collect(Scan)), n)
+    self.assertTrue(opt.plans_tested < 2 * n * n)
+    for join in plan.collect(ThetaJoin):
+      self.assertEqual(join.l.p, join)
+      self.assertEqual(join.r.p, join)
+
+  def test_physical_joins(self):
+    for i in xrange(3):
+      n = 100 + 50 * i
+      self.db.register_dataframe("t%d" % i, pd.DataFrame({
+        "k": np.arange(n) % 10, "v%d" % i: np.arange(n) % 30}))
+    q = """SELECT t0.v0, t1.v1, t2.v2 FROM t0, t1, t2
+           WHERE t0.k = t1.k and t0.v0 = t1.v1 and t2.k = t1.k and t2.v2 > t0.v0"""
+    plan = Optimizer()(Yield(parse(q)))
+    # equi-joins use hash joins, and the non-equi predicate stays a filter
+    self.assertEqual(len(plan.collect(HashJoin)), 2)
+    self.assertEqual(plan.collect(ThetaJoin), [])
+    self.assertTrue(any(j.cond is not None for j in plan.collect(HashJoin)))
+
+    expected = []
+    rows = [list(self.db["t%d" % i].iter_rows()) for i in xrange(3)]
+    for r0, r1, r2 in product(*rows):
+      if r0[0] == r1[0] and r0[1] == r1[1] and r2[0] == r1[0] and r2[1] > r0[1]:
+        expected.append((r0[1], r1[1], r2[1]))
+    self.assertEqual(self.run_all(plan), sorted(expected))
+
+  def test_composite_join_keys(self):
+    for i in xrange(2):
+      self.db.register_dataframe("c%d" % i, pd.DataFrame({
+        "store": np.arange(60) % 4, "day": np.arange(60) % 5, "v%d" % i: np.arange(60)}))
+    q = """SELECT c0.v0, c1.v1 FROM c0, c1
+           WHERE c0.store = c1.store and c1.day = c0.day"""
+    plan = Optimizer()(Yield(parse(q)))
+    # both equi-join predicates are hash join keys, so there is no residual
+    joins = plan.collect(HashJoin)
+    self.assertEqual(len(joins), 1)
+    self.assertEqual(len(joins[0].join_keys), 2)
+    self.assertEqual(joins[0].cond, None)
+    for lattr, rattr in joins[0].join_keys:
+      self.assertEqual((lattr.tablename, rattr.tablename), (joins[0].l.alias, joins[0].r.alias))
+
+    expected = [(i, j) for i in xrange(60) for j in xrange(60) if i % 20 == j % 20]
+    self.assertEqual(self.run_all(plan), expected)
+
+  def test_sort_merge_join(self):
+    def join(klass):
+      l, r = Scan("t0", "t0"), Scan("t1", "t1")
+      attrs = [Attr("k", tablename="t0"), Attr("k", tablename="t1")]
+      plan = klass(l, r, attrs, cond_to_func("t0.v0 < t1.v1"))
+      return Optimizer()(Yield(plan))
+    res = self.run_all(join(SortMergeJoin))
+    self.assertTrue(len(res) > 0)
+    self.assertEqual(res, self.run_all(join(HashJoin)))
+    # NaN keys match nothing
+    matches = MergeCursor([[1], [2], [2], [5]], 0)
+    self.assertEqual([matches(k) for k in (0, 2, 2, np.nan, 3)], 
+                     [[], [[2], [2]], [[2], [2]], [], []])
+    matches = MergeCursor([[1], [2], [2], [5]], 0, (-1, 2))
+    self.assertEqual([matches(k) for k in (None, 0, 3, np.nan, 4, 9)], 
+                     [[], [[1], [2], [2]], [[2], [2], [5]], [], [[5]], []])
+
+  def test_band_join(self):
+    np.random.seed(0)
+    n = 80
+    # ts0 is sorted on t, and ts1 is not
+    self.db.register_dataframe("ts0", pd.DataFrame({
+      "t": np.arange(n) * 2, "v0": np.arange(n)}))
+    t1 = np.random.permutation(n * 2).astype(float)
+    t1[3] = np.nan
+    self.db.register_dataframe("ts1", pd.DataFrame({"t": t1, "v1": np.arange(n * 2)}))
+    rows = [list(self.db[t].iter_rows()) for t in ("ts0", "ts1")]
+
+    bands = [
+      ("ts1.t BETWEEN (ts0.t - 3) AND (ts0.t + 3)", lambda t0, t1: t0 - 3 <= t1 <= t0 + 3),
+      ("ts0.t < ts1.t + 2 and ts0.t >= ts1.t - 1", lambda t0, t1: t1 - 1 <= t0 < t1 + 2),
+      ("ts0.t = ts1.t + 1", lambda t0, t1: t0 == t1 + 1)]
+    for cond, f in bands:
+      plan = Optimizer()(Yield(parse(
+        "SELECT ts0.v0, ts1.v1 FROM ts0, ts1 WHERE %s" % cond)))
+      self.assertEqual(plan.collect(ThetaJoin), [])
+      joins = plan.collect(SortMergeJoin)
+      self.assertEqual(len(joins), 1)
+      # only the strict comparison is evaluated by the residual condition
+      self.assertEqual(joins[0].cond is None, "<" not in cond)
+      sorted_sides = [joins[0].lsorted, joins[0].rsorted]
+      if joins[0].l.alias == "ts1":
+        sorted_sides.reverse()
+      self.assertEqual(sorted_sides, [True, False])
+
+      expected = sorted((r0[1], r1[1]) for r0, r1 in product(*rows) if f(r0[0], r1[0]))
+      self.assertTrue(len(expected) > 0)
+      self.assertEqual(self.run_all(plan), expected)
+
+    # subqueries are in the order of their ORDER BY
+    q = """SELECT s.v1, ts0.v0 FROM (SELECT t, v1 FROM ts1 ORDER BY t) AS s, ts0
+           WHERE ts0.t BETWEEN s.t AND (s.t + 1)"""
+    plan = Optimizer()(Yield(parse(q)))
+    join = plan.collect(SortMergeJoin)[0]
+    self.assertTrue(join.lsorted and join.rsorted)
+    expected = sorted((r1[1], r0[1]) for r0, r1 in product(*rows) if r1[0] <= r0[0] <= r1[0] + 1)
+    self.assertEqual(self.run_all(plan), expected)
+
+  def test_sorted_inputs(self):
+    for i in xrange(2):
+      self.db.register_dataframe("st%d" % i, pd.DataFrame({
+        "k": np.arange(100) // (i + 2), "v%d" % i: np.arange(100)}))
+    # both inputs are sorted on k, so merging them is cheaper than hashing
+    plan = Optimizer()(Yield(parse(
+      "SELECT st0.v0, st1.v1 FROM st0, st1 WHERE st0.k = st1.k")))
+    joins = plan.collect(SortMergeJoin)
+    self.assertEqual(len(joins), 1)
+    self.assertTrue(joins[0].lsorted and joins[0].rsorted)
+    expected = [(i, j) for i in xrange(100) for j in xrange(100) if i // 2 == j // 3]
+    self.assertEqual(self.run_all(plan), expected)
+
+  def test_hash_join_keys(self):
+    # hash(-1) == hash(-2), but they are different keys
+    self.db.register_dataframe("hk0", pd.DataFrame({
+      "a": [-1, -2, 1, 1, np.nan], "b": [0, 1, 0, 1, 1], "x": np.arange(5)}))
+    self.db.register_dataframe("hk1", pd.DataFrame({
+      "a": [-2, 1, 1, np.nan], "b": [1, 1, 2, 1], "y": np.arange(4)}))
+    def join(pairs):
+      attrs = [(Attr(l, tablename="hk0"), Attr(r, tablename="hk1")) for l, r in pairs]
+      plan = HashJoin(Scan("hk0", "hk0"), Scan("hk1", "hk1"), attrs)
+      plan = Optimizer()(Yield(Project(plan, [Attr("x"), Attr("y")])))
+      return self.run_all(plan)
+    self.assertEqual(join([("a", "a")]), [(1, 0), (2, 1), (2, 2), (3, 1), (3, 2)])
+    self.assertEqual(join([("a", "a"), ("b", "b")]), [(1, 0), (3, 1)])
+
+    l, r = Scan("hk0", "hk0"), Scan("hk1", "hk1")
+    plan = HashJoin(l, r, [Attr("a", tablename="hk0"), Attr("a", tablename="hk1")])
+    self.assertEqual(len(plan.join_keys), 1)
+    self.assertEqual(plan.left_attrs[0].tablename, "hk0")
+
+  def test_join_algorithm_costs(self):
+    opt = SelingerOpt(self.db)
+    key = (("a", "k"), ("b", "k"))
+    def best(lorder, rorder):
+      algos = opt.join_algorithms(100, 1000, lorder, 100, 1000, rorder, 1000, key)
+      return min(algos, key=lambda algo: algo[1])[0]
+    self.assertEqual(best(frozenset(), frozenset()), HashJoin)
+    self.assertEqual(best(frozenset([key[0]]), frozenset([key[1]])), SortMergeJoin)
+    self.assertEqual(opt.join_algorithms(1, 1, frozenset(), 1, 1, frozenset(), 1, None)[0][0], 
+                     ThetaJoin)
+
+  def test_predicate_pushdown(self):
+    q = """SELECT t0.v0, t1.v1, t2.v2 FROM t0, t1, t2
+           WHERE t0.k = t1.k and t1.k = t2.k and t0.v0 > 3 and 
+                 t1.v1 < t2.v2 and t2.v2 < 20"""
+    plan, res = self.run_query(q)
+    # single table predicates are evaluated right above the scans
+    filters = plan.collect(Filter)
+    self.assertEqual(len(filters), 2)
+    self.assertTrue(all(f.c.is_type(Scan) for f in filters))
+    # and the other predicates by the joins
+    self.assertTrue(any("<" in str(j.cond) for j in plan.collect(Join)))
+
+    expected = []
+    rows = [list(self.db["t%d" % i].iter_rows()) for i in xrange(3)]
+    for r0, r1, r2 in product(*rows):
+      if (r0[0] == r1[0] == r2[0] and r0[1] > 3 and r1[1] < r2[1] and 
+          r2[1] < 20):
+        expected.append("(%s, %s, %s)" % (r0[1], r1[1], r2[1]))
+    self.assertEqual(res, sorted(expected))
+
+  def test_subquery_pushdown(self):
+    q = """SELECT x.k, x.s FROM (SELECT k, sum(v1) AS s FROM t1 GROUP BY k) AS x
+           WHERE x.k > 2 and x.s > 10"""
+    plan, res = self.run_query(q)
+    # the predicate over the group key is evaluated before grouping, the
+    # predicate over the aggregate stays outside of the subquery
+    gby = plan.collect(GroupBy)[0]
+    self.assertTrue(gby.c.is_type(Filter))
+    self.assertEqual(str(gby.c.cond), "t1.k:num > 2.0")
+    self.assertTrue(plan.c.c.is_type(Filter))
+
+    sums = defaultdict(int)
+    for k, v in self.db["t1"].iter_rows():
+      sums[k] += v
+    expected = ["(%s, %s)" % (k, s) for k, s in sums.items() if k > 2 and s > 10]
+    self.assertEqual(res, sorted(expected))
+
+  def test_projection_pushdown(self):
+    n = 50
+    cols = dict(("c%d" % i, np.arange(n) * i) for i in xrange(20))
+    cols["k"] = np.arange(n) % 7
+    self.db.register_dataframe("wide", pd.DataFrame(cols))
+    q = """SELECT w.c3, sum(t1.v1) FROM wide AS w, t1 
+           WHERE w.k = t1.k and w.c5 > 10 GROUP BY w.c3"""
+    plan = Optimizer()(Yield(parse(q)))
+    scans = dict((scan.alias, scan) for scan in plan.collect(Scan))
+    self.assertEqual(sorted(scans["w"].attrs), ["c3", "c5", "k"])
+    self.assertEqual(sorted(scans["t1"].attrs or ["k", "v1"]), ["k", "v1"])
+
+    sums = defaultdict(int)
+    for row in self.db["t1"].iter_rows():
+      for i in xrange(n):
+        if i % 7 == row[0] and i * 5 > 10:
+          sums[i * 3] += row[1]
+    self.assertEqual(self.run_all(plan), sorted(sums.items()))
+
+  def test_constant_folding(self):
+    a = Attr("a", "num", "t")
+    self.assertEqual(str(simplify(cond_to_func("t.a > (1 + 2)"))), "t.a > 3.0")
+    self.assertEqual(str(simplify(Expr("*", a, Literal(1)), "numeric")), str(a))
+    # x * 1 is a float when x is an int, so it is kept if the value is output
+    self.assertEqual(str(simplify(Expr("*", a, Literal(1)))), str(a) + " * 1")
+    self.assertEqual(str(simplify(Expr("and", Bool(True), a))), str(a))
+    self.assertEqual(str(simplify(Expr("and", a, Bool(True)), "bool")), str(a))
+    self.assertEqual(str(simplify(Expr("or", a, Bool(True)), "bool")), "True")
+    self.assertEqual(str(simplify(Between(a, Literal(5), Literal(2)))), "False")
+    self.assertEqual(str(simplify(Expr("<", Param(0), Literal(1)))), "? < 1")
+    self.assertEqual(str(simplify(Expr("/", Literal(1), Literal(0)))), "1 / 0")
+
+    q = """SELECT t0.v0, t1.v1 FROM t0, t1 
+           WHERE t0.k = t1.k and ((t0.v0 * 1) > (2 - 2)) and true"""
+    plan = Optimizer()(Yield(parse(q)))
+    self.assertEqual([str(f.cond) for f in plan.collect(Filter)], ["t0.v0:num > 0.0"])
+    self.assertTrue(len(self.run_all(plan)) > 0)
+
+    # always false filters skip the scans
+    for q in ["SELECT t0.v0 FROM t0, t1 WHERE t0.k = t1.k and 1 = 2",
+              "SELECT k, count(v0) FROM t0 WHERE v0 BETWEEN 5 AND 2 GROUP BY k"]:
+      plan = Optimizer()(Yield(parse(q)))
+      self.assertEqual(plan.collect(Scan), [])
+      self.assertEqual(len(plan.collect(Empty)), 1)
+      self.assertEqual(self.run_all(plan), [])
+
+  def test_top_k(self):
+    self.db.register_dataframe("ev", pd.DataFrame({
+      "a": np.arange(200) % 13, "b": np.arange(200)}))
+    for q, expected in [
+        ("SELECT a, b FROM ev ORDER BY a DESC, b LIMIT 4 OFFSET 2",
+         [(12, 38), (12, 51), (12, 64), (12, 77)]),
+        ("SELECT a, count(b) AS c FROM ev GROUP BY a ORDER BY c, a DESC LIMIT 3",
+         [(12, 15), (11, 15), (10, 15)]),
+        ("SELECT a, b FROM ev ORDER BY b LIMIT 5 OFFSET 198", [(3, 198), (4, 199)]),
+        ("SELECT a, b FROM ev ORDER BY b LIMIT 0", [])]:
+      plan = Optimizer()(Yield(parse(q)))
+      self.assertEqual(plan.collect(Limit), [])
+      self.assertEqual(len(plan.collect(TopK)), 1)
+      self.assertEqual([tuple(row.row) for row in plan], expected)
+      self.assertEqual([tuple(row.row) for row in self.compile(plan)()], expected)
+      self.assertEqual([tuple(row.row) for row in plan.vectorized(4)], expected)
+
+  def test_sort_keys(self):
+    keys = [(1, "b"), (0, "a"), (1, "a"), (0, "b"), (1, "b")]
+    self.assertEqual(sort_order(keys, ["asc", "desc"]), [3, 1, 0, 4, 2])
+    self.assertEqual(sort_order(keys, ["desc", "asc"]), [2, 0, 4, 1, 3])
+    keys = [(1, 2.5), (0, 1.0), (1, 2.5), (0, 3.0)]
+    self.assertEqual(sort_order(keys, ["desc", "desc"]), [0, 2, 3, 1])
+    self.assertEqual(sort_passes(["asc", "asc", "desc"]), [([2], True), ([0, 1], False)])
+
+    self.db.register_dataframe("ev", pd.DataFrame({
+      "a": np.arange(300) % 7, "s": ["s%d" % (i % 11) for i in xrange(300)]}))
+    q = "SELECT s, a FROM ev ORDER BY s DESC, a"
+    expected = sorted(sorted(self.db["ev"].iter_rows(), key=lambda r: r[0]),
+                      key=lambda r: r[1], reverse=True)
+    expected = [(s, a) for a, s in expected]
+    plan = Optimizer()(Yield(parse(q)))
+    self.assertEqual([tuple(row.row) for row in plan], expected)
+    self.assertEqual([tuple(row.row) for row in self.compile(plan)()], expected)
+
+    # TopK truncates its buffer many times
+    plan = Optimizer()(Yield(parse(q + " LIMIT 5 OFFSET 20")))
+    plan.c.MIN_BUFFER = 8
+    self.assertEqual([tuple(row.row) for row in plan], expected[20:25])
+    self.assertEqual([tuple(row.row) for row in self.compile(plan)()], expected[20:25])
@@ -0,0 +1,54 @@
+"""
+Plan cache tests
+"""
+import unittest
+import numpy as np
+import pandas as pd
+from databass import *
+from databass.plancache import *
+from databass.prompt import parse_and_optimize
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.db.register_dataframe("pc", pd.DataFrame({
+      "a": np.arange(10), "b": np.arange(10) % 3}))
+
+  def test_normalize(self):
+    q = normalize_query("SELECT  a,\n\tb FROM pc WHERE b = 'x  y' ;")
+    self.assertEqual(q, "SELECT a, b FROM pc WHERE b = 'x  y'")
+
+  def test_hits(self):
+    cache = PlanCache(parse_and_optimize)
+    plan = cache("SELECT a FROM pc WHERE b = 1")
+    self.assertTrue(cache("SELECT a  FROM pc\nWHERE b = 1;") is plan)
+    self.assertTrue(cache("SELECT a FROM pc WHERE b = 2") is not plan)
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    # cached plans can be run again
+    self.assertEqual([row[0] for row in plan], [1, 4, 7])
+    self.assertEqual([row[0] for row in cache("SELECT a FROM pc WHERE b = 1")], 
+                     [1, 4, 7])
+
+  def test_lru(self):
+    cache = PlanCache(parse_and_optimize, capacity=2)
+    qs = ["SELECT a FROM pc WHERE b = %d" % i for i in xrange(3)]
+    cache(qs[0])
+    cache(qs[1])
+    cache(qs[0])
+    cache(qs[2])
+    self.assertEqual(len(cache), 2)
+    self.assertTrue(qs[0] in cache)
+    self.assertTrue(qs[1] not in cache)
+
+  def test_invalidate(self):
+    cache = PlanCache(parse_and_optimize)
+    q = "SELECT * FROM pc"
+    plan = cache(q)
+    self.assertEqual(len(plan.schema.attrs), 2)
+    self.db.register_dataframe("pc", pd.DataFrame({"a": [1], "b": [2], "c": [3]}))
+    self.assertTrue(q not in cache)
+    plan = cache(q)
+    self.assertEqual(cache.misses, 2)
+    self.assertEqual([list(row.row) for row in plan], [[1, 2, 3]])
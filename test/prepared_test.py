@@ -0,0 +1,45 @@
+"""
+Prepared statement tests
+"""
+import unittest
+from databass import *
+from databass.codecache import CodeCache
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+
+  def run_literal(self, q):
+    return [list(row.row) for row in self.opt(Yield(parse(q)))]
+
+  def test_params(self):
+    q = "SELECT a, b FROM data WHERE a > ? and b < :hi and a < :hi"
+    for mode in PreparedStatement.MODES:
+      stmt = prepare(q, mode)
+      self.assertEqual(stmt.nparams, 2)
+      for lo, hi in [(1, 10), (5, 20), (0, 3)]:
+        expected = self.run_literal(
+            "SELECT a, b FROM data WHERE a > %d and b < %d and a < %d" % (lo, hi, hi))
+        self.assertEqual([list(row.row) for row in stmt.execute(lo, hi=hi)], expected)
+        self.assertEqual([list(row.row) for row in stmt.execute(lo, hi)], expected)
+
+  def test_reuse(self):
+    cache = CodeCache()
+    stmt = prepare("SELECT c, sum(b) FROM data WHERE a > ? GROUP BY c", 
+                   code_cache=cache)
+    plan = stmt.plan
+    for lo in xrange(5):
+      list(stmt.execute(lo))
+    self.assertTrue(stmt.plan is plan)
+    self.assertEqual((cache.hits, cache.misses), (0, 1))
+    # the same query prepared again generates the same code
+    prepare(stmt.qstr, code_cache=cache).execute(3)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def test_bind_errors(self):
+    stmt = prepare("SELECT a FROM data WHERE a > ? and b = :b")
+    self.assertRaises(Exception, stmt.execute, 1)
+    self.assertRaises(Exception, stmt.execute, 1, 2, 3)
+    self.assertRaises(Exception, stmt.execute, 1, b=2, c=3)
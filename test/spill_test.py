@@ -0,0 +1,102 @@
+"""
+External sort and spill file tests
+"""
+import unittest
+import random
+from itertools import chain
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from databass import *
+from databass.spill import *
+from databass.ops import Limit, TopK, Scan, HashJoin
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    n = 500
+    self.db.register_dataframe("sp", pd.DataFrame({
+      "a": np.arange(n) % 17, "b": np.arange(n),
+      "s": ["s%d" % (i % 23) for i in xrange(n)]}))
+
+  def compile(self, q):
+    ctx = Context()
+    q.produce(ctx)
+    code = ctx.compiler.compile_to_func("compiled_q")
+    exec(code)
+    return compiled_q
+
+  def test_spill_file(self):
+    f = SpillFile()
+    rows = [(i, "x%d" % i, None, i * 0.5) for i in xrange(10000)]
+    f.write(rows)
+    f.write([(Decimal(1), u"y")])
+    self.assertEqual(f.nrows, 10001)
+    self.assertTrue(f.nbytes > 0)
+    self.assertEqual(list(f), rows + [(Decimal(1), u"y")])
+    f.close()
+
+  def test_external_sort(self):
+    random.seed(0)
+    keys = [(random.randint(0, 9), random.choice("abc")) for i in xrange(1000)]
+    for ascdescs in (["asc", "asc"], ["desc", "asc"], ["asc", "desc"]):
+      sorter = ExternalSort(ascdescs, 64)
+      for i, key in enumerate(keys):
+        sorter.keys.append(key)
+        sorter.rows.append((i,))
+        if len(sorter.rows) > sorter.max_rows:
+          sorter.spill()
+      self.assertEqual(len(sorter.runs), 1000 / 65)
+      self.assertTrue(sorter.nbytes > 0)
+      expected = [(i,) for i in sort_order(keys, ascdescs)]
+      self.assertEqual(list(sorter), expected)
+
+  def test_orderby_spills(self):
+    q = "SELECT s, a, b FROM sp ORDER BY s DESC, a"
+    plan = Optimizer()(Yield(parse(q)))
+    expected = [tuple(row.row) for row in plan]
+    plan.c.max_rows = 30
+    self.assertEqual([tuple(row.row) for row in plan], expected)
+    self.assertEqual([tuple(row.row) for row in self.compile(plan)()], expected)
+
+    # the Limit is not turned into a TopK if its rows exceed the budget
+    plan = parse(q + " LIMIT 40 OFFSET 5")
+    plan.c.max_rows = 30
+    plan = Optimizer()(Yield(plan))
+    self.assertEqual(plan.collect(TopK), [])
+    self.assertEqual(len(plan.collect(Limit)), 1)
+    self.assertEqual([tuple(row.row) for row in plan], expected[5:45])
+    self.assertEqual([tuple(row.row) for row in self.compile(plan)()], expected[5:45])
+
+  def test_hybrid_hash_table(self):
+    table = HybridHashTable(10)
+    for i in xrange(100):
+      table.add(i % 40, (i,))
+    self.assertTrue(table.spilled)
+    probes = [(k, ("l%d" % k,)) for k in xrange(-5, 45)]
+    matches = [(lrow, table.lookup(key, lrow)) for key, lrow in probes]
+    matches = chain([m for m in matches if m[1]], table.spilled_matches())
+    res = sorted((lrow[0], rrow[0]) for lrow, rrows in matches for rrow in rrows)
+    self.assertEqual(res, sorted(("l%d" % (i % 40), i) for i in xrange(100)))
+
+  def test_hash_join_spills(self):
+    n = 300
+    self.db.register_dataframe("sp2", pd.DataFrame({
+      "k": np.arange(n) % 37, "c": np.arange(n)}))
+    # a skewed key that can not be partitioned further
+    self.db.register_dataframe("sp3", pd.DataFrame({
+      "k": np.zeros(n, dtype=int), "c": np.arange(n)}))
+    for t in ("sp2", "sp3"):
+      l, r = Scan("sp", "l"), Scan(t, "r")
+      attrs = [Attr("a", tablename="l"), Attr("k", tablename="r")]
+      plan = Optimizer()(Yield(HashJoin(l, r, attrs, cond_to_func("l.b < r.c"))))
+      expected = sorted(tuple(row.row) for row in plan)
+      self.assertTrue(len(expected) > 0)
+
+      join = plan.collect(HashJoin)[0]
+      join.max_rows = 20
+      stats.reset()
+      self.assertEqual(sorted(tuple(row.row) for row in plan), expected)
+      self.assertTrue(stats.nfiles > 0 and stats.nbytes > 0)
+      self.assertEqual(sorted(tuple(row.row) for row in self.compile(plan)()), expected)
@@ -0,0 +1,169 @@
+"""
+Table statistics and cost model tests
+"""
+import unittest
+import numpy as np
+import pandas as pd
+from databass import *
+from databass.stats import *
+from databass.ops import Scan, ThetaJoin
+from databass.tables import InMemoryTable
+
+
+class ScanCountingTable(InMemoryTable):
+  """
+  Row-oriented table that counts the number of passes over its rows
+  """
+  def __init__(self, schema, rows):
+    super(ScanCountingTable, self).__init__(schema, rows)
+    self.nscans = 0
+
+  def iter_rows(self, idxs=None):
+    self.nscans += 1
+    return super(ScanCountingTable, self).iter_rows(idxs)
+
+  def column(self, aname):
+    raise Exception("ScanCountingTable: column() rescans the table")
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+
+  def test_attr_stats(self):
+    table = self.db["data"]
+    self.assertTrue(table.stats is table.stats)
+    for attr in table.schema:
+      vals = table.col_values(attr)
+      stat = table.stats[attr]
+      self.assertEqual(stat.card, len(vals))
+      self.assertEqual(stat.nulls, 0)
+      self.assertEqual(stat.ndv, len(set(vals)))
+      self.assertEqual(stat.domain, [min(vals), max(vals)])
+      self.assertEqual(stat.hist is None, attr.typ != "num")
+    self.assertEqual(table.stats["a"], table.stats[Attr("a")])
+
+  def test_nulls(self):
+    df = pd.DataFrame({"x": [1.0, np.nan, 3.0, 3.0],
+                       "y": ["a", None, "b", np.nan]})
+    self.db.register_dataframe("nulls", df)
+    stats = self.db["nulls"].stats
+    self.assertEqual((stats["x"].nulls, stats["x"].ndv), (1, 2))
+    self.assertEqual((stats["y"].nulls, stats["y"].ndv), (2, 2))
+    self.assertEqual(stats["x"].domain, [1.0, 3.0])
+    self.assertAlmostEqual(stats["y"].selectivity_eq(), 0.25)
+
+  def test_histogram(self):
+    # skewed: half of the values are 0
+    vals = np.sort(np.concatenate([np.zeros(500), np.arange(1, 501)]))
+    hist = Histogram.from_values(vals, 10)
+    self.assertEqual(hist.counts.sum(), len(vals))
+    self.assertAlmostEqual(hist.selectivity_eq(0), 0.5)
+    self.assertAlmostEqual(hist.selectivity_eq(250), 0.001, places=3)
+    self.assertAlmostEqual(hist.selectivity_range(1, 500), 0.5, places=2)
+    self.assertAlmostEqual(hist.selectivity_range(251, 500), 0.25, places=2)
+    self.assertEqual(hist.selectivity_range(600, 700), 0)
+    self.assertEqual(hist.selectivity_range(), 1)
+
+  def test_join_estimates(self):
+    n = 1000
+    self.db.register_dataframe("big", pd.DataFrame({
+      "k": np.arange(n), "v": np.arange(n) % 10}))
+    self.db.register_dataframe("small", pd.DataFrame({
+      "k": np.arange(10), "w": np.arange(10)}))
+    opt = SelingerOpt(self.db)
+    big, small = Scan("big", "big"), Scan("small", "small")
+    pred = cond_to_func("big.v = small.k")
+    join = ThetaJoin(big, small, pred)
+    self.assertEqual(opt.card(big), n)
+    self.assertAlmostEqual(opt.selectivity(join), 0.1)
+    self.assertAlmostEqual(opt.card(join), n)
+
+    # nested loops rescans the inner table for every outer row, so the 
+    # smaller table should be the outer one
+    flipped = ThetaJoin(small, big, cond_to_func("big.v = small.k"))
+    self.assertAlmostEqual(opt.card(flipped), n)
+    self.assertTrue(opt.cost(flipped) < opt.cost(join))
+
+  def test_sketches(self):
+    n = 20000
+    keys = np.random.randint(0, 5000, n)
+    keys[:n // 4] = 7
+    df = pd.DataFrame({"k": keys, "s": ["s%d" % k for k in keys]})
+    threshold = Stats.SKETCH_THRESHOLD
+    Stats.SKETCH_THRESHOLD = 1000
+    try:
+      self.db.register_dataframe("sketched", df)
+    finally:
+      Stats.SKETCH_THRESHOLD = threshold
+    stats = self.db["sketched"].stats
+    for aname in ["k", "s"]:
+      stat = stats[aname]
+      self.assertTrue(isinstance(stat, SketchAttrStats))
+      self.assertEqual(stat.card, n)
+      ndv = len(set(keys))
+      self.assertTrue(abs(stat.ndv - ndv) < 0.05 * ndv)
+    self.assertEqual(stats["k"].domain, [keys.min(), keys.max()])
+    self.assertAlmostEqual(stats["k"].selectivity_eq(7.0), 0.25, places=2)
+    self.assertAlmostEqual(stats["s"].selectivity_eq("s7"), 0.25, places=2)
+    self.assertTrue(stats["k"].selectivity_eq(-1) < 0.001)
+    self.assertAlmostEqual(stats["k"].selectivity_range(0, 2500), 0.625, places=1)
+
+  def test_sorted_attrs(self):
+    n = 3000
+    # "b" is only out of order across the sketches' chunks
+    df = pd.DataFrame({"a": np.arange(n) * 0.5, "b": np.arange(n) % 1000,
+                       "c": np.arange(n)[::-1], "s": ["s%d" % i for i in xrange(n)]})
+    df.loc[10, "a"] = np.nan
+    threshold, chunk_size = Stats.SKETCH_THRESHOLD, SketchAttrStats.CHUNK_SIZE
+    for sketch in (False, True):
+      Stats.SKETCH_THRESHOLD = 1000 if sketch else threshold
+      SketchAttrStats.CHUNK_SIZE = 1000
+      try:
+        self.db.register_dataframe("sorted", df)
+      finally:
+        Stats.SKETCH_THRESHOLD, SketchAttrStats.CHUNK_SIZE = threshold, chunk_size
+      stats = self.db["sorted"].stats
+      self.assertEqual(isinstance(stats["a"], SketchAttrStats), sketch)
+      self.assertEqual([stats[aname].is_sorted for aname in "abcs"],
+                       [True, False, False, False])
+
+  def test_reservoir(self):
+    sample = Reservoir(100)
+    for start in xrange(0, 10000, 999):
+      sample.add(np.arange(start, min(10000, start + 999)))
+    self.assertEqual(sample.n, 10000)
+    self.assertEqual(len(set(sample.sample)), 100)
+    # a uniform sample should have about half of its values in each half
+    self.assertTrue(25 < np.sum(sample.sample < 5000) < 75)
+
+  def test_row_table_stats(self):
+    # row-oriented tables are summarized in one pass over their rows, 
+    # whether or not they are sketched
+    n = 3000
+    df = pd.DataFrame({"k": np.arange(n) % 500, "v": np.arange(n) * 0.5,
+                       "s": ["s%d" % (i % 100) for i in xrange(n)]})
+    df.loc[10, "v"] = np.nan
+    self.db.register_dataframe("cols", df)
+    schema = self.db["cols"].schema
+    rows = [list(row) for row in self.db["cols"].iter_rows()]
+    threshold, chunk_size = Stats.SKETCH_THRESHOLD, SketchAttrStats.CHUNK_SIZE
+    for sketch in (False, True):
+      Stats.SKETCH_THRESHOLD = 1000 if sketch else threshold
+      SketchAttrStats.CHUNK_SIZE = 700
+      try:
+        table = ScanCountingTable(schema.copy(), rows)
+        stats = table.stats
+      finally:
+        Stats.SKETCH_THRESHOLD, SketchAttrStats.CHUNK_SIZE = threshold, chunk_size
+      self.assertEqual(table.nscans, 1)
+      self.assertEqual(stats.card, n)
+      for aname, ndv in (("k", 500), ("v", n - 1), ("s", 100)):
+        stat = stats[aname]
+        self.assertEqual(isinstance(stat, SketchAttrStats), sketch)
+        self.assertEqual((stat.card, stat.nulls), (n, aname == "v"))
+        self.assertTrue(abs(stat.ndv - ndv) < 0.05 * ndv)
+      self.assertEqual(stats["k"].domain, [0, 499])
+      self.assertEqual([stats[aname].is_sorted for aname in "kvs"],
+                       [False, True, False])
+      self.assertAlmostEqual(stats["k"].selectivity_eq(7), 0.002, places=3)
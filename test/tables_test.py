@@ -0,0 +1,43 @@
+"""
+Table representation tests
+"""
+import unittest
+import numpy as np
+import pandas
+from databass import *
+from databass.tables import InMemoryTable, ColumnarTable
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+
+  def test_columnar_from_dataframe(self):
+    df = pandas.DataFrame(dict(a=[1, 2, 3], b=[0.5, 1.5, 2.5], c=["x", "y", "z"]))
+    df = df[["a", "b", "c"]]
+    schema = Schema([Attr("a", "num"), Attr("b", "num"), Attr("c", "str")])
+    table = ColumnarTable.from_dataframe(schema, df)
+
+    self.assertEqual(len(table), 3)
+    self.assertEqual(table.column("a").dtype, np.int64)
+    self.assertEqual(table.column("c").dtype, np.object_)
+    self.assertEqual(table.col_values(Attr("b")), [0.5, 1.5, 2.5])
+    self.assertEqual(list(table.iter_rows()), 
+        [[1, 0.5, "x"], [2, 1.5, "y"], [3, 2.5, "z"]])
+    self.assertEqual(map(str, table), ["(1, 0.5, x)", "(2, 1.5, y)", "(3, 2.5, z)"])
+
+  def test_scan_matches_inmemory(self):
+    data = self.db["data"]
+    self.assertTrue(isinstance(data, ColumnarTable))
+
+    rows = [list(row) for row in data.iter_rows()]
+    self.db.register_table("data_rows", data.schema, 
+        InMemoryTable(data.schema.copy(), rows))
+
+    for tablename in ["data", "data_rows"]:
+      q = Yield(parse("SELECT a, e FROM %s WHERE a > 10" % tablename))
+      q = self.opt(q)
+      res = [str(row) for row in q]
+      self.assertEqual(len(res), 9)
+      self.assertEqual(res[0], "(11, cde)")
@@ -0,0 +1,80 @@
+"""
+Vectorized execution mode tests.
+Check that the batch-at-a-time mode produces the same results as the
+tuple-at-a-time iterators.
+"""
+import unittest
+from databass import *
+
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    self.db = Database.db()
+    self.opt = Optimizer()
+
+  def parse(self, s):
+    q = parse(s)
+    q = Yield(q)
+    q = self.opt(q)
+    return q
+
+  def run_query(self, s, ordered, batch_size=7):
+    q = self.parse(s)
+    res1 = [str(row) for row in q]
+    res2 = [str(row) for row in q.vectorized(batch_size)]
+    if not ordered:
+      res1.sort()
+      res2.sort()
+    self.assertEqual(res1, res2)
+    return res1
+
+  def test_scan_filter_project(self):
+    qs = ["SELECT 1",
+          "SELECT a, e FROM data WHERE a > 10",
+          "SELECT a+b AS x, 9*b FROM data WHERE (a > 3) and (b < 4)",
+          "SELECT a FROM data WHERE a BETWEEN 2 AND 5",
+          "SELECT lower(e) FROM data"]
+    for q in qs:
+      self.run_query(q, False)
+
+  def test_orderby_limit(self):
+    qs = ["SELECT * FROM data ORDER BY f LIMIT 2",
+          "SELECT e, a FROM data ORDER BY e DESC, a",
+          "SELECT a, b FROM data ORDER BY b, a DESC LIMIT 12"]
+    for q in qs:
+      self.run_query(q, True)
+    self.assertEqual(len(self.run_query(qs[-1], True, batch_size=5)), 12)
+
+  def test_groupby(self):
+    qs = ["SELECT count(b), sum(a), avg(f) FROM data GROUP BY c",
+          "SELECT c, e, count(b) FROM data GROUP BY c, e",
+          "SELECT a+b, count(c) FROM data GROUP BY a+b"]
+    for q in qs:
+      self.run_query(q, False)
+
+  def test_hashjoin(self):
+    q = HashJoin(Scan('data', 'd1'), Scan('data', "d2"),
+            map(cond_to_func, ["d1.a", "d2.c"]))
+    q = Yield(Project(q, [Star()]))
+    self.opt.initialize_plan(q)
+    res1 = sorted(str(row) for row in q)
+    res2 = sorted(str(row) for row in q.vectorized(3))
+    self.assertEqual(len(res1), 20)
+    self.assertEqual(res1, res2)
+
+    q = HashJoin(Scan('data', 'd1'), Scan('data', "d2"),
+            map(cond_to_func, ["d1.e", "d2.g"]))
+    q = Yield(Project(q, [Star()]))
+    self.opt.initialize_plan(q)
+    res1 = sorted(str(row) for row in q)
+    res2 = sorted(str(row) for row in q.vectorized(3))
+    self.assertEqual(res1, res2)
+
+  def test_subquery_join(self):
+    q = """SELECT d2.x
+      FROM (SELECT a AS x, sum(b) AS z
+            FROM data GROUP BY a) AS d2,
+           (SELECT d AS y, sum(b) AS z
+            FROM data GROUP BY d+1) AS d3
+      WHERE d2.z = d3.y ORDER BY x"""
+    self.assertEqual(self.run_query(q, True), ['(0)', '(5)', '(10)', '(15)'])